@@ -44,6 +44,10 @@ from extract_dispersy_statistics import *
 
 class DemersMessages(AbstractHandler):
 
+    keys = ("statistics-successful-messages", "statistics-created-messages")
+    fields = ("text",)
+    resumable = True
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
@@ -58,6 +62,15 @@ class DemersMessages(AbstractHandler):
             if key == "text" and node_nr not in self.pieces_received[value]:
                 self.pieces_received[value][node_nr] = timeoffset
 
+    def get_state(self):
+        return self.pieces_received
+
+    def merge_state(self, state):
+        # keep the first time a peer received a piece
+        for piece, peers in state.iteritems():
+            for node_nr, timeoffset in peers.iteritems():
+                self.pieces_received[piece][node_nr] = min(timeoffset, self.pieces_received[piece].get(node_nr, timeoffset))
+
     def all_files_done(self, extract_statistics):
         # modify self.pieces_received into flat piece, timeoffset dict
         pieces_received = defaultdict(list)
@@ -79,15 +92,20 @@ class DemersMessages(AbstractHandler):
         h_received_records.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print "Usage: %s <node-directory> <messagestoplot>" % (sys.argv[0])
+    parser = get_option_parser()
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_usage()
         print >> sys.stderr, sys.argv
 
         sys.exit(1)
 
-    e = get_parser(sys.argv)
+    e = get_parser([sys.argv[0]] + args)
+    e.record_format = options.format
+    e.incremental = options.incremental
+    e.partial = options.partial
     e.add_handler(DemersMessages())
-    e.parse()
+    e.parse(options.jobs)
 
 #
 # extract_demers_statistics.py ends here
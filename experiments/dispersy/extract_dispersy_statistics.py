@@ -1,26 +1,61 @@
 #!/usr/bin/env python
+import gzip
+import heapq
 import re
 import sys
 import os
 
 from collections import defaultdict
-from json import loads
+from copy import deepcopy
+from glob import glob
+from hashlib import md5
+from multiprocessing import Pool
 from time import time
 from traceback import print_exc
+import cPickle as pickle
+
+# Use the fastest JSON decoder available
+try:
+    from ujson import loads
+except ImportError:
+    try:
+        from simplejson import loads
+    except ImportError:
+        from json import loads
+
+from gumby.records import RECORD_FORMATS, open_record_reader, open_record_writer
 
 
 class ExtractStatistics:
 
-    def __init__(self, node_directory, handlers=[]):
+    # Stores the progress made on each statistics file when parsing incrementally
+    MANIFEST_FILENAME = 'extract_statistics.cache'
+    # Stores the per peer results of parsing the statistics files on the node that ran them
+    PARTIAL_MANIFEST_FILENAME = 'extract_statistics.partial'
+    # The end of every statistics file is kept in the partial manifest, for read_last
+    TAIL_SIZE = 4096
+
+    def __init__(self, node_directory, handlers=[], record_format='text', incremental=False, partial=False):
         self.node_directory = node_directory
         self.handlers = handlers
+        self.record_format = record_format
+        self.incremental = incremental
+        # Only run the per peer part on the peer directories of a single node, see parse_partial
+        self.partial = partial
         self.start_of_experiment = 0
+        # filename -> tail of the statistics files that come with a partial manifest
+        self.file_tails = {}
+        # outputdir -> seconds to add to the timeoffsets of the records parsed on the node
+        self.timeoffset_shifts = {}
 
     def add_handler(self, handler):
         self.handlers.append(handler)
 
-    def parse(self):
+    def parse(self, jobs=1):
+        partial_manifests = {} if self.partial else self.load_partial_manifests()
+
         for handler in self.handlers:
+            handler.record_format = self.record_format
             handler.parse(self)
 
         files = sorted(self.yield_files())
@@ -34,34 +69,40 @@ class ExtractStatistics:
         self.max_timeoffset = 0
         self.start_of_experiment = int(self.get_first_datetime(files))
 
-        start_time = time()
-        start_size = 0
-        after_size = 0
-        total_size = len(files)
+        if self.partial:
+            self.parse_partial(files, jobs)
+            print >> sys.stderr, "Partial results saved"
+            return
 
-        for node_nr, filename, outputdir in files:
-            for handler in self.handlers:
-                handler.new_file(node_nr, filename, outputdir)
+        if partial_manifests:
+            files = self.merge_partial_manifests(files, partial_manifests)
 
-            for line_nr, timestamp, timeoffset, key, json in self.read(filename):
-                converted_json = None
+        if self.incremental:
+            self.parse_incremental(files, jobs)
+        elif jobs > 1 and len(files) > 1:
+            self.parse_parallel(files, jobs)
+        else:
+            self.parse_files(files)
 
-                # we limit the output granularity to int
-                timestamp = int(timestamp)
-                timeoffset = int(timeoffset)
+        print >> sys.stderr, "All files parsed, merging..."
 
-                for handler in self.handlers:
-                    if handler.filter_line(node_nr, line_nr, timestamp, timeoffset, key):
-                        if not converted_json:
-                            converted_json = loads(json)
+        for handler in self.handlers:
+            handler.all_files_done(self)
 
-                        handler.handle_line(node_nr, line_nr, timestamp, timeoffset, key, converted_json)
+        print >> sys.stderr, "Finished merging"
+
+        print "XMIN=%d" % self.min_timeoffset
+        print "XMAX=%d" % self.max_timeoffset
+        print "XSTART=%d" % self.start_of_experiment
 
-                self.min_timeoffset = min(self.min_timeoffset, timeoffset)
-                self.max_timeoffset = max(self.max_timeoffset, timeoffset)
+    def parse_files(self, files):
+        start_time = time()
+        start_size = 0
+        after_size = 0
+        total_size = len(files)
 
-            for handler in self.handlers:
-                handler.end_file(node_nr, timestamp, timeoffset)
+        for node_nr, filename, outputdir in files:
+            self.parse_file(node_nr, filename, outputdir)
 
             after_size += 1
 
@@ -80,19 +121,381 @@ class ExtractStatistics:
                 start_time = time()
                 start_size = after_size
 
-        print >> sys.stderr, "All files parsed, merging..."
+    def parse_file(self, node_nr, filename, outputdir):
+        for handler in self.handlers:
+            handler.new_file(node_nr, filename, outputdir)
+
+        _, _, first_timestamp, last_timestamp = self.feed_lines(self.handlers, node_nr, filename)
+
+        timestamp = timeoffset = 0
+        if first_timestamp is not None:
+            self.min_timeoffset = min(self.min_timeoffset, self.get_timeoffset(first_timestamp))
+
+            timestamp = int(last_timestamp)
+            timeoffset = self.get_timeoffset(last_timestamp)
+            self.max_timeoffset = max(self.max_timeoffset, timeoffset)
 
         for handler in self.handlers:
-            handler.all_files_done(self)
+            handler.end_file(node_nr, timestamp, timeoffset)
 
-        print >> sys.stderr, "Finished merging"
+    def feed_lines(self, handlers, node_nr, filename, offset=0, line_nr=0):
+        """
+        Feeds the lines of a single statistics file, starting at byte offset, to the handlers interested in them.
 
-        print "XMIN=%d" % self.min_timeoffset
-        print "XMAX=%d" % self.max_timeoffset
-        print "XSTART=%d" % self.start_of_experiment
+        Lines with a key no handler declared interest in are skipped without parsing their timestamp, and
+        the JSON document of a line is only decoded if a handler accepts it. An incomplete last line is
+        left for the next time the file is parsed.
+
+        Returns the offset and line number after the last line parsed and the first and last timestamps
+        found (None if no lines were parsed). The statistics files are written in chronological order, so
+        those hold the minimum and maximum timestamps.
+        """
+        wanted_keys = self.get_wanted_keys(handlers)
+        key_handlers = {}
+
+        first_timestamp = last_timestamp = None
+
+        h_statistics = self.open_statistics(filename)
+        h_statistics.seek(offset)
+        for line in h_statistics:
+            if line[-1] != '\n':
+                break
+
+            offset += len(line)
+            timestamp, _, key, json = line.split(' ', 3)
+
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            last_timestamp = timestamp
+
+            if wanted_keys is None or key in wanted_keys:
+                line_handlers = key_handlers.get(key)
+                if line_handlers is None:
+                    line_handlers = key_handlers[key] = [(handler, self.get_quoted_fields(handler)) for handler in handlers if handler.keys is None or key in handler.keys]
+
+                converted_json = None
+
+                # we limit the output granularity to int
+                timestamp = float(timestamp)
+                timeoffset = int(timestamp - self.start_of_experiment)
+                timestamp = int(timestamp)
+
+                for handler, quoted_fields in line_handlers:
+                    if quoted_fields and not any(field in json for field in quoted_fields):
+                        continue
+
+                    if handler.filter_line(node_nr, line_nr, timestamp, timeoffset, key):
+                        if converted_json is None:
+                            converted_json = loads(json)
+
+                        handler.handle_line(node_nr, line_nr, timestamp, timeoffset, key, converted_json)
+
+            line_nr += 1
+        h_statistics.close()
+
+        if first_timestamp is not None:
+            first_timestamp = float(first_timestamp)
+            last_timestamp = float(last_timestamp)
+        return offset, line_nr, first_timestamp, last_timestamp
+
+    def get_timeoffset(self, timestamp):
+        return int(timestamp - self.start_of_experiment)
+
+    def get_wanted_keys(self, handlers):
+        """
+        Returns the set of line keys the handlers are interested in, or None if any of them wants all lines.
+        """
+        wanted_keys = set()
+        for handler in handlers:
+            if handler.keys is None:
+                return None
+            wanted_keys.update(handler.keys)
+        return wanted_keys
+
+    def get_quoted_fields(self, handler):
+        if handler.fields is None:
+            return None
+        return ['"%s"' % field for field in handler.fields]
+
+    def parse_parallel(self, files, jobs):
+        """
+        Shards the files over a pool of worker processes. Each worker runs the per file handler hooks on its
+        shard and sends back the partial handler states, which are merged into the handlers of this process.
+        """
+        global _extract_statistics
+        _extract_statistics = self
+
+        shards = [shard for shard in (files[i::jobs] for i in xrange(jobs)) if shard]
+        print >> sys.stderr, "Parsing using", len(shards), "processes"
+
+        # maxtasksperchild=1 makes sure every shard starts from the initial handler state
+        pool = Pool(len(shards), maxtasksperchild=1)
+        try:
+            for min_timeoffset, max_timeoffset, states in pool.imap_unordered(_parse_shard, shards):
+                self.min_timeoffset = min(self.min_timeoffset, min_timeoffset)
+                self.max_timeoffset = max(self.max_timeoffset, max_timeoffset)
+
+                for handler, state in zip(self.handlers, states):
+                    handler.merge_state(state)
+        finally:
+            pool.close()
+            pool.join()
+
+    def parse_incremental(self, files, jobs):
+        """
+        Only parses the statistics files that changed since the last run, using the manifest stored in the
+        node directory. Files that grew are parsed from the offset reached last time if all the handlers are
+        resumable, other changed files are parsed from the start.
+
+        The manifest stores, for every file, its size and mtime, the offset and line number reached, the
+        per file state of every handler (to resume it) and the state it contributed to the handlers (merged
+        into the handlers of this process for the files that are skipped).
+        """
+        global _extract_statistics
+        _extract_statistics = self
+
+        digest = self.get_handlers_digest()
+        manifest = self.load_manifest(digest)
+        resumable = all(handler.resumable for handler in self.handlers)
+
+        to_parse = []
+        entries = {}
+        nr_resumed = 0
+        for node_nr, filename, outputdir in files:
+            entry = manifest.get(filename)
+            if entry:
+                file_stat = os.stat(filename)
+                if file_stat.st_size == entry['size'] and file_stat.st_mtime == entry['mtime']:
+                    entries[filename] = entry
+                    continue
+
+                if not (resumable and file_stat.st_size >= entry['offset'] and self.get_tail_digest(filename, entry['offset']) == entry['tail_digest']):
+                    entry = None
+
+            nr_resumed += 1 if entry else 0
+            to_parse.append((node_nr, filename, outputdir, entry))
+
+        print >> sys.stderr, "Skipping", len(files) - len(to_parse), "unchanged files, resuming", nr_resumed, "and parsing", len(to_parse) - nr_resumed, "files"
+
+        # Every file starts from a copy of the handlers as they are before parsing any file
+        self.pristine_handlers = deepcopy(self.handlers)
+
+        for filename, entry in self.iter_parse_files_incrementally(to_parse, jobs):
+            entries[filename] = entry
+
+        for filename in sorted(entries):
+            entry = entries[filename]
+            if entry['min_timeoffset'] is not None:
+                self.min_timeoffset = min(self.min_timeoffset, entry['min_timeoffset'])
+                self.max_timeoffset = max(self.max_timeoffset, entry['last_timeoffset'])
+
+            for handler, state in zip(self.handlers, entry['states']):
+                handler.merge_state(state)
+
+        self.save_manifest(digest, entries)
+
+    def iter_parse_files_incrementally(self, to_parse, jobs):
+        """
+        Yields the (filename, manifest entry) pairs of parse_file_incrementally for every job in to_parse,
+        using up to jobs processes.
+        """
+        if jobs > 1 and len(to_parse) > 1:
+            pool = Pool(min(jobs, len(to_parse)))
+            try:
+                for result in pool.imap_unordered(_parse_file_incrementally, to_parse):
+                    yield result
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in to_parse:
+                yield self.parse_file_incrementally(*job)
+
+    def parse_partial(self, files, jobs):
+        """
+        Runs the per peer part of the parsing on the node the peers ran on, so the head node only has to
+        merge the results. Every file is parsed as it would be when parsing incrementally, the per peer
+        record files are left in the peer directories and the manifest entries (plus the tail of every
+        statistics file) are saved in a partial manifest, picked up by merge_partial_manifests.
+
+        The results only depend on the peers of this node, if the handler configuration (IE: the communities
+        found) turns out to be different on the head node the files will be parsed there again.
+        """
+        global _extract_statistics
+        _extract_statistics = self
+
+        self.pristine_handlers = deepcopy(self.handlers)
+
+        entries = {}
+        for filename, entry in self.iter_parse_files_incrementally([file + (None,) for file in files], jobs):
+            h_statistics = open(filename, 'rb')
+            h_statistics.seek(max(entry['offset'] - self.TAIL_SIZE, 0))
+            entry['tail'] = h_statistics.read(min(entry['offset'], self.TAIL_SIZE))
+            h_statistics.close()
+
+            entries[os.path.basename(os.path.dirname(filename))] = entry
+
+        filename = os.path.join(self.node_directory, self.PARTIAL_MANIFEST_FILENAME)
+        h_manifest = open(filename + '.tmp', 'wb')
+        pickle.dump({'digest': self.get_handlers_digest(),
+                     'start_of_experiment': self.start_of_experiment,
+                     'entries': entries}, h_manifest, pickle.HIGHEST_PROTOCOL)
+        h_manifest.close()
+        os.rename(filename + '.tmp', filename)
+
+    def load_partial_manifests(self):
+        """
+        Returns the partial manifests found in the node directories, by node directory, and keeps the tails
+        of the statistics files they describe for read_last.
+        """
+        partial_manifests = {}
+        for headnode in os.listdir(self.node_directory):
+            headdir = os.path.join(self.node_directory, headnode)
+            if os.path.isdir(headdir):
+                for node in os.listdir(headdir):
+                    nodedir = os.path.join(headdir, node)
+                    filename = os.path.join(nodedir, self.PARTIAL_MANIFEST_FILENAME)
+                    if os.path.exists(filename):
+                        try:
+                            h_manifest = open(filename, 'rb')
+                            partial_manifests[nodedir] = pickle.load(h_manifest)
+                            h_manifest.close()
+                        except:
+                            print_exc()
+
+        for node_nr, filename, outputdir in self.yield_files():
+            manifest = partial_manifests.get(os.path.dirname(outputdir))
+            entry = manifest and manifest['entries'].get(os.path.basename(outputdir))
+            if entry:
+                self.file_tails[filename] = entry['tail']
+        return partial_manifests
+
+    def merge_partial_manifests(self, files, partial_manifests):
+        """
+        Merges the results of the files parsed on their nodes and returns the files that still need to be
+        parsed. The start of the experiment seen by a node might be different from the global one, the
+        difference is added to the timeoffsets of its records when merging them.
+        """
+        to_parse = []
+        for node_nr, filename, outputdir in files:
+            manifest = partial_manifests.get(os.path.dirname(outputdir))
+            entry = manifest and manifest['entries'].get(os.path.basename(outputdir))
+            if not entry or manifest['digest'] != self.get_handlers_digest(manifest['start_of_experiment']):
+                to_parse.append((node_nr, filename, outputdir))
+                continue
+
+            shift = manifest['start_of_experiment'] - self.start_of_experiment
+            if shift:
+                self.timeoffset_shifts[outputdir] = shift
+
+            if entry['min_timeoffset'] is not None:
+                self.min_timeoffset = min(self.min_timeoffset, self.get_timeoffset(entry['first_timestamp']))
+                self.max_timeoffset = max(self.max_timeoffset, self.shift_timeoffsets([entry['last_timestamp']], [entry['last_timeoffset']], shift)[0])
+
+            for handler, state in zip(self.handlers, entry['states']):
+                handler.merge_state(state)
+
+        print >> sys.stderr, "Merged the results of", len(files) - len(to_parse), "files parsed on their nodes, parsing", len(to_parse), "files"
+        return to_parse
+
+    def shift_timeoffsets(self, timestamps, timeoffsets, shift):
+        """
+        Converts the timeoffsets of a node whose start of the experiment was shift seconds after the global
+        one. They were int(timestamp - start) of the float timestamps, which rounds towards 0, so in the
+        seconds between both starts they have to be computed again from the (int) timestamps.
+        """
+        node_start = self.start_of_experiment + shift
+        return [timestamp - self.start_of_experiment if self.start_of_experiment <= timestamp < node_start else timeoffset + shift
+                for timestamp, timeoffset in zip(timestamps, timeoffsets)]
+
+    def parse_file_incrementally(self, node_nr, filename, outputdir, entry=None):
+        handlers = deepcopy(self.pristine_handlers)
+        file_stat = os.stat(filename)
+
+        if entry:
+            for handler, state, file_state in zip(handlers, entry['states'], entry['file_states']):
+                handler.merge_state(state)
+                handler.resume_file(node_nr, filename, outputdir, file_state)
+            offset, line_nr, min_timeoffset = entry['offset'], entry['line_nr'], entry['min_timeoffset']
+            timestamp, timeoffset = entry['last_timestamp'], entry['last_timeoffset']
+            file_first_timestamp = entry.get('first_timestamp')
+        else:
+            for handler in handlers:
+                handler.new_file(node_nr, filename, outputdir)
+            offset = line_nr = 0
+            min_timeoffset = file_first_timestamp = None
+            timestamp = timeoffset = 0
+
+        offset, line_nr, first_timestamp, last_timestamp = self.feed_lines(handlers, node_nr, filename, offset, line_nr)
+        if first_timestamp is not None:
+            if min_timeoffset is None:
+                min_timeoffset = self.get_timeoffset(first_timestamp)
+                file_first_timestamp = first_timestamp
+            timestamp = int(last_timestamp)
+            timeoffset = self.get_timeoffset(last_timestamp)
+
+        for handler in handlers:
+            handler.end_file(node_nr, timestamp, timeoffset)
+
+        return filename, {'size': file_stat.st_size,
+                          'mtime': file_stat.st_mtime,
+                          'offset': offset,
+                          'line_nr': line_nr,
+                          'tail_digest': self.get_tail_digest(filename, offset),
+                          'min_timeoffset': min_timeoffset,
+                          'first_timestamp': file_first_timestamp,
+                          'last_timestamp': timestamp,
+                          'last_timeoffset': timeoffset,
+                          'file_states': [handler.get_file_state() for handler in handlers],
+                          'states': [handler.get_state() for handler in handlers]}
+
+    def get_tail_digest(self, filename, offset, size=1024):
+        # Used to check that the part of a file we already parsed has not been modified
+        h_statistics = open(filename, 'rb')
+        h_statistics.seek(max(offset - size, 0))
+        digest = md5(h_statistics.read(min(offset, size))).hexdigest()
+        h_statistics.close()
+        return digest
+
+    def get_handlers_digest(self, start_of_experiment=None):
+        """
+        Identifies the handler configuration, a manifest made with a different one can not be reused.
+        """
+        if start_of_experiment is None:
+            start_of_experiment = self.start_of_experiment
+        config = [(handler.__class__.__name__, handler.get_config()) for handler in self.handlers]
+        return md5(pickle.dumps((config, self.record_format, start_of_experiment))).hexdigest()
+
+    def load_manifest(self, digest):
+        filename = os.path.join(self.node_directory, self.MANIFEST_FILENAME)
+        if os.path.exists(filename):
+            try:
+                h_manifest = open(filename, 'rb')
+                manifest_digest, entries = pickle.load(h_manifest)
+                h_manifest.close()
+            except:
+                print_exc()
+            else:
+                if manifest_digest == digest:
+                    return entries
+                print >> sys.stderr, "The handlers changed since the last run, parsing all files"
+        return {}
+
+    def save_manifest(self, digest, entries):
+        filename = os.path.join(self.node_directory, self.MANIFEST_FILENAME)
+        h_manifest = open(filename + '.tmp', 'wb')
+        pickle.dump((digest, entries), h_manifest, pickle.HIGHEST_PROTOCOL)
+        h_manifest.close()
+        os.rename(filename + '.tmp', filename)
+
+    def open_statistics(self, filename):
+        # The statistics files parsed on their nodes are compressed before being sent to the head node
+        if filename.endswith('.gz'):
+            return gzip.open(filename, 'rb')
+        return open(filename)
 
     def read(self, filename, filterkey=[]):
-        for line_nr, line in enumerate(open(filename)):
+        for line_nr, line in enumerate(self.open_statistics(filename)):
             timestamp, _, key, json = line.split(' ', 3)
 
             if not filterkey or key in filterkey:
@@ -101,16 +504,27 @@ class ExtractStatistics:
                 yield line_nr, timestamp, timeoffset, key, json
 
     def read_last(self, filename, chars):
-        # From http://stackoverflow.com/a/260352
-        f = open(filename, "r")
-        f.seek(0, 2)  # Seek @ EOF
-        fsize = f.tell()  # Get Size
-        f.seek(max(fsize - chars, 0), 0)  # Set pos @ last n chars
+        if filename in self.file_tails and chars <= self.TAIL_SIZE:
+            lines = self.file_tails[filename][-chars:].splitlines(True)[1:]
+        elif filename.endswith('.gz'):
+            # Compressed files can't be read from the end
+            lines = self.open_statistics(filename).read()[-chars:].splitlines(True)[1:]
+        else:
+            # From http://stackoverflow.com/a/260352
+            f = open(filename, "r")
+            f.seek(0, 2)  # Seek @ EOF
+            fsize = f.tell()  # Get Size
+            f.seek(max(fsize - chars, 0), 0)  # Set pos @ last n chars
+
+            # skip broken line
+            f.readline()
 
-        # skip broken line
-        f.readline()
+            lines = f.readlines()
+            f.close()
 
-        lines = f.readlines()
+        # skip the last line if it is still being written
+        if lines and not lines[-1].endswith('\n'):
+            lines.pop()
         lines.reverse()
 
         for line_nr, line in enumerate(lines):
@@ -143,81 +557,113 @@ class ExtractStatistics:
         return min(datetimes)
 
     def yield_files(self):
-        pattern = re.compile('[0-9]+')
+        if self.partial:
+            # We are running on the node, the peer directories are right here
+            for file in self.yield_node_files(self.node_directory):
+                yield file
+            return
+
         for headnode in os.listdir(self.node_directory):
             headdir = os.path.join(self.node_directory, headnode)
             if os.path.isdir(headdir):
                 for node in os.listdir(headdir):
                     nodedir = os.path.join(self.node_directory, headnode, node)
                     if os.path.isdir(nodedir):
-                        for peer in os.listdir(nodedir):
-                            peerdir = os.path.join(self.node_directory, headnode, node, peer)
-                            if os.path.isdir(peerdir) and pattern.match(peer):
-                                peer_nr = int(peer)
+                        for file in self.yield_node_files(nodedir):
+                            yield file
+
+    def yield_node_files(self, nodedir):
+        pattern = re.compile('[0-9]+')
+        for peer in os.listdir(nodedir):
+            peerdir = os.path.join(nodedir, peer)
+            if os.path.isdir(peerdir) and pattern.match(peer):
+                peer_nr = int(peer)
 
-                                filename = os.path.join(self.node_directory, headnode, node, peer, 'statistics.log')
-                                if os.path.exists(filename):
-                                    yield peer_nr, filename, peerdir
+                for filename in ('statistics.log', 'statistics.log.gz'):
+                    filename = os.path.join(peerdir, filename)
+                    if os.path.exists(filename):
+                        yield peer_nr, filename, peerdir
+                        break
 
     def merge_records(self, inputfilename, outputfilename, columnindex, diffoutputfilename=None):
+        self.merge_columns(inputfilename, [(columnindex, outputfilename, diffoutputfilename)])
+
+    def merge_columns(self, inputfilename, columns):
+        """
+        Merges several columns of the per peer inputfilename files, reading each of them only once.
+
+        columns is a list of (columnindex, outputfilename, diffoutputfilename) tuples, diffoutputfilename can be None.
+        The non-zero records of every column are kept per peer in two arrays (time, value).
+        """
         all_nodes = []
+        columnindexes = [columnindex for columnindex, _, _ in columns]
 
-        sum_records = {}
+        column_records = [{} for _ in columns]
         for node_nr, _, inputdir in self.yield_files():
             all_nodes.append(node_nr)
 
-            h_records = open(os.path.join(inputdir, inputfilename))
-            for line in h_records:
-                if line[0] == "#":
-                    continue
+            reader = open_record_reader(os.path.join(inputdir, inputfilename))
+            node_columns = reader.get_columns(1, columnindexes, skip_zero=True)
 
-                parts = line.split()
-                if len(parts) > columnindex:
-                    time = float(parts[1])
-                    record = float(parts[columnindex])
-                    if record == 0:
-                        continue
-                    sum_records.setdefault(time, {})[node_nr] = record
-            h_records.close()
+            shift = self.timeoffset_shifts.get(inputdir)
+            if shift:
+                node_columns = [(self.shift_timeoffsets(timestamps, times, shift), values)
+                                for (times, values), (timestamps, _) in zip(node_columns, reader.get_columns(0, columnindexes, skip_zero=True))]
 
-        diffoutputfile = os.path.join(self.node_directory, diffoutputfilename) if diffoutputfilename else None
-        self.write_records(all_nodes, sum_records, os.path.join(self.node_directory, outputfilename), diffoutputfile)
+            for node_records, (times, values) in zip(column_records, node_columns):
+                if len(times):
+                    node_records[node_nr] = (times, values)
 
-    def write_records(self, all_nodes, sum_records, outputfile, diffoutputfile=None):
-        if len(sum_records) > 0:
-            all_nodes.sort()
+        all_nodes.sort()
+        for (_, outputfilename, diffoutputfilename), node_records in zip(columns, column_records):
+            diffoutputfile = os.path.join(self.node_directory, diffoutputfilename) if diffoutputfilename else None
+            self.write_records(all_nodes, node_records, os.path.join(self.node_directory, outputfilename), diffoutputfile)
 
-            fp = open(outputfile, 'wb')
-            fp2 = open(diffoutputfile, 'wb') if diffoutputfile else None
+    def write_records(self, all_nodes, node_records, outputfile, diffoutputfile=None):
+        """
+        Writes one row per distinct time, with the last known value of every node in all_nodes.
 
-            print >> fp, 'time', ' '.join(map(str, all_nodes))
-            if fp2:
-                print >> fp2, 'time', ' '.join(map(str, all_nodes))
+        node_records maps a node to its (times, values) arrays. The records of all nodes are merged on
+        time, if a node has several records with the same time the last one is used.
+        """
+        if len(node_records) > 0:
+            def iter_records(node_index, times, values):
+                if any(times[i] > times[i + 1] for i in xrange(len(times) - 1)):
+                    order = sorted(xrange(len(times)), key=times.__getitem__)
+                else:
+                    order = xrange(len(times))
 
-            prev_records = {}
-            for time in sorted(sum_records.iterkeys()):
-                print >> fp, time,
-                if fp2:
-                    print >> fp2, time,
+                for position in order:
+                    yield times[position], node_index, position, values[position]
 
-                nodes = sum_records[time]
-                for node in all_nodes:
-                    value = nodes.get(node, prev_records.get(node, 0))
-                    print >> fp, value,
+            names = ['time'] + map(str, all_nodes)
+            # The rows of the text files keep the trailing space they always had
+            fp = open_record_writer(outputfile, self.record_format, names, trailing_space=True)
+            fp2 = open_record_writer(diffoutputfile, self.record_format, names, trailing_space=True) if diffoutputfile else None
 
-                    if fp2:
-                        diff = value - prev_records.get(node, 0)
-                        print >> fp2, diff,
+            iterators = [iter_records(node_index, *node_records[node]) for node_index, node in enumerate(all_nodes) if node in node_records]
 
-                    prev_records[node] = value
-                print >> fp, ''
-                if fp2:
-                    print >> fp2, ''
+            prev_records = [0] * len(all_nodes)
+            cur_records = list(prev_records)
+            cur_time = None
+            for time, node_index, _, value in heapq.merge(*iterators):
+                if time != cur_time:
+                    if cur_time is not None:
+                        self._write_row(fp, fp2, cur_time, prev_records, cur_records)
+                    cur_time = time
+                cur_records[node_index] = value
+            self._write_row(fp, fp2, cur_time, prev_records, cur_records)
 
             fp.close()
             if fp2:
                 fp2.close()
 
+    def _write_row(self, fp, fp2, time, prev_records, cur_records):
+        fp.write(time, *cur_records)
+        if fp2:
+            fp2.write(time, *[value - prev for value, prev in zip(cur_records, prev_records)])
+        prev_records[:] = cur_records
+
     # From http://snipplr.com/view/5713/python-elapsedtime-human-readable-time-span-given-total-seconds/
     def elapsed_time(self, seconds, suffixes=['y', 'w', 'd', 'h', 'm', 's'], add_s=False, separator=' '):
         """
@@ -250,11 +696,53 @@ class ExtractStatistics:
         return separator.join(time)
 
 
+def _parse_shard(files):
+    # Runs in a worker process forked by ExtractStatistics.parse_parallel
+    extract_statistics = _extract_statistics
+    extract_statistics.parse_files(files)
+    return extract_statistics.min_timeoffset, extract_statistics.max_timeoffset, [handler.get_state() for handler in extract_statistics.handlers]
+
+
+def _parse_file_incrementally(job):
+    # Runs in a worker process forked by ExtractStatistics.parse_incremental
+    return _extract_statistics.parse_file_incrementally(*job)
+
+
 class AbstractHandler(object):
 
+    """
+    Handlers that keep state across files (used in all_files_done) need to implement get_state and merge_state
+    to support parsing with multiple processes. get_state should return a picklable object with the state built
+    from the files parsed by a worker, merge_state will receive that object in the main process.
+
+    Numeric per file output should be written using open_records, so it honours the record format
+    (text or binary) selected for this run.
+
+    Handlers should declare the line keys they handle in keys, lines with any other key will not be passed
+    to filter_line. If fields is set, only lines whose JSON document contains at least one of those
+    (top level) fields will be passed to filter_line. None means all keys or fields.
+
+    To be resumable when parsing incrementally, a handler needs to implement get_file_state, returning a
+    picklable object with its per file state after end_file, and resume_file, which is called instead of
+    new_file with that object when the rest of a file that grew is parsed. get_config should return
+    anything that changes the output of the handler, so previous results are not reused if it changes.
+    merge_state may receive states that overlap with the ones already merged.
+    """
+
+    record_format = 'text'
+    keys = None
+    fields = None
+    resumable = False
+
     def parse(self, extract_statistics):
         pass
 
+    def open_records(self, outputdir, filename, comments=(), append=False, truncate=None):
+        return open_record_writer(os.path.join(outputdir, filename), self.record_format, comments=comments, append=append, truncate=truncate)
+
+    def get_config(self):
+        return None
+
     def new_file(self, node_nr, filename, outputdir):
         pass
 
@@ -270,9 +758,25 @@ class AbstractHandler(object):
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         pass
 
+    def get_state(self):
+        return None
+
+    def merge_state(self, state):
+        pass
+
+    def get_file_state(self):
+        return None
+
+    def resume_file(self, node_nr, filename, outputdir, state):
+        pass
+
 
 class BasicExtractor(AbstractHandler):
 
+    keys = ("statistics",)
+    fields = ("total_down", "total_up", "total_send", "received_count", "drop_count", "communities")
+    resumable = True
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
@@ -298,6 +802,9 @@ class BasicExtractor(AbstractHandler):
         self.communities = list(communities)
         self.communities.sort()
 
+    def get_config(self):
+        return self.communities
+
     def new_file(self, node_nr, filename, outputdir):
         node = str(node_nr)
 
@@ -307,31 +814,40 @@ class BasicExtractor(AbstractHandler):
 
         self.max_incomming_connections = 0
 
-        self.h_stat = open(os.path.join(outputdir, "stat.txt"), "w+")
-        print >> self.h_stat, "# timestamp timeoffset total-send total-received"
-        print >> self.h_stat, "0 0 0 0"
+        self.h_stat = self.open_records(outputdir, "stat.txt", ["timestamp timeoffset total-send total-received"])
+        self.h_stat.write(0, 0, 0, 0)
 
-        self.h_drop = open(os.path.join(outputdir, "drop.txt"), "w+")
-        print >> self.h_drop, "# timestamp timeoffset num-drops"
-        print >> self.h_drop, "0 0 0"
+        self.h_drop = self.open_records(outputdir, "drop.txt", ["timestamp timeoffset num-drops"])
+        self.h_drop.write(0, 0, 0)
 
-        self.h_total_connections = open(os.path.join(outputdir, "total_connections.txt"), "w+")
-        print >> self.h_total_connections, "# timestamp timeoffset (num-connections +)"
-        print >> self.h_total_connections, "#", " ".join(self.communities)
-        print >> self.h_total_connections, "0 0" + (" 0" * len(self.communities))
+        self.h_total_connections = self.open_records(outputdir, "total_connections.txt", ["timestamp timeoffset (num-connections +)", " ".join(self.communities)])
+        self.h_total_connections.write(0, 0, *[0] * len(self.communities))
 
-        self.h_blstats = open(os.path.join(outputdir, "bl_stat.txt"), "w+")
-        print >> self.h_blstats, "# timestamp timeoffset (bl-skip +) (bl-reuse +) (bl-new +)"
-        print >> self.h_blstats, "#", " ".join(self.communities)
-        print >> self.h_blstats, "0 0" + (" 0 0" * len(self.communities))
+        self.h_blstats = self.open_records(outputdir, "bl_stat.txt", ["timestamp timeoffset (bl-skip +) (bl-reuse +) (bl-new +)", " ".join(self.communities)])
+        self.h_blstats.write(0, 0, *[0] * (3 * len(self.communities)))
 
-    def end_file(self, node_nr, timestamp, timeoffset):
-        print >> self.h_drop, timestamp, timeoffset, self.c_dropped_record
+    def resume_file(self, node_nr, filename, outputdir, state):
+        c_dropped_record, c_communities, c_blstats, max_incomming_connections, dispersy_in_out, end_offsets = state
+
+        self.c_dropped_record = c_dropped_record
+        self.c_communities = defaultdict(lambda: 0, c_communities)
+        self.c_blstats = defaultdict(lambda: [0, 0, 0], c_blstats)
+        self.max_incomming_connections = max_incomming_connections
+        self.dispersy_in_out.update(dispersy_in_out)
+
+        self.h_stat = self.open_records(outputdir, "stat.txt", append=True)
+        # drop the records written by end_file, they will be written again once we are done
+        self.h_drop = self.open_records(outputdir, "drop.txt", append=True, truncate=end_offsets[0])
+        self.h_total_connections = self.open_records(outputdir, "total_connections.txt", append=True, truncate=end_offsets[1])
+        self.h_blstats = self.open_records(outputdir, "bl_stat.txt", append=True)
 
-        print >> self.h_total_connections, timestamp, timeoffset,
-        for community in self.communities:
-            print >> self.h_total_connections, self.c_communities[community],
-        print >> self.h_total_connections, ''
+    def get_file_state(self):
+        return self.c_dropped_record, dict(self.c_communities), dict(self.c_blstats), self.max_incomming_connections, dict(self.dispersy_in_out), self.end_offsets
+
+    def end_file(self, node_nr, timestamp, timeoffset):
+        self.end_offsets = (self.h_drop.tell(), self.h_total_connections.tell())
+        self.h_drop.write(timestamp, timeoffset, self.c_dropped_record)
+        self.h_total_connections.write(timestamp, timeoffset, *[self.c_communities[community] for community in self.communities])
 
         self.nr_connections.append((self.max_incomming_connections, node_nr))
         self.nr_connections.sort(reverse=True)
@@ -342,6 +858,17 @@ class BasicExtractor(AbstractHandler):
         self.h_total_connections.close()
         self.h_blstats.close()
 
+    def get_state(self):
+        return self.nr_connections
+
+    def merge_state(self, state):
+        # keep the highest amount of connections seen for every node
+        nr_connections = dict((node, nr) for nr, node in self.nr_connections)
+        for nr, node in state:
+            nr_connections[node] = max(nr, nr_connections.get(node, nr))
+
+        self.nr_connections = sorted(((nr, node) for node, nr in nr_connections.iteritems()), reverse=True)[:10]
+
     def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
         return key == "statistics"
 
@@ -352,11 +879,11 @@ class BasicExtractor(AbstractHandler):
         self.dispersy_in_out[node_nr][3] = value.get("received_count", self.dispersy_in_out[node_nr][3])
 
         if "total_down" in value or "total_up" in value:
-            print >> self.h_stat, timestamp, timeoffset, self.dispersy_in_out[node_nr][1], self.dispersy_in_out[node_nr][0]
+            self.h_stat.write(timestamp, timeoffset, self.dispersy_in_out[node_nr][1], self.dispersy_in_out[node_nr][0])
 
         if "drop_count" in value:
             self.c_dropped_record = value["drop_count"]
-            print >> self.h_drop, timestamp, timeoffset, self.c_dropped_record
+            self.h_drop.write(timestamp, timeoffset, self.c_dropped_record)
 
         if 'communities' in value:
             for community in value['communities']:
@@ -370,19 +897,12 @@ class BasicExtractor(AbstractHandler):
             if self.c_communities:
                 self.max_incomming_connections = max(self.max_incomming_connections, max(self.c_communities.values()))
 
-            print >> self.h_total_connections, timestamp, timeoffset,
-            for community in self.communities:
-                print >> self.h_total_connections, self.c_communities[community],
-            print >> self.h_total_connections, ''
+            self.h_total_connections.write(timestamp, timeoffset, *[self.c_communities[community] for community in self.communities])
 
-            print >> self.h_blstats, timestamp, timeoffset,
-            for community in self.communities:
-                print >> self.h_blstats, self.c_blstats[community][0],
-            for community in self.communities:
-                print >> self.h_blstats, self.c_blstats[community][1],
-            for community in self.communities:
-                print >> self.h_blstats, self.c_blstats[community][2],
-            print >> self.h_blstats, ''
+            blstats = [self.c_blstats[community][0] for community in self.communities]
+            blstats.extend(self.c_blstats[community][1] for community in self.communities)
+            blstats.extend(self.c_blstats[community][2] for community in self.communities)
+            self.h_blstats.write(timestamp, timeoffset, *blstats)
 
     def all_files_done(self, extract_statistics):
         f = open(os.path.join(extract_statistics.node_directory, "dispersy_incomming_connections.txt"), 'w')
@@ -392,49 +912,67 @@ class BasicExtractor(AbstractHandler):
         f.close()
 
         extract_statistics.merge_records("total_record.txt", 'sum_total_records.txt', 2)
-        extract_statistics.merge_records("stat.txt", 'send.txt', 2, 'send_diff.txt')
-        extract_statistics.merge_records("stat.txt", 'received.txt', 3, 'received_diff.txt')
+        extract_statistics.merge_columns("stat.txt", [(2, 'send.txt', 'send_diff.txt'), (3, 'received.txt', 'received_diff.txt')])
         extract_statistics.merge_records("drop.txt", 'dropped.txt', 2, 'dropped_diff.txt')
 
-        for column in xrange(len(self.communities)):
-            extract_statistics.merge_records("total_connections.txt", 'total_connections_%d.txt' % (column + 1), 2 + column)
+        nr_communities = len(self.communities)
+        if nr_communities:
+            extract_statistics.merge_columns("total_connections.txt", [(2 + column, 'total_connections_%d.txt' % (column + 1), None) for column in xrange(nr_communities)])
 
-            extract_statistics.merge_records("bl_stat.txt", 'bl_reuse_%d.txt' % (column + 1), 2 + column)
-            extract_statistics.merge_records("bl_stat.txt", 'bl_skip_%d.txt' % (column + 1), 2 + len(self.communities) + column)
-            extract_statistics.merge_records("bl_stat.txt", 'bl_new_%d.txt' % (column + 1), 2 + len(self.communities) + len(self.communities) + column)
+            bl_columns = []
+            for column in xrange(nr_communities):
+                bl_columns.append((2 + column, 'bl_reuse_%d.txt' % (column + 1), None))
+                bl_columns.append((2 + nr_communities + column, 'bl_skip_%d.txt' % (column + 1), None))
+                bl_columns.append((2 + nr_communities + nr_communities + column, 'bl_new_%d.txt' % (column + 1), None))
+            extract_statistics.merge_columns("bl_stat.txt", bl_columns)
 
 
 class SuccMessages(AbstractHandler):
 
+    keys = ("statistics-successful-messages", "statistics-created-messages")
+    resumable = True
+
     def __init__(self, messages_to_plot):
         AbstractHandler.__init__(self)
 
         self.messages_to_plot = [message for message in messages_to_plot.split(',') if message.strip()]
+        self.dispersy_msg_distribution = {}
 
     def new_file(self, node_nr, filename, outputdir):
-        self.dispersy_msg_distribution = {}
         self.c_received_records = {}
         self.c_created_records = {}
 
-        self.h_received_record = open(os.path.join(outputdir, "received-record.txt"), "w+")
-        print >> self.h_received_record, "# timestamp timeoffset num-records"
-        print >> self.h_received_record, "0 0 0"
+        self.h_received_record = self.open_records(outputdir, "received-record.txt", ["timestamp timeoffset num-records"])
+        self.h_received_record.write(0, 0, 0)
+
+        self.h_created_record = self.open_records(outputdir, "created-record.txt", ["timestamp timeoffset num-records"])
+        self.h_created_record.write(0, 0, 0)
+
+        self.h_total_record = self.open_records(outputdir, "total_record.txt", ["timestamp timeoffset num-records"])
+        self.h_total_record.write(0, 0, 0)
+
+    def resume_file(self, node_nr, filename, outputdir, state):
+        self.c_received_records, self.c_created_records, end_offsets = state
+
+        # drop the records written by end_file, they will be written again once we are done
+        self.h_received_record = self.open_records(outputdir, "received-record.txt", append=True, truncate=end_offsets[0])
+        self.h_created_record = self.open_records(outputdir, "created-record.txt", append=True, truncate=end_offsets[1])
+        self.h_total_record = self.open_records(outputdir, "total_record.txt", append=True, truncate=end_offsets[2])
 
-        self.h_created_record = open(os.path.join(outputdir, "created-record.txt"), "w+")
-        print >> self.h_created_record, "# timestamp timeoffset num-records"
-        print >> self.h_created_record, "0 0 0"
+    def get_file_state(self):
+        return self.c_received_records, self.c_created_records, self.end_offsets
 
-        self.h_total_record = open(os.path.join(outputdir, "total_record.txt"), "w+")
-        print >> self.h_total_record, "# timestamp timeoffset num-records"
-        print >> self.h_total_record, "0 0 0"
+    def get_config(self):
+        return self.messages_to_plot
 
     def end_file(self, node_nr, timestamp, timeoffset):
         c_received_record = sum(self.c_received_records.itervalues())
         c_created_record = sum(self.c_created_records.itervalues())
 
-        print >> self.h_received_record, timestamp, timeoffset, c_received_record
-        print >> self.h_created_record, timestamp, timeoffset, c_created_record
-        print >> self.h_total_record, timestamp, timeoffset, c_received_record + c_created_record
+        self.end_offsets = (self.h_received_record.tell(), self.h_created_record.tell(), self.h_total_record.tell())
+        self.h_received_record.write(timestamp, timeoffset, c_received_record)
+        self.h_created_record.write(timestamp, timeoffset, c_created_record)
+        self.h_total_record.write(timestamp, timeoffset, c_received_record + c_created_record)
 
         self.h_received_record.close()
         self.h_created_record.close()
@@ -456,7 +994,7 @@ class SuccMessages(AbstractHandler):
 
             if writeTotal:
                 c_received_record = sum(self.c_received_records.itervalues())
-                print >> self.h_received_record, timestamp, timeoffset, c_received_record
+                self.h_received_record.write(timestamp, timeoffset, c_received_record)
 
         elif key == "statistics-created-messages":
             for key, value in json.iteritems():
@@ -466,12 +1004,19 @@ class SuccMessages(AbstractHandler):
 
             if writeTotal:
                 c_created_record = sum(self.c_created_records.itervalues())
-                print >> self.h_created_record, timestamp, timeoffset, c_created_record
+                self.h_created_record.write(timestamp, timeoffset, c_created_record)
 
         if writeTotal:
             c_received_record = sum(self.c_received_records.itervalues())
             c_created_record = sum(self.c_created_records.itervalues())
-            print >> self.h_total_record, timestamp, timeoffset, c_received_record + c_created_record
+            self.h_total_record.write(timestamp, timeoffset, c_received_record + c_created_record)
+
+    def get_state(self):
+        return self.dispersy_msg_distribution
+
+    def merge_state(self, state):
+        for key, value in state.iteritems():
+            self.dispersy_msg_distribution[key] = max(value, self.dispersy_msg_distribution.get(key, value))
 
     def all_files_done(self, extract_statistics):
         h_dispersy_msg_distribution = open(os.path.join(extract_statistics.node_directory, "dispersy-msg-distribution.txt"), "w+")
@@ -483,10 +1028,16 @@ class SuccMessages(AbstractHandler):
 
 class StatisticMessages(AbstractHandler):
 
+    keys = ("scenario-statistics",)
+    resumable = True
+
     def new_file(self, node_nr, filename, outputdir):
         self.h_statistics = open(os.path.join(outputdir, "scenario-statistics.txt"), "w+")
         print >> self.h_statistics, "# timestamp timeoffset key value"
 
+    def resume_file(self, node_nr, filename, outputdir, state):
+        self.h_statistics = open(os.path.join(outputdir, "scenario-statistics.txt"), "a")
+
     def end_file(self, node_nr, timestamp, timeoffset):
         self.h_statistics.close()
 
@@ -500,6 +1051,9 @@ class StatisticMessages(AbstractHandler):
 
 class DropMessages(AbstractHandler):
 
+    keys = ("statistics-dropped-messages",)
+    resumable = True
+
     def __init__(self):
         AbstractHandler.__init__(self)
         self.dispersy_dropped_msg_distribution = {}
@@ -511,6 +1065,13 @@ class DropMessages(AbstractHandler):
         for key, value in json.iteritems():
             self.dispersy_dropped_msg_distribution[key] = max((value, node_nr), self.dispersy_dropped_msg_distribution.get(key, (0, node_nr)))
 
+    def get_state(self):
+        return self.dispersy_dropped_msg_distribution
+
+    def merge_state(self, state):
+        for key, value in state.iteritems():
+            self.dispersy_dropped_msg_distribution[key] = max(value, self.dispersy_dropped_msg_distribution.get(key, value))
+
     def all_files_done(self, extract_statistics):
         h_dispersy_dropped_msg_distribution = open(os.path.join(extract_statistics.node_directory, "dispersy-dropped-msg-distribution.txt"), "w+")
 
@@ -522,6 +1083,9 @@ class DropMessages(AbstractHandler):
 
 class BootstrapMessages(AbstractHandler):
 
+    keys = ("statistics-bootstrap-candidates",)
+    resumable = True
+
     def __init__(self):
         AbstractHandler.__init__(self)
         self.dispersy_bootstrap_distribution = defaultdict(dict)
@@ -533,6 +1097,13 @@ class BootstrapMessages(AbstractHandler):
         for key, value in json.iteritems():
             self.dispersy_bootstrap_distribution[key][node_nr] = value
 
+    def get_state(self):
+        return dict(self.dispersy_bootstrap_distribution)
+
+    def merge_state(self, state):
+        for key, nodes in state.iteritems():
+            self.dispersy_bootstrap_distribution[key].update(nodes)
+
     def all_files_done(self, extract_statistics):
         h_dispersy_bootstrap_distribution = open(os.path.join(extract_statistics.node_directory, "dispersy-bootstrap-distribution.txt"), "w+")
         print >> h_dispersy_bootstrap_distribution, "# sock_addr count"
@@ -548,6 +1119,9 @@ class BootstrapMessages(AbstractHandler):
 
 class DebugMessages(AbstractHandler):
 
+    keys = ("scenario-debug",)
+    resumable = True
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
@@ -556,6 +1130,13 @@ class DebugMessages(AbstractHandler):
     def new_file(self, node_nr, filename, outputdir):
         self.outputdir = outputdir
 
+        # write_to_debug appends to the files, remove the ones left by a previous run
+        for filename in glob(os.path.join(outputdir, "scenario-*-debugstatistics.txt")):
+            os.remove(filename)
+
+    def resume_file(self, node_nr, filename, outputdir, state):
+        self.outputdir = outputdir
+
     def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
         return key == "scenario-debug"
 
@@ -577,6 +1158,12 @@ class DebugMessages(AbstractHandler):
         print >> h_debugstatistics, time, timeoffset, value
         h_debugstatistics.close()
 
+    def get_state(self):
+        return self.dispersy_debugstatistics
+
+    def merge_state(self, state):
+        self.dispersy_debugstatistics.update(state)
+
     def all_files_done(self, extract_statistics):
         for debug_stat in self.dispersy_debugstatistics:
             extract_statistics.merge_records("scenario-%s-debugstatistics.txt" % debug_stat, "scenario-%s-debugstatistics.txt" % debug_stat, 2)
@@ -591,12 +1178,44 @@ def get_parser(argv):
     e.add_handler(DebugMessages())
     return e
 
+def get_option_parser():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] <node-directory> <messagestoplot>")
+    parser.add_option("-j", "--jobs",
+                      metavar='N',
+                      default=1,
+                      type=int,
+                      help="Parse the statistics files using N processes (default: 1)"
+                      )
+    parser.add_option("-i", "--incremental",
+                      action="store_true",
+                      default=False,
+                      help="Only parse what changed in the statistics files since the last incremental run"
+                      )
+    parser.add_option("-p", "--partial",
+                      action="store_true",
+                      default=False,
+                      help="Only do the per peer parsing of the peer directories in node-directory (on the node that ran them), the results are merged when parsing the whole experiment"
+                      )
+    parser.add_option("-f", "--format",
+                      metavar='FORMAT',
+                      default='text',
+                      choices=RECORD_FORMATS,
+                      help="Format of the generated record files, text or binary (default: text)"
+                      )
+    return parser
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print "Usage: %s <node-directory> <messagestoplot>" % (sys.argv[0])
+    parser = get_option_parser()
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_usage()
         print >> sys.stderr, sys.argv
 
         sys.exit(1)
 
-    e = get_parser(sys.argv)
-    e.parse()
+    e = get_parser([sys.argv[0]] + args)
+    e.record_format = options.format
+    e.incremental = options.incremental
+    e.partial = options.partial
+    e.parse(options.jobs)
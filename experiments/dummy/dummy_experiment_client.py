@@ -55,7 +55,7 @@ class DummyExperimentClient(ExperimentClient):
 
 def main():
     factory = ExperimentClientFactory({"random_key": "random value"}, DummyExperimentClient)
-    reactor.connectTCP(environ['HEAD_NODE'], int(environ['SYNC_PORT']), factory)
+    reactor.connectTCP(environ.get('SYNC_HOST', environ['HEAD_NODE']), int(environ['SYNC_PORT']), factory)
 
     reactor.exitCode = 0
     reactor.run()
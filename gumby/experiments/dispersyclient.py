@@ -43,6 +43,7 @@ import json
 from time import time
 
 from gumby.sync import ExperimentClient, ExperimentClientFactory
+from gumby.stats import StatisticsClientFactory, compact_statistics
 from gumby.scenario import ScenarioRunner
 from gumby.log import PythonLoggingObserver, setupLogging
 
@@ -61,6 +62,10 @@ def call_on_dispersy_thread(func):
 
 class DispersyExperimentScriptClient(ExperimentClient):
     scenario_file = None
+    # We don't use the vars of the other peers, only our ID
+    subscribed_peers = ''
+    # For the barrier scenario action
+    persistent = True
 
     def __init__(self, vars):
         ExperimentClient.__init__(self, vars)
@@ -73,12 +78,14 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.community_args = []
         self.community_kwargs = {}
         self._stats_file = None
+        self._live_stats = None
 
     def startExperiment(self):
         msg("Starting dummy scenario experiment")
         scenario_file_path = path.join(environ['EXPERIMENT_DIR'], self.scenario_file)
 
-        self.scenario_runner = ScenarioRunner(scenario_file_path, int(self.my_id))
+        # The clock offset estimated by the sync server makes the @ times of all the peers match
+        self.scenario_runner = ScenarioRunner(scenario_file_path, int(self.my_id), self.experiment_start)
         # TODO(emilon): Auto-register this stuff
         self.scenario_runner.register(self.echo)
         self.scenario_runner.register(self.online)
@@ -93,6 +100,7 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.scenario_runner.register(self.set_master_member)
         self.scenario_runner.register(self.reset_dispersy_statistics, 'reset_dispersy_statistics')
         self.scenario_runner.register(self.annotate, 'annotate')
+        self.scenario_runner.register(self.barrier, 'barrier')
 
         # TODO(emilon): Move this to the right place
         # TODO(emilon): Do we want to have the .dbs in the output dirs or should they be dumped to /tmp?
@@ -101,6 +109,10 @@ class DispersyExperimentScriptClient(ExperimentClient):
         chdir(my_dir)
         self._stats_file = open("statistics.log", 'w')
 
+        if environ.get('LIVE_STATISTICS_PORT'):
+            self._live_stats = StatisticsClientFactory(self.my_id)
+            reactor.connectTCP(environ['HEAD_NODE'], int(environ['LIVE_STATISTICS_PORT']), self._live_stats)
+
         # TODO(emilon): Fix me or kill me
         try:
             symlink(path.join(environ['PROJECT_DIR'], 'tribler', 'bootstraptribler.txt'), 'bootstraptribler.txt')
@@ -198,6 +210,8 @@ class DispersyExperimentScriptClient(ExperimentClient):
                 reactor.callLater(1, self.stop, retry - 1)
         else:
                 msg("Dispersy exit status was:", self._dispersy_exit_status)
+                if self._live_stats:
+                    self._live_stats.close()
                 reactor.callLater(0, reactor.stop)
 
     def set_master_member(self, pub_key):
@@ -257,8 +271,14 @@ class DispersyExperimentScriptClient(ExperimentClient):
                         changed_values[key] = value
 
             if changed_values:
-                self._stats_file.write('%f %s %s %s\n' % (time(), self.my_id, name, json.dumps(changed_values)))
+                timestamp = time()
+                self._stats_file.write('%f %s %s %s\n' % (timestamp, self.my_id, name, json.dumps(changed_values)))
                 self._stats_file.flush()
+
+                if self._live_stats and name == "statistics":
+                    live_values = compact_statistics(changed_values)
+                    if live_values:
+                        reactor.callFromThread(self._live_stats.pushStatistics, timestamp, live_values)
                 return new_values
             return prev_dict
 
@@ -331,7 +351,7 @@ class DispersyExperimentScriptClient(ExperimentClient):
 def main(client_class):
     setupLogging()
     factory = ExperimentClientFactory({}, client_class)
-    reactor.connectTCP(environ['HEAD_NODE'], int(environ['SYNC_PORT']), factory)
+    reactor.connectTCP(environ.get('SYNC_HOST', environ['HEAD_NODE']), int(environ['SYNC_PORT']), factory)
 
     reactor.exitCode = 0
     reactor.run()
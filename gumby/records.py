@@ -0,0 +1,370 @@
+# records.py ---
+#
+# Filename: records.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 11:02:37 2026 (+0200)
+
+# Commentary:
+#
+# Readers and writers for the numeric record files generated while post processing an
+# experiment (stat.txt, drop.txt, send.txt, etc.).
+#
+# Two formats are supported:
+# * text   -> One space separated record per line. Lines starting with # are comments, record
+#             files with named columns have a header line with the names (IE: "time 1 2 3").
+# * binary -> A small header followed by fixed-width little-endian float64 records, so the
+#             data can be memory mapped using numpy. The header is:
+#                 "GUMBYREC" + uint32 length + JSON {"columns", "names", "comments"}
+#             padded with spaces so the records start at a 16 byte boundary.
+#
+# Binary record files use the .rec extension instead of .txt, open_record_reader() will pick
+# the binary version of a file if it exists and fall back to the text one otherwise.
+# export_to_text() converts a binary file back to text so it can be read by the R scripts.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from array import array
+from os import path
+from struct import pack, unpack
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RECORD_FORMATS = ('text', 'binary')
+BINARY_EXTENSION = '.rec'
+MAGIC = 'GUMBYREC'
+
+
+def record_filename(filename, record_format):
+    """
+    Returns the name of the file holding filename's records in the specified format.
+    """
+    if record_format == 'binary':
+        return path.splitext(filename)[0] + BINARY_EXTENSION
+    return filename
+
+
+def open_record_writer(filename, record_format='text', names=None, comments=(), append=False, truncate=None,
+                       trailing_space=False):
+    """
+    Opens a record writer for filename in the specified format. If append is set and the file exists,
+    new records are added to it and names and comments are ignored. truncate can be set to a position
+    previously returned by the writer's tell() to drop the records written after it before appending.
+    trailing_space ends the rows of text files with a space, like the ones written by print >> fp, x,
+    """
+    if record_format not in RECORD_FORMATS:
+        raise ValueError("Unknown record format: %s" % record_format)
+
+    filename = record_filename(filename, record_format)
+    if append and truncate is not None and path.exists(filename):
+        fp = open(filename, 'r+b')
+        fp.truncate(truncate)
+        fp.close()
+
+    if record_format == 'binary':
+        return BinaryRecordWriter(filename, names, comments, append)
+    return TextRecordWriter(filename, names, comments, append, trailing_space)
+
+
+def open_record_reader(filename, has_names=False):
+    """
+    Opens the binary version of filename if it exists, the text version otherwise.
+
+    has_names is only used for text files, as binary ones store it in their header.
+    """
+    binary_filename = record_filename(filename, 'binary')
+    if path.exists(binary_filename):
+        return BinaryRecordReader(binary_filename)
+    return TextRecordReader(filename, has_names)
+
+
+def record_file_exists(filename):
+    return path.exists(filename) or path.exists(record_filename(filename, 'binary'))
+
+
+def export_to_text(filename, text_filename=None):
+    """
+    Writes the records of the binary file filename as text, by default next to it with a .txt extension.
+    """
+    if not text_filename:
+        text_filename = path.splitext(filename)[0] + '.txt'
+
+    reader = BinaryRecordReader(filename)
+    writer = TextRecordWriter(text_filename, reader.names, reader.comments)
+    for row in reader.iter_rows():
+        writer.write(*row)
+    writer.close()
+    return text_filename
+
+#
+# Writers
+#
+
+
+class TextRecordWriter(object):
+
+    def __init__(self, filename, names=None, comments=(), append=False, trailing_space=False):
+        self.filename = filename
+        self._row_end = ' ' if trailing_space else ''
+        if append and path.exists(filename):
+            self._fp = open(filename, 'a')
+            return
+
+        self._fp = open(filename, 'w')
+        for comment in comments:
+            print >> self._fp, '#', comment
+        if names:
+            print >> self._fp, ' '.join(names)
+
+    def write(self, *values):
+        print >> self._fp, ' '.join(map(str, values)) + self._row_end
+
+    def tell(self):
+        return self._fp.tell()
+
+    def close(self):
+        self._fp.close()
+
+
+class BinaryRecordWriter(object):
+
+    def __init__(self, filename, names=None, comments=(), append=False):
+        self.filename = filename
+        self._names = list(names) if names else None
+        self._comments = list(comments)
+        self._columns = None
+        self._row_format = None
+
+        if append and path.exists(filename) and path.getsize(filename):
+            columns = BinaryRecordReader(filename).columns
+            if columns:
+                self._fp = open(filename, 'ab')
+                self._columns = columns
+                self._row_format = '<%dd' % columns
+                return
+
+        self._fp = open(filename, 'wb')
+        if self._names:
+            self._write_header(len(self._names))
+
+    def _write_header(self, columns):
+        self._columns = columns
+        self._row_format = '<%dd' % columns
+
+        header = json.dumps({'columns': columns, 'names': self._names, 'comments': self._comments})
+        header += ' ' * (-(len(MAGIC) + 4 + len(header)) % 16)
+        self._fp.write(MAGIC + pack('<I', len(header)) + header)
+
+    def write(self, *values):
+        # The amount of columns is fixed by the names or the first record written.
+        if self._columns is None:
+            self._write_header(len(values))
+        elif len(values) != self._columns:
+            raise ValueError("%s has %d columns, got a record with %d values" % (self.filename, self._columns, len(values)))
+        self._fp.write(pack(self._row_format, *values))
+
+    def tell(self):
+        return self._fp.tell()
+
+    def close(self):
+        if self._columns is None:
+            self._write_header(0)
+        self._fp.close()
+
+#
+# Readers
+#
+
+
+class TextRecordReader(object):
+
+    def __init__(self, filename, has_names=False):
+        self.filename = filename
+        self.comments = []
+        self.names = None
+
+        fp = open(filename, 'r')
+        line = fp.readline()
+        while line.startswith('#'):
+            self.comments.append(line[1:].strip())
+            line = fp.readline()
+        if has_names and line:
+            self.names = line.split()
+            line = fp.readline()
+        self._offset = fp.tell() - len(line)
+        fp.close()
+
+    def _iter_parts(self):
+        fp = open(self.filename, 'r')
+        fp.seek(self._offset)
+        for line in fp:
+            if line[0] == '#':
+                continue
+
+            parts = line.split()
+            if parts:
+                yield parts
+        fp.close()
+
+    def count_rows(self):
+        # Same as counting _iter_parts() without splitting the lines
+        fp = open(self.filename, 'r')
+        fp.seek(self._offset)
+        rows = sum(1 for line in fp if line[0] != '#' and not line.isspace())
+        fp.close()
+        return rows
+
+    def iter_rows(self):
+        for parts in self._iter_parts():
+            yield map(float, parts)
+
+    def iter_lines(self):
+        """
+        Yields the lines of the records as they are in the file.
+        """
+        fp = open(self.filename, 'r')
+        fp.seek(self._offset)
+        for line in fp:
+            if line[0] != '#' and not line.isspace():
+                yield line
+        fp.close()
+
+    def iter_blocks(self, block_size=4096):
+        """
+        Yields the records as (rows, columns) numpy arrays of up to block_size rows, all the records
+        need to have the same amount of values.
+        """
+        if numpy is None:
+            raise ImportError("numpy is needed to read record files in blocks")
+
+        lines = []
+        for line in self.iter_lines():
+            lines.append(line)
+            if len(lines) == block_size:
+                yield self._parse_block(lines)
+                lines = []
+
+        if lines:
+            yield self._parse_block(lines)
+
+    def _parse_block(self, lines):
+        columns = len(lines[0].split())
+        values = numpy.fromstring(' '.join(lines), sep=' ')
+        if len(values) != len(lines) * columns:
+            raise ValueError("%s has records with a different amount of values" % self.filename)
+        return values.reshape(len(lines), columns)
+
+    def get_columns(self, timeindex, columnindexes, skip_zero=False):
+        """
+        Returns a (times, values) pair of arrays for each of the requested columns, rows not having a
+        column are skipped for it.
+        """
+        columns = [(array('d'), array('d')) for _ in columnindexes]
+        min_parts = max(timeindex, min(columnindexes)) + 1
+
+        for parts in self._iter_parts():
+            if len(parts) < min_parts:
+                continue
+
+            time = float(parts[timeindex])
+            for columnindex, (times, values) in zip(columnindexes, columns):
+                if len(parts) > columnindex:
+                    record = float(parts[columnindex])
+                    if skip_zero and record == 0:
+                        continue
+
+                    times.append(time)
+                    values.append(record)
+        return columns
+
+
+class BinaryRecordReader(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        fp = open(filename, 'rb')
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a binary record file" % filename)
+        header_length, = unpack('<I', fp.read(4))
+        header = json.loads(fp.read(header_length))
+        self._offset = fp.tell()
+        fp.close()
+
+        self.columns = header['columns']
+        self.names = header['names']
+        self.comments = header['comments']
+        self.rows = (path.getsize(filename) - self._offset) // (8 * self.columns) if self.columns else 0
+
+    def get_data(self):
+        """
+        Returns a read only (rows, columns) numpy array memory mapping the records.
+        """
+        if numpy is None:
+            raise ImportError("numpy is needed to read binary record files")
+
+        if not self.rows:
+            return numpy.zeros((0, self.columns))
+        return numpy.memmap(self.filename, dtype='<f8', mode='r', offset=self._offset, shape=(self.rows, self.columns))
+
+    def count_rows(self):
+        return self.rows
+
+    def iter_rows(self, block_size=65536):
+        data = self.get_data()
+        for start in xrange(0, self.rows, block_size):
+            for row in data[start:start + block_size].tolist():
+                yield row
+
+    def iter_blocks(self, block_size=4096):
+        data = self.get_data()
+        for start in xrange(0, self.rows, block_size):
+            yield numpy.array(data[start:start + block_size])
+
+    def get_columns(self, timeindex, columnindexes, skip_zero=False):
+        data = self.get_data()
+
+        columns = []
+        for columnindex in columnindexes:
+            if columnindex < self.columns:
+                times = data[:, timeindex]
+                values = data[:, columnindex]
+                if skip_zero:
+                    mask = values != 0
+                    times = times[mask]
+                    values = values[mask]
+                columns.append((times.tolist(), values.tolist()))
+            else:
+                columns.append(([], []))
+        return columns
+
+#
+# records.py ends here
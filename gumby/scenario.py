@@ -18,6 +18,14 @@
 #     s = ScenarioRunner("./scenario", int(t.peerid))
 #     s.register(t.test_method)
 #     s.run()
+#
+# Events can also come from generators, which are only advanced as the experiment goes:
+#     s.add_source((60.0 + i, "test_method", (str(i),)) for i in xrange(3600))
+#
+# With a lot of peers, compile_scenario() (see scripts/compile_scenario.py) can parse the scenario
+# once for all of them and write an index next to it with the events of every peer. ScenarioRunner
+# then only reads its own events from it instead of parsing the whole scenario, as long as the
+# index is up to date (the scenario file is the source of truth).
 
 # Change Log:
 #
@@ -45,16 +53,22 @@
 
 """Parses and runs scenarios."""
 
+from bisect import bisect_right
+from heapq import merge
 from itertools import ifilter
-from os import environ
+from mmap import mmap, ACCESS_READ
+from os import environ, path, rename, stat
 from random import random
 from re import compile as re_compile
 from time import time
+import json
 import shlex
+import struct
 import sys
 
 from twisted.internet import reactor
-from twisted.python.log import msg
+from twisted.internet.defer import maybeDeferred
+from twisted.python.log import err, msg
 
 class ScenarioRunner():
 
@@ -93,10 +107,18 @@ class ScenarioRunner():
 
             Examples: "{1,2}" - apply event only for peer 1 and 2, "{3-6}" - apply
             event for peers 3 to 6 (including 3 and 6).
+            "{!3}" - apply event for all the peers but 3. Ranges are cheap, no matter
+            how many peers they cover.
 
         Notes:
              - Have in mind that in case of having several lines with the same
                time stamp, they will be executed in order.
+             - "barrier NAME" is special: if a callable was registered as
+               "barrier", it's called with NAME and the scenario is paused until
+               the Deferred it returns fires. The following events are delayed by
+               the time spent waiting, so they keep their relative timing. Every
+               peer in the experiment has to reach the barrier, so don't give it
+               a PEERSPEC.
     """
     _re_line = re_compile(
         r"^"
@@ -124,6 +146,12 @@ class ScenarioRunner():
         self._expstartstamp = expstartstamp
         self._peernumber = peernumber
         self._origin = None  # will be set just before run()-ing
+        self._sources = []
+        # The merged events of all the sources and the next one
+        self._events = None
+        self._next_event = None
+        # Time lost waiting at barriers
+        self._shift = 0.0
 
     def register(self, clb, name=None):
         """
@@ -134,6 +162,16 @@ class ScenarioRunner():
             name = clb.__name__
         self._callables[name] = clb
 
+    def add_source(self, events):
+        """
+        Adds events besides the ones of the scenario file. events is an iterable
+        (IE: a generator) of (SECONDS, CALLABLE, ARGS) tuples, SECONDS being the
+        time since the experiment start (like @ in the scenario), which must
+        come in chronological order. They are only taken from it when the
+        previous ones are due, so it can be endless.
+        """
+        self._sources.append(events)
+
     def _init_origin_time(self):
         # initialize origin start times
         # _parse_scenario_line() will choose one of them for each lines
@@ -145,23 +183,60 @@ class ScenarioRunner():
 
     def run(self):
         """
-        Schedules calls for each scenario line.
+        Runs the events of the scenario and the added sources.
+
+        Only the next event is scheduled in the reactor, with a single timer
+        that runs all the events that are due and then waits for the next one.
         """
         self._init_origin_time()
 
         print "Running scenario from file:", self.filename
 
-        for (tstmp, lineno, clb, args) in self._parse_scenario(self.filename):
+        # The lines of the scenario don't need to be in chronological order
+        sources = [[(tstmp, 0, lineno, clb, args) for tstmp, lineno, clb, args in sorted(self._parse_scenario(self.filename))]]
+        for source_number, source in enumerate(self._sources, 1):
+            sources.append(self._get_source_events(source_number, source))
+        # Events at the same time run in the order of their sources, and within them in their order
+        self._events = merge(*sources)
+        self._next_event = next(self._events, None)
+        self._schedule_next_event()
+
+    def _get_source_events(self, source_number, source):
+        origin = self._origin["@"]
+        for sequence, (seconds, clb, args) in enumerate(source):
+            yield (origin + seconds, source_number, sequence, clb, tuple(args))
+
+    def _schedule_next_event(self):
+        if self._next_event is not None:
+            delay = self._next_event[0] + self._shift - time()
+            reactor.callLater(delay if delay > 0.0 else 0, self._run_due_events)
+
+    def _run_due_events(self):
+        while self._next_event is not None and self._next_event[0] + self._shift <= time():
+            tstmp, _, _, clb, args = self._next_event
+            self._next_event = next(self._events, None)
             if clb not in self._callables:
                 msg(clb, "is not registered as an action!")
                 continue
-            # TODO(vladum): Handle errors while calling.
-            delay = tstmp - time()
-            reactor.callLater(
-                delay if delay > 0.0 else 0,
-                self._callables[clb],
-                *args
-            )
+            if clb == "barrier":
+                self._wait_at_barrier(tstmp, args)
+                return
+            try:
+                self._callables[clb](*args)
+            except Exception:
+                err(None, "Scenario action %s failed" % clb)
+        self._schedule_next_event()
+
+    def _wait_at_barrier(self, tstmp, args):
+        msg("Waiting at barrier", *args)
+        d = maybeDeferred(self._callables["barrier"], *args)
+        d.addErrback(err, "Barrier %s failed, going on with the scenario" % " ".join(args))
+        d.addCallback(self._barrier_passed, tstmp)
+
+    def _barrier_passed(self, _, tstmp):
+        # The events after the barrier keep their distance to it
+        self._shift = max(self._shift, time() - tstmp)
+        self._schedule_next_event()
 
     # TODO(vladum): Move _parse_*() stuff to separate class.
 
@@ -173,6 +248,13 @@ class ScenarioRunner():
         the name of a function, method, etc. registered with this scenario using
         the register() method.
         """
+        index = ScenarioIndex.open_for(filename)
+        if index is not None:
+            for event in index.get_events(self._peernumber):
+                yield self._get_command(*event)
+            index.close()
+            return
+
         try:
             for lineno, line in enumerate(open(filename, "r")):
                 cmd = self._parse_scenario_line(lineno, line)
@@ -189,12 +271,28 @@ class ScenarioRunner():
 
         The command tuple is described in _parse_scenario().
         """
+        event = self._parse_line(lineno, line)
+
+        # only return lines that belong to this peer
+        if event is not None and self._parse_for_this_peer(event[-1]):
+            return self._get_command(*event[:-1])
+
+        # line not for this peer or a parse error occurred
+        return None
+
+    @classmethod
+    def _parse_line(cls, lineno, line):
+        """
+        Parses one scenario line into a (LINENO, ORIGIN, BEGIN, END, CALLABLE,
+        ARGS, PEERSPEC) tuple, the same for all the peers. Returns None if the
+        line is invalid.
+        """
         # Look for $VARIABLES to replace with config options from the env.
-        for substitution in self._re_substitution.findall(line):
+        for substitution in cls._re_substitution.findall(line):
             if substitution[1:] in environ:
                 line = line.replace(substitution, environ[substitution[1:]])
 
-        match = self._re_line.match(line)
+        match = cls._re_line.match(line)
         if match:
             # remove all entries that are None (to get default per key)
             dic = dict(ifilter(
@@ -202,30 +300,33 @@ class ScenarioRunner():
                 match.groupdict().iteritems()
             ))
 
-            # only return lines that belong to this peer
-            if self._parse_for_this_peer(dic.get("peers", "")):
-                begin = int(dic.get("beginH", 0)) * 3600.0 + \
-                    int(dic.get("beginM", 0)) * 60.0 + \
-                    int(dic.get("beginS", 0))
-                end = int(dic.get("endH", 0)) * 3600.0 + \
-                    int(dic.get("endM", 0)) * 60.0 + \
-                    int(dic.get("endS", 0))
-                assert end == 0.0 or begin <= end, \
-                    "if given, end time must be at or after the start time"
-                timestamp = self._origin[dic.get("origin", "@")] + \
-                    begin + \
-                    (random() * (end - begin) if end else 0.0)
-                return (
-                    timestamp,
-                    lineno,
-                    dic.get("callable", ""),
-                    tuple(shlex.split(dic.get("args", "")))
-                )
+            begin = int(dic.get("beginH", 0)) * 3600.0 + \
+                int(dic.get("beginM", 0)) * 60.0 + \
+                int(dic.get("beginS", 0))
+            end = int(dic.get("endH", 0)) * 3600.0 + \
+                int(dic.get("endM", 0)) * 60.0 + \
+                int(dic.get("endS", 0))
+            assert end == 0.0 or begin <= end, \
+                "if given, end time must be at or after the start time"
+            return (
+                lineno,
+                dic.get("origin", "@"),
+                begin,
+                end,
+                dic.get("callable", ""),
+                tuple(shlex.split(dic.get("args", ""))),
+                dic.get("peers", "")
+            )
         else:
             print >> sys.stderr, "Ignoring invalid scenario line", lineno
+            return None
 
-        # line not for this peer or a parse error occurred
-        return None
+    def _get_command(self, lineno, origin, begin, end, clb, args):
+        # Every peer picks its own time in the interval
+        timestamp = self._origin[origin] + \
+            begin + \
+            (random() * (end - begin) if end else 0.0)
+        return (timestamp, lineno, clb, tuple(args))
 
     def _parse_for_this_peer(self, peerspec):
         """
@@ -236,9 +337,49 @@ class ScenarioRunner():
 
         Note: An empty peer specification matches everything.
         """
-        # get individual peers, if any, for a peer spec
-        yes_peers = set()
-        no_peers = set()
+        return get_peerspec(peerspec).matches(self._peernumber)
+
+
+def merge_intervals(intervals):
+    """
+    Sorts inclusive (LOW, HIGH) intervals, merging the ones that overlap or
+    touch.
+    """
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            if high > merged[-1][1]:
+                merged[-1] = (merged[-1][0], high)
+        else:
+            merged.append((low, high))
+    return merged
+
+
+class PeerSpec(object):
+
+    """
+    A parsed peer specification. The peers it lists and the ones it lists with
+    a '!' are kept as sorted lists of inclusive (LOW, HIGH) intervals, which
+    peer numbers are looked up in by bisection, so big ranges cost as much as
+    small ones.
+
+    A peer matches if the specification is empty, if it's listed, or if there
+    are negated peers and it isn't one of them.
+    """
+
+    def __init__(self, yes_peers=(), no_peers=()):
+        self.yes_peers = merge_intervals(yes_peers)
+        self.no_peers = merge_intervals(no_peers)
+        self._yes_lows = [low for low, _ in self.yes_peers]
+        self._no_lows = [low for low, _ in self.no_peers]
+
+    @classmethod
+    def parse(cls, peerspec):
+        """
+        Parses a "PEERNR1, PEERNR3-PEERNR6, !PEERNR7" like peer specification.
+        """
+        yes_peers = []
+        no_peers = []
         for peer in peerspec.split(","):
             peer = peer.strip()
             if peer:
@@ -252,14 +393,196 @@ class ScenarioRunner():
                 # parse the peer number (or peer number pair)
                 if "-" in peer:
                     low, high = peer.split("-")
-                    peers.update(xrange(int(low), int(high) + 1))
+                    low, high = int(low), int(high)
                 else:
-                    peers.add(int(peer))
+                    low = high = int(peer)
+                if low <= high:
+                    peers.append((low, high))
+        return cls(yes_peers, no_peers)
+
+    def __nonzero__(self):
+        return bool(self.yes_peers or self.no_peers)
+
+    @staticmethod
+    def _contains(intervals, lows, peernumber):
+        index = bisect_right(lows, peernumber) - 1
+        return index >= 0 and peernumber <= intervals[index][1]
+
+    def matches(self, peernumber):
         return (
-            not (yes_peers or no_peers) or
-            (yes_peers and self._peernumber in yes_peers) or
-            (no_peers and not self._peernumber in no_peers)
+            not self or
+            self._contains(self.yes_peers, self._yes_lows, peernumber) or
+            (self.no_peers and not self._contains(self.no_peers, self._no_lows, peernumber))
         )
 
+
+# The scenario lines of a peer often repeat the same peer specifications
+_peerspecs = {}
+
+
+def get_peerspec(peerspec):
+    """
+    Returns the parsed PeerSpec of a peer specification, parsing each one once.
+    """
+    if peerspec not in _peerspecs:
+        _peerspecs[peerspec] = PeerSpec.parse(peerspec)
+    return _peerspecs[peerspec]
+
+
+def get_scenario_index_path(scenario_file_path):
+    return scenario_file_path + ".idx"
+
+
+def compile_scenario(scenario_file_path, index_file_path=None):
+    """
+    Parses the scenario once for all the peers and writes its events, grouped
+    by peer specification, to an index (next to the scenario by default), see
+    ScenarioIndex. Returns the (amount of events, amount of distinct peer
+    specifications) of it.
+    """
+    if index_file_path is None:
+        index_file_path = get_scenario_index_path(scenario_file_path)
+
+    # The values of the $VARIABLES are fixed now, the index is only valid with the same ones
+    substitutions = {}
+    events = []
+    for lineno, line in enumerate(open(scenario_file_path, "r")):
+        for substitution in ScenarioRunner._re_substitution.findall(line):
+            substitutions[substitution[1:]] = environ.get(substitution[1:])
+        event = ScenarioRunner._parse_line(lineno, line)
+        if event is not None:
+            events.append(event)
+
+    # The ids of the events of every distinct peer spec, in the order they first appear
+    peerspecs = []
+    peerspec_events = {}
+    for event_id, event in enumerate(events):
+        peerspec = get_peerspec(event[-1])
+        key = (tuple(peerspec.yes_peers), tuple(peerspec.no_peers))
+        if key not in peerspec_events:
+            peerspecs.append(key)
+            peerspec_events[key] = []
+        peerspec_events[key].append(event_id)
+
+    peerspec_table = []
+    intervals = []
+    event_ids = []
+    for key in peerspecs:
+        yes_peers, no_peers = key
+        peerspec_table.extend((len(intervals) / 2, len(yes_peers), len(no_peers), len(event_ids), len(peerspec_events[key])))
+        for low, high in yes_peers + no_peers:
+            intervals.extend((low, high))
+        event_ids.extend(peerspec_events[key])
+
+    event_data = [json.dumps(event[:-1]) + "\n" for event in events]
+    event_offsets = [0]
+    for data in event_data:
+        event_offsets.append(event_offsets[-1] + len(data))
+
+    stat_result = stat(scenario_file_path)
+    header = {
+        "size": stat_result.st_size,
+        "mtime": stat_result.st_mtime,
+        "substitutions": substitutions,
+        "events": len(events),
+        "peerspecs": len(peerspecs),
+        "intervals": len(intervals) / 2,
+    }
+    tmp_file_path = index_file_path + ".tmp"
+    with open(tmp_file_path, "wb") as index_file:
+        index_file.write(ScenarioIndex.MAGIC)
+        index_file.write(json.dumps(header) + "\n")
+        # Sections: peer spec table, intervals, event ids, event offsets and events
+        for table in (peerspec_table, intervals, event_ids, event_offsets):
+            index_file.write(struct.pack("<%dI" % len(table), *table))
+        index_file.write("".join(event_data))
+    # Don't let peers reading the index see it half written
+    rename(tmp_file_path, index_file_path)
+    return len(events), len(peerspecs)
+
+
+class ScenarioIndex(object):
+
+    """
+    Index of a scenario written by compile_scenario(). It's memory mapped and
+    its size doesn't depend on the amount of peers: a peer matches its number
+    against the intervals of every distinct peer specification, like PeerSpec
+    does, and only reads the events of the ones it matches.
+
+    It starts with MAGIC and a JSON header line, followed by these sections:
+      - peer spec table: (first interval, listed intervals, negated intervals,
+        first event id, event ids) uint32s per peer specification.
+      - intervals: (LOW, HIGH) uint32 pairs, the listed peers of a peer spec
+        followed by its negated ones.
+      - event ids: the ids of the events of every peer spec, in scenario order.
+      - event offsets: events + 1 uint32 offsets into the events section.
+      - events: a JSON line with a (LINENO, ORIGIN, BEGIN, END, CALLABLE,
+        ARGS) list per event, see ScenarioRunner._parse_line().
+    """
+    MAGIC = "gumby-scenario-index 2\n"
+
+    def __init__(self, index_file_path):
+        self._file = open(index_file_path, "rb")
+        self._map = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        if self._map.readline() != self.MAGIC:
+            raise ValueError("%s is not a scenario index" % index_file_path)
+        self.header = json.loads(self._map.readline())
+        self._peerspec_table_offset = self._map.tell()
+        self._intervals_offset = self._peerspec_table_offset + self.header["peerspecs"] * 20
+        self._event_ids_offset = self._intervals_offset + self.header["intervals"] * 8
+        self._event_offsets_offset = self._event_ids_offset + self.header["events"] * 4
+        self._events_offset = self._event_offsets_offset + (self.header["events"] + 1) * 4
+
+    @classmethod
+    def open_for(cls, scenario_file_path):
+        """
+        Returns the index of the scenario if there is one and it's up to date,
+        None otherwise.
+        """
+        index_file_path = get_scenario_index_path(scenario_file_path)
+        if not path.exists(index_file_path):
+            return None
+        try:
+            index = cls(index_file_path)
+        except (EnvironmentError, ValueError):
+            print >> sys.stderr, "Ignoring unreadable scenario index", index_file_path
+            return None
+
+        stat_result = stat(scenario_file_path)
+        if (index.header["size"], index.header["mtime"]) != (stat_result.st_size, stat_result.st_mtime) or \
+                any(environ.get(name) != value for name, value in index.header["substitutions"].iteritems()):
+            print >> sys.stderr, "Ignoring outdated scenario index", index_file_path
+            index.close()
+            return None
+        return index
+
+    def _get_peerspec(self, number):
+        first_interval, yes_count, no_count, first_event, event_count = \
+            struct.unpack_from("<5I", self._map, self._peerspec_table_offset + number * 20)
+        bounds = struct.unpack_from("<%dI" % ((yes_count + no_count) * 2), self._map, self._intervals_offset + first_interval * 8)
+        intervals = zip(bounds[::2], bounds[1::2])
+        return PeerSpec(intervals[:yes_count], intervals[yes_count:]), first_event, event_count
+
+    def get_events(self, peernumber):
+        """
+        Yields the (LINENO, ORIGIN, BEGIN, END, CALLABLE, ARGS) events of the
+        peer in scenario order.
+        """
+        event_ids = []
+        for number in xrange(self.header["peerspecs"]):
+            peerspec, first_event, event_count = self._get_peerspec(number)
+            if peerspec.matches(peernumber):
+                event_ids.extend(struct.unpack_from("<%dI" % event_count, self._map, self._event_ids_offset + first_event * 4))
+
+        for event_id in sorted(event_ids):
+            start, end = struct.unpack_from("<II", self._map, self._event_offsets_offset + event_id * 4)
+            lineno, origin, begin, end, clb, args = json.loads(self._map[self._events_offset + start:self._events_offset + end])
+            # As if parsed from the scenario
+            yield lineno, str(origin), begin, end, clb.encode("utf-8"), tuple(arg.encode("utf-8") for arg in args)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
 #
 # scenario.py ends here
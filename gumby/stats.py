@@ -0,0 +1,329 @@
+# stats.py ---
+#
+# Filename: stats.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 16:12:09 2026 (+0200)
+
+# Commentary:
+#
+# Live statistics aggregation service.
+#
+# While the experiment is running the instances push a compact version of the statistics they
+# write to their statistics.log to this service, which keeps rolling per second aggregates of
+# the headline values (bytes sent and received, dropped messages and connections) of all of
+# them in memory. The aggregates are periodically written to a record file (live_statistics.txt
+# by default) so they can be watched while the experiment runs, and are complete as soon as it
+# ends without having to wait for the statistics.log files to be collected and parsed.
+#
+# It receives 2 types of commands:
+# * id:<peer id>                -> Has to be the first line, identifies the instance.
+# * <timestamp> <json document> -> The values that changed since the last update of this
+#                                  instance (IE: {"total_send": 1024, "connections": 3}).
+#
+# Example of an expected exchange:
+# [connection is opened by the client]
+# -> id:3
+# -> 1378479678.110000 {"total_send": 0, "total_down": 0, "drop_count": 0, "connections": 0}
+# -> 1378479679.120000 {"total_send": 5120, "connections": 2}
+# [connection is closed by the client]
+#
+# The service stops the reactor when all of the expected subscribers (distinct peer ids) have
+# connected and closed their connection again, or when stopWaiting() is called (experiment_server.py
+# does it when the sync server is done) and the ones that connected are gone.
+# run_live_statistics_locally.py runs it with a bunch of fake peers.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from collections import deque
+from time import time
+import json
+import logging
+
+from gumby.records import open_record_writer
+from gumby.sync import stopReactor
+
+from twisted.internet import reactor
+from twisted.internet.error import ConnectionDone
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python.log import msg, err
+
+# The values of the "statistics" entries in statistics.log which are aggregated, connections
+# is the sum of the nr_candidates of all the communities.
+AGGREGATED_FIELDS = ('total_send', 'total_down', 'drop_count', 'connections')
+AGGREGATED_NAMES = ('time', 'send', 'received', 'dropped', 'connections', 'peers')
+
+STATISTICS_FLUSH_INTERVAL = 5
+
+
+def compact_statistics(statistics):
+    """
+    Returns the aggregated fields present in a statistics dict as written to statistics.log.
+    """
+    compact = dict((field, statistics[field]) for field in AGGREGATED_FIELDS if field in statistics)
+    if 'communities' in statistics:
+        compact['connections'] = sum(community.get('nr_candidates') or 0 for community in statistics['communities'])
+    return compact
+
+
+class StatisticsAggregator(object):
+
+    """
+    Keeps the last known values of every peer and a snapshot of the totals for every second of the
+    experiment in which they changed.
+    """
+
+    def __init__(self, start_of_experiment=None):
+        self.start_of_experiment = start_of_experiment
+        self.peer_values = {}
+        self.totals = [0] * len(AGGREGATED_FIELDS)
+        self.series = {}
+
+    def update(self, peer_id, timestamp, values):
+        if self.start_of_experiment is None:
+            self.start_of_experiment = int(timestamp)
+
+        peer_values = self.peer_values.get(peer_id)
+        if peer_values is None:
+            peer_values = self.peer_values[peer_id] = [0] * len(AGGREGATED_FIELDS)
+
+        for index, field in enumerate(AGGREGATED_FIELDS):
+            if field in values:
+                value = values[field]
+                self.totals[index] += value - peer_values[index]
+                peer_values[index] = value
+
+        timeoffset = int(timestamp - self.start_of_experiment)
+        self.series[timeoffset] = self.totals + [len(self.peer_values)]
+
+    def iter_rows(self):
+        """
+        Yields a (timeoffset, send, received, dropped, connections, peers) row for every second
+        between the first and the last update.
+        """
+        if not self.series:
+            return
+
+        timeoffsets = sorted(self.series)
+        row = self.series[timeoffsets[0]]
+        for timeoffset in xrange(timeoffsets[0], timeoffsets[-1] + 1):
+            row = self.series.get(timeoffset, row)
+            yield [timeoffset] + row
+
+    def write(self, filename, record_format='text'):
+        writer = open_record_writer(filename, record_format, names=AGGREGATED_NAMES,
+                                    comments=["start of the experiment: %s" % self.start_of_experiment])
+        for row in self.iter_rows():
+            writer.write(*row)
+        writer.close()
+
+#
+# Server side
+#
+
+
+class StatisticsServiceProto(LineReceiver):
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.state = 'init'
+        self.peer_id = None
+
+    def connectionMade(self):
+        msg("New statistics connection from: ", str(self.transport.getPeer()), logLevel=logging.DEBUG)
+        self.factory.registerConnection(self)
+
+    def lineReceived(self, line):
+        try:
+            pto = 'proto_' + self.state
+            statehandler = getattr(self, pto)
+        except AttributeError:
+            err('Callback %s not found' % self.state)
+            self.transport.loseConnection()
+        else:
+            self.state = statehandler(line)
+            if self.state == 'done':
+                self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        msg("Lost statistics connection with: %s with ID %s" % (str(self.transport.getPeer()), self.peer_id), logLevel=logging.DEBUG)
+        self.factory.unregisterConnection(self)
+        LineReceiver.connectionLost(self, reason)
+
+    #
+    # Protocol state handlers
+    #
+
+    def proto_init(self, line):
+        if line.startswith('id:'):
+            self.peer_id = line.strip().split(':', 1)[1]
+            self.factory.registerPeer(self.peer_id)
+            return 'statistics'
+        else:
+            err("Haven't received the id command as the first line, closing connection")
+            return 'done'
+
+    def proto_statistics(self, line):
+        try:
+            timestamp, values = line.split(' ', 1)
+            self.factory.aggregator.update(self.peer_id, float(timestamp), json.loads(values))
+        except ValueError:
+            err('Unexpected statistics received "%s" from %s, closing connection.' % (line, self.peer_id))
+            return 'done'
+        return 'statistics'
+
+
+class StatisticsServiceFactory(Factory):
+    protocol = StatisticsServiceProto
+
+    def __init__(self, expected_subscribers, output_filename, flush_interval=STATISTICS_FLUSH_INTERVAL):
+        self.expected_subscribers = expected_subscribers
+        self.output_filename = output_filename
+        self.aggregator = StatisticsAggregator()
+        self.connections = []
+        # The IDs of the subscribers that connected, they reconnect if their connection is lost
+        self.seen_peers = set()
+
+        self._flush_lc = LoopingCall(self.flush)
+        self._flush_lc.start(flush_interval, now=False)
+
+    def buildProtocol(self, addr):
+        return StatisticsServiceProto(self)
+
+    def registerConnection(self, proto):
+        self.connections.append(proto)
+
+    def registerPeer(self, peer_id):
+        self.seen_peers.add(peer_id)
+
+    def unregisterConnection(self, proto):
+        if proto in self.connections:
+            self.connections.remove(proto)
+
+        self.checkSubscribersGone()
+
+    def stopWaiting(self, _=None):
+        """
+        Stops waiting for the expected subscribers that haven't connected yet (IE: because they
+        crashed), the service stops once the connected ones are gone.
+        """
+        if len(self.seen_peers) < self.expected_subscribers:
+            msg("%d of %d statistics subscribers never connected, not waiting for them." % (
+                self.expected_subscribers - len(self.seen_peers), self.expected_subscribers))
+            self.expected_subscribers = len(self.seen_peers)
+            self.checkSubscribersGone()
+
+    def checkSubscribersGone(self):
+        if not self.connections and len(self.seen_peers) >= self.expected_subscribers:
+            msg("All statistics subscribers are gone, writing the final aggregates.")
+            self.stop()
+
+    def flush(self):
+        self.aggregator.write(self.output_filename)
+
+    def stop(self):
+        if self._flush_lc.running:
+            self._flush_lc.stop()
+        self.flush()
+        reactor.callLater(0, stopReactor)
+
+#
+# Client side
+#
+
+
+class StatisticsClient(LineReceiver):
+
+    def connectionMade(self):
+        msg("Connected to the statistics server", logLevel=logging.DEBUG)
+        self.sendLine("id:%s" % self.factory.peer_id)
+        self.factory.onConnected(self)
+
+    def connectionLost(self, reason):
+        self.factory.onDisconnected(self)
+        LineReceiver.connectionLost(self, reason)
+
+
+class StatisticsClientFactory(ReconnectingClientFactory):
+
+    """
+    Pushes statistics to the statistics server. Not being able to reach the server doesn't abort
+    the experiment, the statistics will just be missing from the live aggregates as they are
+    also written to statistics.log. The statistics pushed while disconnected are kept in a
+    bounded queue and sent once the connection is made.
+    """
+    protocol = StatisticsClient
+    maxDelay = 10
+
+    def __init__(self, peer_id, max_pending=1000):
+        self.peer_id = peer_id
+        self.pending = deque(maxlen=max_pending)
+        self.connection = None
+        self.closing = False
+
+    def pushStatistics(self, timestamp, values):
+        """
+        Should be called from the reactor thread.
+        """
+        line = "%f %s" % (timestamp, json.dumps(values))
+        if self.connection:
+            self.connection.sendLine(line)
+        else:
+            self.pending.append(line)
+
+    def close(self):
+        self.closing = True
+        self.stopTrying()
+        if self.connection:
+            self.connection.transport.loseConnection()
+
+    def onConnected(self, proto):
+        self.resetDelay()
+        self.connection = proto
+        while self.pending:
+            proto.sendLine(self.pending.popleft())
+        if self.closing:
+            proto.transport.loseConnection()
+
+    def onDisconnected(self, proto):
+        self.connection = None
+
+    def clientConnectionFailed(self, connector, reason):
+        msg("Failed to connect to the statistics server, error was: %s" % reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if reason.type is ConnectionDone or self.closing:
+            self.stopTrying()
+        else:
+            msg("The connection with the statistics server was lost with reason: %s" % reason.getErrorMessage())
+            ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+#
+# stats.py ends here
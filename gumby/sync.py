@@ -23,6 +23,42 @@
 # be sent back to them in the form of a JSON document. After this, a "go" command will
 # be sent to indicate that they should start running the experiment.
 #
+# Sending encoding:columnar-zlib before ready (ExperimentClient does) makes the server send the
+# document compressed (see encode_compact_vars) instead, as a "vars:<length>" line followed by
+# that many bytes, which isn't limited by the maximum line length.
+#
+# The time offset of an instance is estimated from its time: line alone, unless it sends clock:ping.
+# Then the server sends it CLOCK_SAMPLES "ping:<server time>" lines one after the other, which it
+# answers with "pong:<server time>:<its time>", and uses the sample with the smallest round trip
+# time (its half being the maximum error, time_offset_error in the vars). Those instances get a
+# "start:<server time>:<time_offset>:<time_offset_error>" line before the document, with the time
+# the server will send the go command at, so they can all start at the same moment.
+#
+# Instances sending persistent before ready stay connected after the go command and the server
+# keeps running until the last of them disconnects. Meanwhile they can use these commands:
+# * barrier:<name>     -> Waits for all the (still connected) instances at the barrier called name,
+#                         the server answers passed:<name> to all of them once the last one
+#                         arrives. Barriers can be used again with the same name afterwards.
+# * put:<key>:<value>  -> Stores the value of key, replacing its previous one.
+# * wait:<key>         -> Asks for the value of key, the server answers value:<key>:<value> with
+#                         the current value, or as soon as someone puts one.
+#
+# Instances only needing some of the vars can send subscribe:<keys>:<peers> before ready, IE:
+# "subscribe:host,port:1-10,15" to only get the host and port of those peers, or "subscribe:*:"
+# to get no peers at all ("*" means all of them). After getting the document and until the go
+# command, get:<keys>:<peers> asks for more vars, which are sent back as another document.
+#
+# With a lot of instances the server can be offloaded with relays (one per node, see
+# ExperimentRelayFactory), which wait for their local instances like the server does and then
+# register all of them with it in a single connection using this command instead of set:
+# * subscriber:<json> -> The vars of one of the instances of the relay, its time_offset relative
+#                        to the relay.
+# The relay gets the id of its first instance (the rest follow it in the order they were
+# registered), the JSON document and the go command, and passes them on to its instances.
+# Relays of persistent instances send barrier:<name>:<count> once all of their instances reached
+# the barrier, and gone:<count> when some of them disconnect during the experiment, so the server
+# doesn't wait for them at the next barriers.
+#
 # Example of an expected exchange:
 # [connection is opened by the client]
 # -> time:1378479678.11
@@ -58,22 +94,157 @@
 
 # Code:
 
+from collections import Mapping
 from time import time
 import json
 import logging
+import zlib
 
 from twisted.internet import epollreactor
 epollreactor.install()
 
 from twisted.internet import reactor
-from twisted.internet.defer import gatherResults
-from twisted.internet.error import ConnectionDone
+from twisted.internet.defer import Deferred, fail, gatherResults
+from twisted.internet.error import ConnectionDone, ConnectionLost
 from twisted.internet.protocol import Factory, ReconnectingClientFactory
 from twisted.internet.task import deferLater
 from twisted.protocols.basic import LineReceiver
 from twisted.python.log import msg, err
 
 EXPERIMENT_SYNC_TIMEOUT = 10
+# Amount of ping rounds used to estimate the clock offset of every subscriber
+CLOCK_SAMPLES = 8
+
+COMPACT_ENCODING = 'columnar-zlib'
+
+#
+# Vars document encoding
+#
+
+
+def encode_compact_vars(all_vars):
+    """
+    Encodes an {id: vars} dict as a zlib compressed JSON document with a column of values per key
+    instead of a dict per subscriber, the columns with few different values (IE: the hosts) are
+    stored as a list of those values and the index of the value of every subscriber.
+    """
+    ids = sorted(all_vars, key=int)
+    keys = sorted(set(key for vars in all_vars.itervalues() for key in vars))
+    columns = []
+    for key in keys:
+        column = [all_vars[subscriber_id].get(key) for subscriber_id in ids]
+        # By type too, so 1, 1.0 and True stay different values
+        value_indexes = {}
+        indexes = [value_indexes.setdefault((type(value), value), len(value_indexes)) for value in column]
+        if len(value_indexes) * 2 < len(column):
+            values = [None] * len(value_indexes)
+            for (_, value), index in value_indexes.iteritems():
+                values[index] = value
+            column = {'values': values, 'indexes': indexes}
+        columns.append(column)
+
+    return zlib.compress(json.dumps({'ids': map(str, ids), 'keys': keys, 'columns': columns}, separators=(',', ':')))
+
+
+class CompactVars(Mapping):
+
+    """
+    Read only {id: vars} mapping over a document written by encode_compact_vars, the vars dict of a
+    subscriber is only built when it's looked up.
+    """
+
+    def __init__(self, data):
+        document = json.loads(zlib.decompress(data))
+        self._indexes = dict((subscriber_id, index) for index, subscriber_id in enumerate(document['ids']))
+        self._keys = document['keys']
+        self._columns = []
+        for column in document['columns']:
+            if isinstance(column, dict):
+                values = column['values']
+                column = [values[index] for index in column['indexes']]
+            self._columns.append(column)
+
+    def __getitem__(self, subscriber_id):
+        index = self._indexes[str(subscriber_id)]
+        # Missing vars are stored as None
+        return dict((key, column[index]) for key, column in zip(self._keys, self._columns) if column[index] is not None)
+
+    def __contains__(self, subscriber_id):
+        return str(subscriber_id) in self._indexes
+
+    def __iter__(self):
+        return iter(self._indexes)
+
+    def __len__(self):
+        return len(self._indexes)
+
+
+def format_subscription(keys=None, peers=None):
+    """
+    Formats the keys and peers (a list of IDs or a "1,5-10" like string) of a subscribe: or get:
+    command, None meaning all of them.
+    """
+    if peers is not None and not isinstance(peers, basestring):
+        peers = ','.join(map(str, peers))
+    return "%s:%s" % ('*' if keys is None else ','.join(keys), '*' if peers is None else peers)
+
+
+def parse_subscription(text):
+    """
+    Parses the keys and peers of a subscribe: or get: command into a (keys, peer ranges) tuple, each
+    of them None when all of them are wanted.
+    """
+    keys, peers = text.strip().split(':')
+    keys = None if keys == '*' else tuple(key for key in keys.split(',') if key)
+    if peers == '*':
+        peers = None
+    else:
+        ranges = []
+        for peer_range in peers.split(','):
+            if peer_range:
+                first, _, last = peer_range.partition('-')
+                ranges.append((int(first), int(last or first)))
+        peers = tuple(ranges)
+    return keys, peers
+
+
+class VarsDocument(object):
+
+    """
+    The {id: vars} document sent to the subscribers, every encoding of it is built once, when a
+    subscriber needs it.
+    """
+
+    def __init__(self, all_vars=None, json_vars=None, compact_vars=None):
+        self._all_vars = all_vars
+        self._json_vars = json_vars
+        self._compact_vars = compact_vars
+
+    def getVars(self):
+        if self._all_vars is None:
+            if self._compact_vars is not None:
+                self._all_vars = CompactVars(self._compact_vars)
+            else:
+                self._all_vars = json.loads(self._json_vars)
+        return self._all_vars
+
+    def getJSON(self):
+        if self._json_vars is None:
+            self._json_vars = json.dumps(dict(self.getVars().iteritems()))
+        return self._json_vars
+
+    def getCompact(self):
+        if self._compact_vars is None:
+            self._compact_vars = encode_compact_vars(self.getVars())
+        return self._compact_vars
+
+    def describe(self):
+        sizes = []
+        if self._json_vars is not None:
+            sizes.append("a %d bytes long json doc" % len(self._json_vars))
+        if self._compact_vars is not None:
+            sizes.append("a %d bytes long compact doc" % len(self._compact_vars))
+        return " and ".join(sizes) or "nothing"
 
 #
 # Server side
@@ -89,11 +260,27 @@ class ExperimentServiceProto(LineReceiver):
         self.factory = factory
         self.state = 'init'
         self.vars = {}
+        # Only set for relays
+        self.relayed_vars = None
+        self.encoding = None
+        self.subscription = None
+        # (round trip time, offset) samples, only when pinging
+        self.clock_samples = None
+        self.ready_pending = False
+        # Stays connected after the go command to use barriers and values
+        self.persistent = False
+        # Subscribers of this relay that disconnected from it during the experiment
+        self.gone_subscribers = 0
 
     def connectionMade(self):
         msg("New connection from: ", str(self.transport.getPeer()), logLevel=logging.DEBUG)
 
     def lineReceived(self, line):
+        if line.startswith('pong:'):
+            # Can come in any state
+            self.pongReceived(line)
+            return
+
         try:
             pto = 'proto_' + self.state
             statehandler = getattr(self, pto)
@@ -105,6 +292,30 @@ class ExperimentServiceProto(LineReceiver):
             if self.state == 'done':
                 self.transport.loseConnection()
 
+    def sendPing(self):
+        self.sendLine("ping:%.6f" % time())
+
+    def pongReceived(self, line):
+        received = time()
+        _, sent, remote_time = line.strip().split(':')
+        sent = float(sent)
+        # The remote time was taken half way the round trip, assuming symmetric delays
+        self.clock_samples.append((received - sent, float(remote_time) - (sent + received) / 2))
+        if len(self.clock_samples) < CLOCK_SAMPLES:
+            self.sendPing()
+            return
+
+        round_trip_time, self.vars['time_offset'] = min(self.clock_samples)
+        self.vars['time_offset_error'] = round_trip_time / 2
+        msg("Time offset is %s (+-%s)" % (self.vars['time_offset'], self.vars['time_offset_error']), logLevel=logging.DEBUG)
+        if self.ready_pending:
+            self.ready_pending = False
+            self.factory.setConnectionReady(self)
+
+    @property
+    def clock_synced(self):
+        return self.clock_samples is not None and len(self.clock_samples) >= CLOCK_SAMPLES
+
     def connectionLost(self, reason):
         msg("Lost connection with: %s with ID %s" % (str(self.transport.getPeer()), self.id), logLevel=logging.DEBUG)
         self.factory.unregisterConnection(self)
@@ -129,10 +340,36 @@ class ExperimentServiceProto(LineReceiver):
                 msg("This subscriber sets %s to %s" % (key, value), logLevel=logging.DEBUG)
                 self.vars[key] = value
                 return 'set'
+            elif line.startswith('subscriber:'):
+                if self.relayed_vars is None:
+                    self.relayed_vars = []
+                self.relayed_vars.append(json.loads(line[len('subscriber:'):]))
+                return 'set'
+            elif line.startswith('subscribe:'):
+                self.subscription = parse_subscription(line[len('subscribe:'):])
+                return 'set'
+            elif line.startswith('encoding:'):
+                encoding = line.strip().split(':', 1)[1]
+                if encoding == COMPACT_ENCODING:
+                    self.encoding = encoding
+                else:
+                    err('Unknown encoding "%s" requested, sending plain JSON' % encoding)
+                return 'set'
+            elif line.strip() == 'persistent':
+                self.persistent = True
+                return 'set'
+            elif line.strip() == 'clock:ping':
+                self.clock_samples = []
+                self.sendPing()
+                return 'set'
             elif line.strip() == 'ready':
                 msg("This subscriber is ready now.")
                 self.ready = True
-                self.factory.setConnectionReady(self)
+                if self.clock_samples is not None and not self.clock_synced:
+                    # Once we are done pinging it
+                    self.ready_pending = True
+                else:
+                    self.factory.setConnectionReady(self)
                 return 'wait'
             else:
                 err('Unexpected command received "%s"' % line)
@@ -140,18 +377,89 @@ class ExperimentServiceProto(LineReceiver):
                 return 'done'
 
     def proto_wait(self, line):
+        if line.startswith('get:') and self.factory.document is not None:
+            self.sendVars(self.factory.getVarsDocument(parse_subscription(line[len('get:'):])))
+            return 'wait'
         err('Unexpected command received "%s" while in ready state. Closing connection' % line)
         return 'done'
 
+    def proto_running(self, line):
+        command, _, argument = line.strip().partition(':')
+        if command == 'barrier':
+            # Relays send the amount of their subscribers that reached it
+            name, _, count = argument.partition(':')
+            self.factory.barrierReached(self, name, int(count) if count else 1)
+        elif command == 'put':
+            key, _, value = argument.partition(':')
+            self.factory.putValue(key, value)
+        elif command == 'wait':
+            self.factory.waitValue(self, argument)
+        elif command == 'gone' and self.relayed_vars is not None:
+            self.factory.subscribersGone(self, int(argument))
+        else:
+            err('Unexpected command received "%s" while running. Closing connection' % line)
+            return 'done'
+        return 'running'
+
+    def sendVars(self, document):
+        if self.encoding == COMPACT_ENCODING:
+            data = document.getCompact()
+            self.sendLine("vars:%d" % len(data))
+            self.transport.write(data)
+        else:
+            self.sendLine(document.getJSON())
+
+    @property
+    def subscriber_count(self):
+        return 1 if self.relayed_vars is None else len(self.relayed_vars) - self.gone_subscribers
+
+    def getSubscribersVars(self):
+        """
+        Returns the vars of the subscribers registered by this connection (more than one for relays)
+        with their host and their time offset relative to us.
+        """
+        host = self.transport.getPeer().host
+        if self.relayed_vars is None:
+            vars = self.vars.copy()
+            vars['host'] = host
+            return [vars]
+
+        subscribers_vars = []
+        for vars in self.relayed_vars:
+            vars = vars.copy()
+            vars['time_offset'] += self.vars['time_offset']
+            if 'time_offset_error' in vars and 'time_offset_error' in self.vars:
+                vars['time_offset_error'] += self.vars['time_offset_error']
+            else:
+                vars.pop('time_offset_error', None)
+            # The relay doesn't know the address of its local subscribers, which is its own
+            vars.setdefault('host', host)
+            subscribers_vars.append(vars)
+        return subscribers_vars
+
 
 class ExperimentServiceFactory(Factory):
     protocol = ExperimentServiceProto
 
-    def __init__(self, expected_subscribers, experiment_start_delay):
+    def __init__(self, expected_subscribers, experiment_start_delay, stop_when_started=True):
         self.expected_subscribers = expected_subscribers
         self.experiment_start_delay = experiment_start_delay
+        # Other services (IE: the live statistics one) might need the reactor to keep running, they can
+        # use finished to know when the subscribers don't need us anymore
+        self.stop_when_started = stop_when_started
+        self.finished = Deferred()
         self.connection_counter = -1
         self.connections = []
+        self.ready_subscribers = 0
+        # The vars document of all the subscribers and its projections, once it's known
+        self.document = None
+        self._projections = {}
+        self.experiment_started = False
+        # The persistent subscribers that reached every barrier ({name: [(connection, count), ...]})
+        # and the values they share
+        self.barriers = {}
+        self.values = {}
+        self.value_waiters = {}
         self._last_subscriber_connection_ts = 0
         self._timeout_delayed_call = None
 
@@ -163,54 +471,182 @@ class ExperimentServiceFactory(Factory):
         if not self._timeout_delayed_call:
             self._timeout_delayed_call = reactor.callLater(EXPERIMENT_SYNC_TIMEOUT, self.onExperimentSetupTimeout)
         self.connections.append(proto)
-        if len(self.connections) >= self.expected_subscribers:
-            msg("All subscribers are ready, pushing data!")
+        self.ready_subscribers += proto.subscriber_count
+        if self.ready_subscribers >= self.expected_subscribers:
             self._timeout_delayed_call.cancel()
-            self.pushInfoToSubscribers()
+            self.onAllSubscribersReady()
         else:
             if self._last_subscriber_connection_ts < time() - 5:
                 logLevel = logging.DEBUG
                 self._last_subscriber_connection_ts = time()
             else:
                 logLevel = logging.INFO
-            msg("%d of %d expected subscribers ready." % (len(self.connections), self.expected_subscribers), logLevel=logLevel)
+            msg("%d of %d expected subscribers ready." % (self.ready_subscribers, self.expected_subscribers), logLevel=logLevel)
+
+    def onAllSubscribersReady(self):
+        msg("All subscribers are ready, pushing data!")
+        self.pushInfoToSubscribers()
+
+    def getSubscribersVars(self):
+        # In the order the subscribers got ready, which is the order of their IDs
+        for subscriber in self.connections:
+            for subscriber_vars in subscriber.getSubscribersVars():
+                yield subscriber_vars
 
     def pushInfoToSubscribers(self):
         # Generate the json doc
         vars = {}
+        for subscriber_id, subscriber_vars in enumerate(self.getSubscribersVars(), 1):
+            subscriber_vars['port'] = subscriber_id + 12000
+            vars[str(subscriber_id)] = subscriber_vars
+        msg("Pushing the vars of %d subscribers." % len(vars))
+
+        document = VarsDocument(vars)
+        self.sendInfoToSubscribers(1, document, time() + self.experiment_start_delay)
+        msg("Data (%s) sent to all subscribers, giving the go signal in %f secs." % (document.describe(), self.experiment_start_delay))
+        reactor.callLater(self.experiment_start_delay, self.startExperiment)
+
+    def sendInfoToSubscribers(self, first_id, document, start, time_offset=0.0, time_offset_error=0.0):
+        """
+        Sends the ID, the time the experiment will start at (in the clock of the server) and the
+        vars they want to the subscribers, relays get the ID of their first subscriber. The time offset
+        and its error are ours relative to the server, when we are a relay.
+        """
+        self.document = document
+        self._projections = {}
+        subscriber_id = first_id
         for subscriber in self.connections:
-            subscriber_vars = subscriber.vars.copy()
-            subscriber_vars['port'] = subscriber.id + 12000
-            subscriber_vars['host'] = subscriber.transport.getPeer().host
-            vars[subscriber.id] = subscriber_vars
-        json_vars = json.dumps(vars)
-        msg("Pushing a %d bytes long json doc." % len(json_vars))
-
-        # Send the ID and json doc to the subscribers
-        for subscriber in self.connections:
+            subscriber.id = subscriber_id
             subscriber.sendLine("id:%s" % subscriber.id)
-            subscriber.sendLine(json_vars)
-        msg("Data sent to all subscribers, giving the go signal in %f secs." % self.experiment_start_delay)
-        reactor.callLater(self.experiment_start_delay, self.startExperiment)
+            if start is not None and subscriber.clock_synced:
+                subscriber.sendLine("start:%.6f:%.6f:%.6f" % (start, time_offset + subscriber.vars['time_offset'],
+                                                             time_offset_error + subscriber.vars['time_offset_error']))
+            subscriber.sendVars(self.getVarsDocument(subscriber.subscription))
+            subscriber_id += subscriber.subscriber_count
+
+    def getVarsDocument(self, subscription):
+        """
+        Returns a document with the vars of the (keys, peer ranges) subscription, subscribers asking
+        for the same vars share it (and its encodings).
+        """
+        if subscription is None or subscription == (None, None):
+            return self.document
+
+        if subscription not in self._projections:
+            keys, peers = subscription
+            all_vars = self.document.getVars()
+            if peers is None:
+                subscriber_ids = all_vars.keys()
+            else:
+                subscriber_ids = [str(subscriber_id) for first, last in peers for subscriber_id in xrange(first, last + 1)
+                                  if str(subscriber_id) in all_vars]
+
+            vars = {}
+            for subscriber_id in subscriber_ids:
+                subscriber_vars = all_vars[subscriber_id]
+                if keys is not None:
+                    subscriber_vars = dict((key, subscriber_vars[key]) for key in keys if key in subscriber_vars)
+                vars[subscriber_id] = subscriber_vars
+            self._projections[subscription] = VarsDocument(vars)
+
+        return self._projections[subscription]
 
     def startExperiment(self):
-        # Give the go signal and disconnect
+        # Give the go signal and disconnect the subscribers that don't need us anymore
         msg("Starting the experiment!")
+        self.experiment_started = True
         deferreds = []
         for subscriber in self.connections:
             subscriber.sendLine("go")
-            deferreds.append(deferLater(reactor, 0, subscriber.transport.loseConnection))
+            if subscriber.persistent:
+                subscriber.state = 'running'
+            else:
+                deferreds.append(deferLater(reactor, 0, subscriber.transport.loseConnection))
         d = gatherResults(deferreds)
         d.addCallbacks(self.onExperimentStarted, self.onExperimentStartError)
 
     def unregisterConnection(self, proto):
         if proto in self.connections:
             self.connections.remove(proto)
+            self.ready_subscribers -= proto.subscriber_count
+            if self.experiment_started:
+                for name, arrived in self.barriers.items():
+                    self.barriers[name] = [(subscriber, count) for subscriber, count in arrived if subscriber is not proto]
+                for waiters in self.value_waiters.itervalues():
+                    if proto in waiters:
+                        waiters.remove(proto)
+                self.onSubscribersGone(proto.subscriber_count, proto.persistent)
         msg("Connection cleanly unregistered.")
 
+    def subscribersGone(self, proto, count):
+        msg("%d subscribers of relay %s are gone." % (count, proto.id), logLevel=logging.DEBUG)
+        proto.gone_subscribers += count
+        self.ready_subscribers -= count
+        self.onSubscribersGone(count, True)
+
+    def onSubscribersGone(self, count, persistent):
+        # The barriers don't wait for them anymore
+        for name in self.barriers.keys():
+            self.checkBarrier(name)
+
+        # The ones that aren't persistent are being disconnected by startExperiment()
+        if persistent and not self.hasPersistentSubscribers():
+            msg("All the persistent subscribers are gone.")
+            self.onFinished()
+
+    def hasPersistentSubscribers(self):
+        return any(subscriber.persistent for subscriber in self.connections)
+
     def onExperimentStarted(self, _):
-        msg("Experiment started, shutting down sync server.")
-        reactor.callLater(0, stopReactor)
+        if self.hasPersistentSubscribers():
+            msg("Experiment started, waiting for the persistent subscribers to disconnect.")
+        else:
+            msg("Experiment started.")
+            self.onFinished()
+
+    def onFinished(self):
+        if self.finished.called:
+            return
+
+        self.finished.callback(None)
+        if self.stop_when_started:
+            msg("Shutting down sync server.")
+            reactor.callLater(0, stopReactor)
+
+    def barrierReached(self, proto, name, count):
+        self.barriers.setdefault(name, []).append((proto, count))
+        self.checkBarrier(name)
+
+    def checkBarrier(self, name):
+        arrived = self.barriers[name]
+        if not arrived:
+            del self.barriers[name]
+        elif sum(count for _, count in arrived) >= self.ready_subscribers:
+            # Anyone reaching a barrier with this name from now on waits for the others again
+            del self.barriers[name]
+            self.onBarrierComplete(name, arrived)
+
+    def onBarrierComplete(self, name, arrived):
+        msg("All %d subscribers reached barrier %s." % (sum(count for _, count in arrived), name))
+        self.releaseBarrier(name, arrived)
+
+    def releaseBarrier(self, name, arrived):
+        for subscriber, _ in arrived:
+            subscriber.sendLine("passed:%s" % name)
+
+    def putValue(self, key, value):
+        self.values[key] = value
+        self.sendValue(key, value)
+
+    def waitValue(self, proto, key):
+        if key in self.values:
+            proto.sendLine("value:%s:%s" % (key, self.values[key]))
+        else:
+            self.value_waiters.setdefault(key, []).append(proto)
+
+    def sendValue(self, key, value):
+        for subscriber in self.value_waiters.pop(key, []):
+            subscriber.sendLine("value:%s:%s" % (key, value))
 
     def onExperimentStartError(self, failure):
         err("Failed to start experiment")
@@ -220,29 +656,100 @@ class ExperimentServiceFactory(Factory):
     def onExperimentSetupTimeout(self):
         err("Waiting for all peers timed out, exiting.")
         reactor.stop()
+
+
+class ExperimentRelayFactory(ExperimentServiceFactory):
+    """
+    Waits for its expected subscribers like ExperimentServiceFactory, then registers all of them with
+    the upstream server (or relay) in a single connection and passes the IDs, the JSON document and
+    the go signal it gets back on to them. With a relay on every node the server only needs to talk
+    to one connection per node.
+    """
+
+    def __init__(self, expected_subscribers, upstream_host, upstream_port, stop_when_started=True):
+        ExperimentServiceFactory.__init__(self, expected_subscribers, 0, stop_when_started)
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        # Our connection to the upstream server and the barriers we passed on to it
+        self.upstream = None
+        self._upstream_barriers = {}
+
+    def onAllSubscribersReady(self):
+        msg("All local subscribers are ready, registering them with %s:%d" % (self.upstream_host, self.upstream_port))
+        reactor.connectTCP(self.upstream_host, self.upstream_port, ExperimentRelayClientFactory(self))
+
+    def onSubscribersGone(self, count, persistent):
+        if self.upstream is not None and self.upstream.state == 'running':
+            self.upstream.sendLine("gone:%d" % count)
+        ExperimentServiceFactory.onSubscribersGone(self, count, persistent)
+
+    def onBarrierComplete(self, name, arrived):
+        # Wait for the subscribers of the rest of the relays
+        self._upstream_barriers[name] = arrived
+        self.upstream.sendLine("barrier:%s:%d" % (name, sum(count for _, count in arrived)))
+
+    def upstreamBarrierComplete(self, name):
+        self.releaseBarrier(name, self._upstream_barriers.pop(name))
+
+    def putValue(self, key, value):
+        self.upstream.sendLine("put:%s:%s" % (key, value))
+
+    def waitValue(self, proto, key):
+        # The value can change upstream, so only waits for the same key are merged
+        if key not in self.value_waiters:
+            self.upstream.sendLine("wait:%s" % key)
+        self.value_waiters.setdefault(key, []).append(proto)
 #
 # Client side
 #
 
 
 class ExperimentClient(LineReceiver):
-    # Allow for 4MB long lines (for the json stuff)
+    # Allow for 4MB long lines (for the json stuff, if the compact encoding isn't used)
     MAX_LENGTH = 2 ** 22
+    # Set to None to get the vars as a JSON line
+    encoding = COMPACT_ENCODING
+    # The keys and peers (IDs, or a "1,5-10" like string) we want the vars of, None for all of them
+    subscribed_keys = None
+    subscribed_peers = None
+    # Stay connected once the experiment starts, to be able to use barrier(), putValue() and waitValue()
+    persistent = False
 
     def __init__(self, vars):
         self.state = "id"
         self.my_id = None
         self.vars = vars
         self.all_vars = {}
+        self._vars_length = None
+        self._vars_data = []
+        self._vars_requests = []
+        self._barriers = {}
+        self._value_waiters = {}
+        # Our clock minus the one of the server, and the local time the experiment starts at
+        self.time_offset = None
+        self.time_offset_error = None
+        self.experiment_start = None
 
     def connectionMade(self):
         msg("Connected to the experiment server")
         self.sendLine("time:%f" % time())
+        self.sendLine("clock:ping")
+        if self.encoding:
+            self.sendLine("encoding:%s" % self.encoding)
+        if self.subscribed_keys is not None or self.subscribed_peers is not None:
+            self.sendLine("subscribe:%s" % format_subscription(self.subscribed_keys, self.subscribed_peers))
+        if self.persistent:
+            self.sendLine("persistent")
         for key, val in self.vars.iteritems():
             self.sendLine("set:%s:%s" % (key, val))
         self.sendLine("ready")
 
     def lineReceived(self, line):
+        if line.startswith("ping:"):
+            # Can come in any state before getting the vars
+            self.sendLine("pong:%s:%.6f" % (line[len("ping:"):], time()))
+            return
+
         try:
             pto = 'proto_' + self.state
             statehandler = getattr(self, pto)
@@ -254,12 +761,86 @@ class ExperimentClient(LineReceiver):
             if self.state == 'done':
                 self.transport.loseConnection()
 
+    def rawDataReceived(self, data):
+        # The rest of a compact vars document
+        self._vars_data.append(data)
+        self._vars_length -= len(data)
+        if self._vars_length <= 0:
+            data = ''.join(self._vars_data)
+            self._vars_data = []
+            rest = data[len(data) + self._vars_length:]
+            document = VarsDocument(compact_vars=data[:len(data) + self._vars_length])
+            if self.state == "all_vars":
+                self.state = "go"
+                self.gotVarsDocument(document)
+            else:
+                self._vars_requests.pop(0).callback(document.getVars())
+            self.setLineMode(rest)
+
+    def gotVarsDocument(self, document):
+        # all_vars is a CompactVars mapping if the document came compressed
+        self.all_vars = document.getVars()
+        self.onAllVarsReceived()
+
     def onAllVarsReceived(self):
         msg("onAllVarsReceived: Call not implemented")
 
+    def requestVars(self, keys=None, peers=None):
+        """
+        Asks for the vars of more keys and peers (see subscribed_keys and subscribed_peers), which can
+        be done from onAllVarsReceived until the experiment starts. Returns a Deferred firing with an
+        {id: vars} mapping of them.
+        """
+        d = Deferred()
+        self._vars_requests.append(d)
+        self.sendLine("get:%s" % format_subscription(keys, peers))
+        return d
+
     def startExperiment(self):
         msg("startExperiment: Call not implemented")
 
+    def barrier(self, name):
+        """
+        Waits for all the other persistent peers to reach the barrier called name. Returns a Deferred
+        firing with the name once they all did.
+        """
+        assert name not in self._barriers, "Already waiting at barrier %s" % name
+        if not self.connected:
+            return fail(ConnectionLost("Not connected to the experiment server"))
+        d = self._barriers[name] = Deferred()
+        self.sendLine("barrier:%s" % name)
+        return d
+
+    def putValue(self, key, value):
+        """
+        Shares value with the other persistent peers, replacing the previous value of key.
+        """
+        self.sendLine("put:%s:%s" % (key, value))
+
+    def waitValue(self, key):
+        """
+        Returns a Deferred firing with the value of key (as a string) as soon as there is one.
+        """
+        if not self.connected:
+            return fail(ConnectionLost("Not connected to the experiment server"))
+        if key not in self._value_waiters:
+            self.sendLine("wait:%s" % key)
+        d = Deferred()
+        self._value_waiters.setdefault(key, []).append(d)
+        return d
+
+    def connectionLost(self, reason):
+        # Don't leave whoever waits for the server hanging, unless we are the ones stopping
+        pending = self._barriers.values() + [d for waiters in self._value_waiters.itervalues() for d in waiters]
+        self._barriers = {}
+        self._value_waiters = {}
+        # Twisted doesn't reset it
+        self.connected = 0
+        if reactor.running:
+            for d in pending:
+                d.errback(reason)
+        LineReceiver.connectionLost(self, reason)
+
     #
     # Protocol state handlers
     #
@@ -277,23 +858,107 @@ class ExperimentClient(LineReceiver):
             return "done"
 
     def proto_all_vars(self, line):
+        if line.startswith("start:"):
+            start, self.time_offset, self.time_offset_error = map(float, line.strip().split(':')[1:])
+            self.experiment_start = start + self.time_offset
+            msg("The experiment starts at %f (time offset %f +-%f)" % (self.experiment_start, self.time_offset, self.time_offset_error),
+                logLevel=logging.DEBUG)
+            return "all_vars"
+
         msg("Got experiment variables", logLevel=logging.DEBUG)
-        self.all_vars = json.loads(line)
-        self.onAllVarsReceived()
+        if line.startswith("vars:"):
+            self._vars_length = int(line.split(':', 1)[1])
+            self.setRawMode()
+            return "all_vars"
+
+        self.gotVarsDocument(VarsDocument(json_vars=line))
         return "go"
 
     def proto_go(self, line):
+        # The answers to requestVars() come before it
+        if line.startswith("vars:"):
+            self._vars_length = int(line.split(':', 1)[1])
+            self.setRawMode()
+            return "go"
+        elif line.startswith("{"):
+            self._vars_requests.pop(0).callback(json.loads(line))
+            return "go"
+
         msg("Got GO signal", logLevel=logging.DEBUG)
         if line.strip() == "go":
+            self.factory.experiment_started = True
             self.startExperiment()
+            if self.persistent:
+                return "running"
             self.transport.loseConnection()
 
+    def proto_running(self, line):
+        command, _, argument = line.strip().partition(':')
+        if command == "passed":
+            self._barriers.pop(argument).callback(argument)
+        elif command == "value":
+            key, _, value = argument.partition(':')
+            for d in self._value_waiters.pop(key, []):
+                d.callback(value)
+        else:
+            err("Unexpected command received from the server: %s" % line)
+        return "running"
+
+
+class ExperimentRelayClient(ExperimentClient):
+
+    def __init__(self, relay):
+        ExperimentClient.__init__(self, {})
+        self.relay = relay
+
+    def connectionMade(self):
+        msg("Connected to the upstream experiment server")
+        self.sendLine("time:%f" % time())
+        self.sendLine("clock:ping")
+        self.sendLine("encoding:%s" % self.encoding)
+        for vars in self.relay.getSubscribersVars():
+            # Let the server use our address for the subscribers connected over the loopback interface
+            if vars['host'].startswith('127.'):
+                del vars['host']
+            self.sendLine("subscriber:%s" % json.dumps(vars))
+        # Barriers and values need us to stay connected if any of our subscribers does
+        self.persistent = self.relay.hasPersistentSubscribers()
+        if self.persistent:
+            self.sendLine("persistent")
+        self.relay.upstream = self
+        self.sendLine("ready")
+
+    def gotVarsDocument(self, document):
+        # No need to parse it, just pass it on
+        msg("Passing the experiment variables on to the local subscribers", logLevel=logging.DEBUG)
+        if self.experiment_start is None:
+            # The upstream server didn't estimate our clock offset
+            self.relay.sendInfoToSubscribers(int(self.my_id), document, None)
+        else:
+            self.relay.sendInfoToSubscribers(int(self.my_id), document, self.experiment_start - self.time_offset,
+                                             self.time_offset, self.time_offset_error)
+
+    def startExperiment(self):
+        self.relay.startExperiment()
+
+    def proto_running(self, line):
+        command, _, argument = line.strip().partition(':')
+        if command == "passed":
+            self.relay.upstreamBarrierComplete(argument)
+        elif command == "value":
+            key, _, value = argument.partition(':')
+            self.relay.sendValue(key, value)
+        else:
+            err("Unexpected command received from the upstream server: %s" % line)
+        return "running"
+
 
 class ExperimentClientFactory(ReconnectingClientFactory):
 
     def __init__(self, vars, protocol=ExperimentClient):
         self.vars = vars
         self.protocol = protocol
+        self.experiment_started = False
 
     def buildProtocol(self, address):
         p = self.protocol(self.vars)
@@ -307,12 +972,25 @@ class ExperimentClientFactory(ReconnectingClientFactory):
 
     def clientConnectionLost(self, connector, reason):
         msg("The connection with the experiment server was lost with reason: %s" % reason.getErrorMessage())
-        if reason.type is not ConnectionDone:
+        # Persistent clients lose it when they stop, which isn't an error
+        if reason.type is not ConnectionDone and not self.experiment_started:
             reactor.exitCode = 3
             stopReactor()
         else:
             # If the connection is cleanly closed we can stop trying to reconnect.
             self.stopTrying()
+
+
+class ExperimentRelayClientFactory(ExperimentClientFactory):
+
+    def __init__(self, relay):
+        ExperimentClientFactory.__init__(self, {}, ExperimentRelayClient)
+        self.relay = relay
+
+    def buildProtocol(self, address):
+        p = self.protocol(self.relay)
+        p.factory = self
+        return p
 #
 # Aux stuff
 #
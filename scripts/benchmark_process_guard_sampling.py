@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# benchmark_process_guard_sampling.py ---
+#
+# Filename: benchmark_process_guard_sampling.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 19:25:10 2026 (+0200)
+
+# Commentary:
+#
+# Measures the cost of a process_guard.py sampling tick depending on the amount of monitored
+# processes, comparing reopening the /proc files on every tick with the persistent file
+# descriptors of ResourceMonitor, and the cost of looking for new processes by scanning all of
+# /proc with following the /proc/<pid>/task/<tid>/children files (when the kernel has them).
+# It also measures the cost of sampling the memory usage of all of them (--memory-interval) from
+# smaps_rollup and from statm, process_guard spreads those reads over the ticks of a memory interval.
+#
+# Usage: benchmark_process_guard_sampling.py [<ticks> [<pid count> ...]]
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import path
+from sys import argv, path as sys_path
+from time import time
+import subprocess
+
+sys_path.insert(0, path.dirname(path.abspath(__file__)))
+from process_guard import ResourceMonitor
+
+
+def get_raw_stats_reopening(pids):
+    # What ResourceMonitor.get_raw_stats() used to do
+    for pid in pids:
+        status = open('/proc/%s/stat' % pid, 'r').read()[:-1]
+        lines = open('/proc/%s/io' % pid, 'r').readlines()
+        yield ' '.join([status] + [line.split(': ')[1][:-1] for line in lines])
+
+
+def time_per_call(func, calls):
+    start = time()
+    for _ in xrange(calls):
+        func()
+    return (time() - start) / calls * 1e6
+
+
+def benchmark(rm, nr_pids, ticks):
+    processes = [subprocess.Popen(['sleep', '1000'], close_fds=True) for _ in xrange(nr_pids)]
+    pids = [process.pid for process in processes]
+    try:
+        rm.pid_list = list(pids)
+        reopening = time_per_call(lambda: list(get_raw_stats_reopening(pids)), ticks)
+        persistent = time_per_call(lambda: list(rm.get_raw_stats()), ticks)
+
+        results = [reopening, persistent]
+        for children_supported in (False, True):
+            if children_supported and not rm.children_supported:
+                results.append(None)
+                continue
+
+            rm.children_supported = children_supported
+            rm.pid_list = []
+            rm.update_pid_tree()
+            results.append(time_per_call(rm.update_pid_tree, max(ticks / 10, 1)))
+        rm.children_supported = bool(results[-1])
+
+        smaps_rollup_supported = rm.smaps_rollup_supported
+        for rm.smaps_rollup_supported in (True, False):
+            if rm.smaps_rollup_supported and not smaps_rollup_supported:
+                results.append(None)
+                continue
+
+            for pid in pids:
+                rm.close_proc_files(pid)
+            results.append(time_per_call(lambda: list(rm.get_memory_stats(pids)), ticks))
+        rm.smaps_rollup_supported = smaps_rollup_supported
+        return results
+
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+        for pid in pids:
+            rm.close_proc_files(pid)
+
+
+def main():
+    ticks = int(argv[1]) if len(argv) > 1 else 200
+    pid_counts = [int(count) for count in argv[2:]] or [1, 10, 20, 50, 100, 200]
+
+    rm = ResourceMonitor(None, [])
+    print "%5s %15s %15s %15s %15s %15s %15s" % ("pids", "reopen us/tick", "pread us/tick", "scan us", "children us", "smaps us", "statm us")
+    for nr_pids in pid_counts:
+        results = benchmark(rm, nr_pids, ticks)
+        print "%5d %15s %15s %15s %15s %15s %15s" % tuple([nr_pids] + ["%.1f" % result if result is not None else "n/a" for result in results])
+
+if __name__ == "__main__":
+    main()
+
+#
+# benchmark_process_guard_sampling.py ends here
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# benchmark_reduce_dispersy_statistics.py ---
+#
+# Filename: benchmark_reduce_dispersy_statistics.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 22:04:51 2026 (+0200)
+
+# Commentary:
+#
+# Measures the time and peak memory needed by reduce_dispersy_statistics.py to reduce a synthetic
+# merged record file (like utimes.txt, with a column per process) to 300 rows, comparing the
+# streaming reducer with the previous one (reading all the lines of the file and keeping a list of
+# floats per column for every output row). Both have to give the same result, which is also checked
+# for small files that are copied instead of reduced and for a debugstatistics file. If a number of
+# jobs is given, it also measures reducing copies of the file with main() using one and that many
+# processes.
+#
+# Usage: benchmark_reduce_dispersy_statistics.py [<columns> [<rows> [<jobs>]]]
+#
+# The defaults (2000 columns and 100000 rows) make a ~900MB file in the temporary directory.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from collections import defaultdict
+from filecmp import cmp
+from math import ceil
+from multiprocessing import Process, Queue
+from os import path, link
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from sys import argv, path as sys_path, stderr
+from tempfile import mkdtemp
+from time import time
+import os
+
+import numpy
+
+sys_path.insert(0, path.dirname(path.abspath(__file__)))
+from reduce_dispersy_statistics import main, reduce
+
+NRLINES = 300
+
+
+def reduce_previous(base_directory, nrlines, inputfile, outputfile):
+    # reduce() as it was before it streamed the files, reading all of their lines at once
+    inputfile = os.path.join(base_directory, inputfile)
+    outputfile = os.path.join(base_directory, outputfile)
+
+    if os.path.exists(inputfile):
+        print >> stderr, base_directory, inputfile, outputfile
+
+        ifp = open(inputfile, 'r')
+        ofp = open(outputfile, 'w')
+
+        lines = ifp.readlines()
+        print >> ofp, lines[0][:-1]
+
+        lines = lines[1:]
+        if len(lines) > nrlines:
+            nrlines_to_merge = int(ceil(len(lines) / float(nrlines)))
+            print >> stderr, "%s has %d lines, reducing to %d lines" % (inputfile, len(lines), nrlines)
+
+            max_time = None
+            to_be_merged_parts = defaultdict(list)
+            for i, line in enumerate(lines):
+                parts = line.split()
+                max_time = max(float(parts[0]), max_time)
+
+                parts = map(float, parts[1:])
+                for j, part in enumerate(parts):
+                    to_be_merged_parts[j].append(part)
+
+                if (i + 1) % nrlines_to_merge == 0 or (i + 1 == len(lines)):
+                    print >> ofp, max_time,
+
+                    for j, parts in to_be_merged_parts.iteritems():
+                        mean = sum(parts) / float(len(parts))
+                        print >> ofp, mean,
+
+                        to_be_merged_parts[j] = []
+
+                    print >> ofp, ''
+
+        else:
+            for line in lines:
+                print >> ofp, line[:-1]
+
+        ifp.close()
+        ofp.close()
+
+
+def write_synthetic_file(filename, columns, rows, block_size=1000):
+    """
+    Writes a record file like the ones written by extract_process_guard_stats.py, with mostly small
+    CPU usage values and a lot of zeros.
+    """
+    values = ['0.0'] * 50 + [str(value / 100.0) for value in xrange(1, 101)]
+    fp = open(filename, 'w')
+    print >> fp, 'time', ' '.join('node%d_%d' % (column // 100, column) for column in xrange(columns))
+    for start in xrange(0, rows, block_size):
+        block = numpy.random.randint(0, len(values), (min(block_size, rows - start), columns)).tolist()
+        fp.write(''.join('%d.0 %s \n' % (start + row, ' '.join([values[value] for value in indexes])) for row, indexes in enumerate(block)))
+    fp.close()
+
+
+def write_debugstatistics_file(filename, rows):
+    """
+    Writes a scenario-*-debugstatistics.txt file like extract_dispersy_statistics.py does, which starts
+    with a comment instead of the names of the columns.
+    """
+    fp = open(filename, 'w')
+    print >> fp, "# timestamp timeoffset value"
+    for row in xrange(rows):
+        print >> fp, 1381234567.123456 + row, row / 4.0, numpy.random.randint(0, 100)
+    fp.close()
+
+
+def check_same_output(directory):
+    """
+    Compares the files written by both reducers for a small record file and a debugstatistics file,
+    both when they have to be reduced and when they are copied.
+    """
+    write_synthetic_file(path.join(directory, 'small.txt'), 20, 1000)
+    write_debugstatistics_file(path.join(directory, 'scenario-check-debugstatistics.txt'), 1000)
+    for inputfile in ('small.txt', 'scenario-check-debugstatistics.txt'):
+        for nrlines in (NRLINES, 1000):
+            reduce_previous(directory, nrlines, inputfile, 'check_previous.txt')
+            reduce(directory, nrlines, inputfile, 'check_reduced.txt')
+            if not cmp(path.join(directory, 'check_previous.txt'), path.join(directory, 'check_reduced.txt'), shallow=False):
+                print "ERROR: the files reduced from %s to %d rows are different!" % (inputfile, nrlines)
+
+
+def _measure(queue, func, args):
+    start = time()
+    func(*args)
+    queue.put((time() - start, getrusage(RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def measure(func, *args):
+    """
+    Runs func in a new process, returns the time it took and its peak memory usage in MB.
+    """
+    queue = Queue()
+    process = Process(target=_measure, args=(queue, func, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main_benchmark():
+    columns = int(argv[1]) if len(argv) > 1 else 2000
+    rows = int(argv[2]) if len(argv) > 2 else 100000
+    jobs = int(argv[3]) if len(argv) > 3 else 0
+
+    directory = mkdtemp()
+    try:
+        check_same_output(directory)
+
+        print >> stderr, "Writing a %d columns and %d rows file..." % (columns, rows)
+        # In another process too, so the measured processes don't start with its memory usage
+        measure(write_synthetic_file, path.join(directory, 'utimes.txt'), columns, rows)
+        print "%d columns, %d rows, %.1f MB" % (columns, rows, path.getsize(path.join(directory, 'utimes.txt')) / 1048576.0)
+
+        print "%-22s %10s %15s" % ("", "seconds", "peak memory MB")
+        for name, func, outputfile in (("previous reduce()", reduce_previous, 'utimes_previous.txt'),
+                                       ("streaming reduce()", reduce, 'utimes_reduced.txt')):
+            print "%-22s %10.1f %15.1f" % ((name,) + measure(func, directory, NRLINES, 'utimes.txt', outputfile))
+
+        if not cmp(path.join(directory, 'utimes_previous.txt'), path.join(directory, 'utimes_reduced.txt'), shallow=False):
+            print "ERROR: the reduced files are different!"
+
+        if jobs:
+            # main() reduces all of these if they exist
+            for name in ('stimes', 'wchars', 'rchars', 'writebytes', 'readbytes', 'vsizes'):
+                link(path.join(directory, 'utimes.txt'), path.join(directory, name + '.txt'))
+
+            for nr_jobs in sorted(set([1, jobs])):
+                print "%-22s %10.1f %15.1f" % (("main() 7 files, %d jobs" % nr_jobs,) + measure(main, directory, NRLINES, nr_jobs))
+    finally:
+        rmtree(directory)
+
+if __name__ == "__main__":
+    main_benchmark()
+
+#
+# benchmark_reduce_dispersy_statistics.py ends here
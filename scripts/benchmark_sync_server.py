@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# benchmark_sync_server.py ---
+#
+# Filename: benchmark_sync_server.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 00:12:40 2026 (+0200)
+
+# Commentary:
+#
+# Load test of the experiment sync server (gumby/sync.py): runs the server and thousands of
+# simulated ExperimentClient instances connecting to it over the loopback interface in the same
+# process, optionally through relays, and measures:
+#
+# * time_to_all_ready: From the first connection to the server having all the subscribers ready.
+# * push_seconds: Time the server spent building and queueing the vars documents.
+# * vars_delivery_seconds: From all of them being ready to the last one getting its document.
+# * server_bytes_sent: Bytes sent by the server (to the relays, if any).
+# * bytes_received: Bytes received by all the instances.
+# * go_latency: From the server sending the go signal to the last instance getting it.
+# * go_spread: Between the first and last instance getting the go signal.
+#
+# Every amount of subscribers is run in its own process, the results are printed as a table and
+# can be written as a JSON list to keep track of them.
+#
+# Usage: benchmark_sync_server.py [options] <subscribers> [<subscribers> ...]
+#
+# IE: benchmark_sync_server.py --relays 20 -o sync.json 1000 2000 5000
+#
+# Every connection needs two file descriptors, up to the hard RLIMIT_NOFILE limit.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from optparse import OptionParser
+from resource import getrlimit, setrlimit, RLIMIT_NOFILE
+from subprocess import Popen, PIPE
+from sys import argv, executable, exit, stdout
+from time import time
+import json
+
+from gumby.sync import (ExperimentClient, ExperimentClientFactory, ExperimentRelayClient, ExperimentRelayClientFactory,
+                        ExperimentRelayFactory, ExperimentServiceFactory)
+
+from twisted.internet import reactor
+from twisted.python.log import startLogging
+
+# Stop waiting if the run takes longer than this many seconds
+RUN_TIMEOUT = 600
+LISTEN_BACKLOG = 4096
+
+
+class LoadTest(object):
+
+    def __init__(self, subscribers, relays, nr_vars, encoding, subscription):
+        self.subscribers = subscribers
+        self.relays = relays
+        self.nr_vars = nr_vars
+        self.encoding = encoding
+        self.subscription = subscription
+
+        self.start = None
+        self.all_ready = None
+        self.pushed = None
+        self.go_sent = None
+        self.vars_received = []
+        self.go_received = []
+        self.server_bytes_sent = 0
+        self.bytes_received = 0
+
+    def run(self):
+        server = BenchmarkServiceFactory(self)
+        port = reactor.listenTCP(0, server, interface='127.0.0.1', backlog=LISTEN_BACKLOG).getHost().port
+
+        # Every subscriber connects to the server or to one of the relays
+        ports = []
+        if self.relays:
+            for relay in xrange(self.relays):
+                relay_subscribers = self.subscribers // self.relays + (1 if relay < self.subscribers % self.relays else 0)
+                factory = BenchmarkRelayFactory(self, relay_subscribers, '127.0.0.1', port)
+                relay_port = reactor.listenTCP(0, factory, interface='127.0.0.1', backlog=LISTEN_BACKLOG).getHost().port
+                ports.extend([relay_port] * relay_subscribers)
+        else:
+            ports = [port] * self.subscribers
+
+        reactor.callWhenRunning(self.connect, ports)
+        reactor.callLater(RUN_TIMEOUT, reactor.stop)
+        reactor.run()
+        return self.get_results()
+
+    def connect(self, ports):
+        self.start = time()
+        for subscriber, port in enumerate(ports):
+            vars = dict(('var%d' % var, 'value%d_%d' % (var, subscriber)) for var in xrange(self.nr_vars))
+            reactor.connectTCP('127.0.0.1', port, SimulatedClientFactory(self, vars))
+
+    def on_go_received(self):
+        self.go_received.append(time())
+        if len(self.go_received) == self.subscribers:
+            reactor.callLater(0, reactor.stop)
+
+    def get_results(self):
+        results = {'subscribers': self.subscribers,
+                   'relays': self.relays,
+                   'vars': self.nr_vars,
+                   'encoding': self.encoding or 'json',
+                   'subscription': self.subscription,
+                   'server_bytes_sent': self.server_bytes_sent,
+                   'bytes_received': self.bytes_received,
+                   'timed_out': len(self.go_received) < self.subscribers}
+
+        if self.all_ready:
+            results['time_to_all_ready'] = self.all_ready - self.start
+            results['push_seconds'] = self.pushed - self.all_ready
+        if len(self.vars_received) == self.subscribers:
+            results['vars_delivery_seconds'] = max(self.vars_received) - self.all_ready
+        if not results['timed_out']:
+            results['go_latency'] = max(self.go_received) - self.go_sent
+            results['go_spread'] = max(self.go_received) - min(self.go_received)
+        return results
+
+
+class BenchmarkServiceFactory(ExperimentServiceFactory):
+
+    def __init__(self, load_test):
+        ExperimentServiceFactory.__init__(self, load_test.subscribers, 0.1, stop_when_started=False)
+        self.load_test = load_test
+
+    def onAllSubscribersReady(self):
+        self.load_test.all_ready = time()
+        ExperimentServiceFactory.onAllSubscribersReady(self)
+        self.load_test.pushed = time()
+
+    def startExperiment(self):
+        self.load_test.go_sent = time()
+        ExperimentServiceFactory.startExperiment(self)
+
+
+class BenchmarkRelayClient(ExperimentRelayClient):
+
+    def dataReceived(self, data):
+        self.relay.load_test.server_bytes_sent += len(data)
+        ExperimentRelayClient.dataReceived(self, data)
+
+
+class BenchmarkRelayFactory(ExperimentRelayFactory):
+
+    def __init__(self, load_test, expected_subscribers, upstream_host, upstream_port):
+        ExperimentRelayFactory.__init__(self, expected_subscribers, upstream_host, upstream_port, stop_when_started=False)
+        self.load_test = load_test
+
+    def onAllSubscribersReady(self):
+        factory = ExperimentRelayClientFactory(self)
+        factory.protocol = BenchmarkRelayClient
+        reactor.connectTCP(self.upstream_host, self.upstream_port, factory)
+
+
+class SimulatedClient(ExperimentClient):
+
+    def __init__(self, vars):
+        ExperimentClient.__init__(self, vars)
+        self.load_test = None
+
+    def dataReceived(self, data):
+        self.load_test.bytes_received += len(data)
+        if not self.load_test.relays:
+            self.load_test.server_bytes_sent += len(data)
+        ExperimentClient.dataReceived(self, data)
+
+    def onAllVarsReceived(self):
+        self.load_test.vars_received.append(time())
+
+    def startExperiment(self):
+        self.load_test.on_go_received()
+
+
+class SimulatedClientFactory(ExperimentClientFactory):
+
+    def __init__(self, load_test, vars):
+        ExperimentClientFactory.__init__(self, vars, SimulatedClient)
+        self.load_test = load_test
+
+    def buildProtocol(self, address):
+        p = ExperimentClientFactory.buildProtocol(self, address)
+        p.load_test = self.load_test
+        p.encoding = self.load_test.encoding
+        if self.load_test.subscription:
+            p.subscribed_keys, p.subscribed_peers = self.load_test.subscription.split(':')
+            p.subscribed_keys = None if p.subscribed_keys == '*' else p.subscribed_keys.split(',')
+            p.subscribed_peers = None if p.subscribed_peers == '*' else p.subscribed_peers
+        return p
+
+
+def print_results(results):
+    columns = ('subscribers', 'time_to_all_ready', 'push_seconds', 'vars_delivery_seconds', 'server_bytes_sent', 'bytes_received', 'go_latency', 'go_spread')
+    print "%11s %17s %12s %21s %17s %14s %10s %9s" % columns
+    for result in results:
+        if 'failed' in result:
+            print "%11d failed with exit code %d" % (result['subscribers'], result['failed'])
+            continue
+        print "%11d %17s %12s %21s %17d %14d %10s %9s%s" % (
+            result['subscribers'],
+            "%.3f" % result['time_to_all_ready'] if 'time_to_all_ready' in result else "n/a",
+            "%.3f" % result['push_seconds'] if 'push_seconds' in result else "n/a",
+            "%.3f" % result['vars_delivery_seconds'] if 'vars_delivery_seconds' in result else "n/a",
+            result['server_bytes_sent'], result['bytes_received'],
+            "%.3f" % result['go_latency'] if 'go_latency' in result else "n/a",
+            "%.3f" % result['go_spread'] if 'go_spread' in result else "n/a",
+            " (timed out)" if result['timed_out'] else "")
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] <subscribers> [<subscribers> ...]")
+    parser.add_option("-r", "--relays",
+                      default=0,
+                      type=int,
+                      help="Connect the subscribers through this many relays (default: %default)"
+                      )
+    parser.add_option("--vars",
+                      default=1,
+                      type=int,
+                      help="Amount of vars set by every subscriber (default: %default)"
+                      )
+    parser.add_option("--json",
+                      action='store_true',
+                      help="Get the vars as a JSON line instead of the compact encoding"
+                      )
+    parser.add_option("--subscribe",
+                      metavar='KEYS:PEERS',
+                      help="Only get these vars, IE: host,port:1-10 (see gumby/sync.py)"
+                      )
+    parser.add_option("-o", "--output",
+                      metavar='FILE',
+                      help="Write the results to FILE as a JSON list"
+                      )
+    parser.add_option("-v", "--verbose",
+                      action='store_true',
+                      help="Print the log of the server and the subscribers"
+                      )
+    parser.add_option("--single",
+                      action='store_true',
+                      help="Run a single amount of subscribers in this process and print its results as JSON"
+                      )
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.print_usage()
+        exit(1)
+
+    if options.single:
+        _, hard_limit = getrlimit(RLIMIT_NOFILE)
+        setrlimit(RLIMIT_NOFILE, (hard_limit, hard_limit))
+        if options.verbose:
+            startLogging(stdout)
+
+        load_test = LoadTest(int(args[0]), options.relays, options.vars, None if options.json else ExperimentClient.encoding,
+                             options.subscribe)
+        print json.dumps(load_test.run())
+        return
+
+    child_args = [executable, argv[0], '--single', '--relays', str(options.relays), '--vars', str(options.vars)]
+    if options.json:
+        child_args.append('--json')
+    if options.subscribe:
+        child_args.extend(('--subscribe', options.subscribe))
+    if options.verbose:
+        child_args.append('--verbose')
+
+    results = []
+    for subscribers in args:
+        # A reactor can only run once
+        child = Popen(child_args + [subscribers], stdout=PIPE)
+        output = child.communicate()[0]
+        if child.returncode:
+            # IE: killed when running out of memory
+            results.append({'subscribers': int(subscribers), 'failed': child.returncode})
+        else:
+            results.append(json.loads(output.splitlines()[-1]))
+
+    print_results(results)
+    if options.output:
+        fp = open(options.output, 'w')
+        json.dump(results, fp, indent=2, separators=(',', ': '), sort_keys=True)
+        fp.close()
+
+if __name__ == '__main__':
+    main()
+
+#
+# benchmark_sync_server.py ends here
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# compile_scenario.py ---
+#
+# Filename: compile_scenario.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 10:12:40 2026 (+0200)
+
+# Commentary:
+#
+# Parses a scenario file once for all the peers and writes an index with the events of every one
+# of them next to it (<scenario file>.idx), which ScenarioRunner uses instead of parsing the whole
+# scenario while it's up to date. See compile_scenario() in gumby/scenario.py.
+#
+# Usage: compile_scenario.py <scenario file> [<scenario file> ...]
+#
+# The $VARIABLES of the scenario are replaced with their values in the environment now, so it
+# should run with the experiment config loaded (tribler_experiment_setup.sh does it).
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from sys import argv, exit, stderr
+
+from gumby.scenario import compile_scenario, get_scenario_index_path
+
+
+def main():
+    if len(argv) < 2:
+        print >> stderr, "Usage: %s <scenario file> [<scenario file> ...]" % argv[0]
+        exit(1)
+
+    for scenario_file_path in argv[1:]:
+        events, peerspecs = compile_scenario(scenario_file_path)
+        print "Compiled %d events of %s with %d distinct peer specs into %s" % (
+            events, scenario_file_path, peerspecs, get_scenario_index_path(scenario_file_path))
+
+if __name__ == "__main__":
+    main()
+
+#
+# compile_scenario.py ends here
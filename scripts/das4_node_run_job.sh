@@ -53,10 +53,64 @@ for INSTANCE in $(seq 1 1 $DAS4_PROCESSES_PER_NODE); do
     echo "$DAS4_NODE_COMMAND" >> $CMDFILE
 done
 
-process_guard.py -f $CMDFILE -t $DAS4_NODE_TIMEOUT -o $OUTPUT_DIR -m $OUTPUT_DIR  -i 5 2>&1 | tee process_guard.log ||:
+# @CONF_OPTION PROCESS_GUARD_MONITOR_FORMAT: Format of the resource usage logs, text (default, raw /proc lines) or binary (compact records, needs numpy to be parsed).
+if [ -z "$PROCESS_GUARD_MONITOR_FORMAT" ]; then
+    PROCESS_GUARD_MONITOR_FORMAT=text
+fi
+
+# @CONF_OPTION PROCESS_GUARD_MONITOR_THREADS: Also sample the CPU usage of every thread of the instances, true or false (default).
+if [ "$PROCESS_GUARD_MONITOR_THREADS" == "true" ]; then
+    PROCESS_GUARD_ARGS="--threads"
+fi
+
+# @CONF_OPTION PROCESS_GUARD_MEMORY_INTERVAL: Sample the RSS, PSS and USS of every process once every this many seconds (default: 0, disabled). Reading smaps is expensive, keep it a multiple of the 5 seconds sampling interval.
+if [ -n "$PROCESS_GUARD_MEMORY_INTERVAL" ]; then
+    PROCESS_GUARD_ARGS="$PROCESS_GUARD_ARGS --memory-interval $PROCESS_GUARD_MEMORY_INTERVAL"
+fi
+
+# @CONF_OPTION PROCESS_GUARD_CGROUPS: Run every instance in its own cgroup (needs cgroup v2) so all its processes are monitored and its resource usage is accounted, true or false (default).
+if [ "$PROCESS_GUARD_CGROUPS" == "true" ]; then
+    PROCESS_GUARD_ARGS="$PROCESS_GUARD_ARGS --cgroups"
+fi
+
+# @CONF_OPTION PROCESS_GUARD_CGROUP_LIMITS: Space separated cgroup FILE=VALUE settings applied to every instance, IE: "memory.max=2G pids.max=200" (needs PROCESS_GUARD_CGROUPS).
+for LIMIT in $PROCESS_GUARD_CGROUP_LIMITS; do
+    PROCESS_GUARD_ARGS="$PROCESS_GUARD_ARGS --cgroup-limit $LIMIT"
+done
+
+# @CONF_OPTION SYNC_RELAY: Register the instances of every node with the experiment server through a relay running on the node, so the server only talks to one connection per node, true or false (default). Recommended for experiments with thousands of instances.
+if [ "$SYNC_RELAY" == "true" ]; then
+    SYNC_RELAY_PORT_FILE=$(mktemp --tmpdir=/local/$USER/ sync_relay_port_XXXXXXXXXXXXX_$USER)
+    rm $SYNC_RELAY_PORT_FILE
+    experiment_relay.py $DAS4_PROCESSES_PER_NODE $SYNC_RELAY_PORT_FILE > sync_relay.log 2>&1 &
+    SYNC_RELAY_PID=$!
+    while [ ! -e $SYNC_RELAY_PORT_FILE ]; do
+        if ! kill -0 $SYNC_RELAY_PID 2>/dev/null; then
+            echo "The sync relay failed to start:"
+            cat sync_relay.log
+            exit 1
+        fi
+        sleep 0.1
+    done
+    export SYNC_HOST=127.0.0.1
+    export SYNC_PORT=$(cat $SYNC_RELAY_PORT_FILE)
+    rm $SYNC_RELAY_PORT_FILE
+fi
+
+process_guard.py -f $CMDFILE -t $DAS4_NODE_TIMEOUT -o $OUTPUT_DIR -m $OUTPUT_DIR  -i 5 --monitor-format $PROCESS_GUARD_MONITOR_FORMAT $PROCESS_GUARD_ARGS 2>&1 | tee process_guard.log ||:
 
 rm $CMDFILE
 
+if [ -n "$SYNC_RELAY_PID" ]; then
+    # It exits by itself after the go signal, unless the experiment never started
+    kill $SYNC_RELAY_PID 2>/dev/null ||:
+fi
+
+# @CONF_OPTION DAS4_NODE_PRE_PROCESS_CMD: Command run in the output dir of every node once its instances are done, to process and reduce their output before sending it to the head node (IE: pre_process_dispersy_experiment.sh).
+if [ -n "$DAS4_NODE_PRE_PROCESS_CMD" ]; then
+    $DAS4_NODE_PRE_PROCESS_CMD 2>&1 | tee pre_process.log ||:
+fi
+
 # Now, lets send the generated data back to the head node
 
 rsync -a --delete-before --exclude="sqlite/" "$OUTPUT_DIR/" "$OUTPUT_DIR_URI/$(hostname)/" 2>&1
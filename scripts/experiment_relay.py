@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# experiment_relay.py ---
+#
+# Filename: experiment_relay.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 23:02:17 2026 (+0200)
+
+# Commentary:
+#
+# Experiment sync relay, runs on every node so the instances of the node register with the
+# experiment server (experiment_server.py on the head node) through a single connection, see
+# ExperimentRelayFactory in gumby/sync.py.
+#
+# Usage: experiment_relay.py <expected local instances> <port file>
+#
+# It connects to the experiment server at HEAD_NODE:SYNC_PORT and listens on a free port, which is
+# written to the port file once it is listening. The instances should connect to it instead of
+# the server (das4_node_run_job.sh sets SYNC_HOST and SYNC_PORT for them).
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import environ, rename
+from sys import argv, exit, stdout
+
+from gumby.sync import ExperimentRelayFactory
+
+from twisted.internet import reactor
+from twisted.python.log import startLogging
+
+
+if __name__ == '__main__':
+    if len(argv) != 3:
+        print >> stdout, "Usage: %s <expected local instances> <port file>" % argv[0]
+        exit(1)
+
+    startLogging(stdout)
+    expected_subscribers = int(argv[1])
+    port_filename = argv[2]
+
+    factory = ExperimentRelayFactory(expected_subscribers, environ['HEAD_NODE'], int(environ['SYNC_PORT']))
+    port = reactor.listenTCP(0, factory).getHost().port
+
+    # Written atomically so whoever is waiting for it doesn't read it half way
+    fp = open(port_filename + '.tmp', 'w')
+    print >> fp, port
+    fp.close()
+    rename(port_filename + '.tmp', port_filename)
+
+    reactor.exitCode = 0
+    reactor.run()
+    exit(reactor.exitCode)
+
+#
+# experiment_relay.py ends here
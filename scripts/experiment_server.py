@@ -32,6 +32,21 @@
 # <- {"0": {"host": "127.0.0.1", "time_offset": -0.94, "port": 12000, "asdf": "ooooo"}, "1": {"host": "127.0.0.1", "time_offset": "-1378479680.61", "port": 12001, "asdf": "ooooo"}, "2": {"host": "127.0.0.1", "time_offset": "-1378479682.26", "port": 12002, "asdf": "ooooo"}}
 # <- go
 # [Connection is closed by the server]
+#
+# Clients sending encoding:columnar-zlib get the document compressed and length prefixed instead,
+# and the ones sending clock:ping get their clock offset estimated with several ping rounds and
+# the time the experiment starts at (see gumby/sync.py). Clients sending persistent stay connected
+# during the experiment to use named barriers and share values, and the server keeps running until
+# they have all disconnected.
+#
+# If LIVE_STATISTICS_PORT is set, the live statistics aggregation service from gumby.stats will
+# listen on it too and the server will keep running until all the instances have disconnected
+# from it. Once the sync server is done (the persistent clients are gone, or the experiment
+# started if there are none), it stops waiting for the instances that never connected to it.
+# The aggregates are written to LIVE_STATISTICS_FILE (defaults to $OUTPUT_DIR/live_statistics.txt).
+#
+# With thousands of instances, run experiment_relay.py on every node (SYNC_RELAY in
+# das4_node_run_job.sh) so the server only has to talk to one connection per node.
 
 
 # Change Log:
@@ -58,10 +73,11 @@
 
 # Code:
 
-from os import environ
+from os import environ, path
 from sys import stdout
 
 from gumby.sync import ExperimentServiceFactory
+from gumby.stats import StatisticsServiceFactory
 
 from twisted.internet import reactor
 from twisted.python.log import startLogging
@@ -72,8 +88,17 @@ if __name__ == '__main__':
     expected_subscribers = int(environ['SYNC_SUBSCRIBERS_AMOUNT'])
     experiment_start_delay = float(environ['SYNC_EXPERIMENT_START_DELAY'])
     server_port = int(environ['SYNC_PORT'])
+    statistics_port = environ.get('LIVE_STATISTICS_PORT')
+
+    sync_factory = ExperimentServiceFactory(expected_subscribers, experiment_start_delay, not statistics_port)
+    if statistics_port:
+        statistics_file = environ.get('LIVE_STATISTICS_FILE', path.join(environ.get('OUTPUT_DIR', '.'), 'live_statistics.txt'))
+        statistics_factory = StatisticsServiceFactory(expected_subscribers, statistics_file)
+        # The instances that crashed before connecting to the statistics service are gone by then
+        sync_factory.finished.addCallback(statistics_factory.stopWaiting)
+        reactor.listenTCP(int(statistics_port), statistics_factory)
 
-    reactor.listenTCP(server_port, ExperimentServiceFactory(expected_subscribers, experiment_start_delay))
+    reactor.listenTCP(server_port, sync_factory)
     reactor.run()
 
 #
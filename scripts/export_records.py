@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+import sys
+import os
+
+from gumby.records import BINARY_EXTENSION, export_to_text
+
+
+def main(input_directory):
+    for filename in sorted(os.listdir(input_directory)):
+        if filename.endswith(BINARY_EXTENSION):
+            print >> sys.stderr, "Exporting", filename
+            export_to_text(os.path.join(input_directory, filename))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "Usage: %s <peers-directory>" % (sys.argv[0])
+        print >> sys.stderr, sys.argv
+
+        exit(1)
+
+    main(sys.argv[1])
@@ -4,174 +4,612 @@ import os
 from sys import argv, exit
 
 import json
-
-
-def write_records(all_nodes, sum_records, output_directory, outputfile, diffoutputfile=None):
-    if len(sum_records) > 0:
-        all_nodes.sort()
+import numpy
+
+# Columns of a resource_usage.log line: the timestamp, the /proc/<pid>/stat fields and the
+# /proc/<pid>/io values (rchar, wchar, syscr, syscw, read_bytes, write_bytes, cancelled_write_bytes)
+TIME_COLUMN = 0
+COMM_COLUMN = 2
+COUNTER_COLUMNS = (1, 14, 15, 23, -7, -6, -3, -2)
+PID, UTIME, STIME, VSIZE, RCHAR, WCHAR, READ_BYTES, WRITE_BYTES = range(len(COUNTER_COLUMNS))
+# The fields of the resource_usage.rec records (written by process_guard.py --monitor-format binary) matching them
+COUNTER_FIELDS = ('pid', 'utime', 'stime', 'vsize', 'rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+# Size hint (in bytes) of the blocks of lines parsed at once
+READ_CHUNK_SIZE = 16 * 1024 ** 2
+# Amount of rows written at once
+WRITE_BLOCK_SIZE = 4096
+# Holds the per node parts of the parsing when it is done on the node (see save_partial)
+PARTIAL_FILENAME = 'process_guard_partial.npz'
+
+
+def parse_columns(lines):
+    """
+    Returns the times and the counters of a list of resource_usage.log lines as arrays.
+    """
+    nr_fields = len(lines[0].split())
+    tokens = ''.join(lines).split()
+
+    # All the lines have the same amount of fields unless a process has spaces in its name, if
+    # that's the case fall back to splitting the lines one by one.
+    if len(tokens) == len(lines) * nr_fields and all(comm[-1] == ')' for comm in tokens[COMM_COLUMN::nr_fields]):
+        def get_column(column):
+            return tokens[column % nr_fields::nr_fields]
+    else:
+        rows = [line.split() for line in lines]
+
+        def get_column(column):
+            return [parts[column] for parts in rows]
+
+    times = numpy.fromstring(' '.join(get_column(TIME_COLUMN)), sep=' ')
+    counters = numpy.empty((len(lines), len(COUNTER_COLUMNS)), dtype=numpy.int64)
+    for index, column in enumerate(COUNTER_COLUMNS):
+        counters[:, index] = numpy.fromstring(' '.join(get_column(column)), dtype=numpy.int64, sep=' ')
+    return times, counters
+
+
+def load_resource_file(filename):
+    """
+    Returns the sc_clk_tck, times and counters of all the samples of a resource_usage.log file.
+    """
+    h_records = open(filename)
+
+    line = h_records.readline()
+    metainfo = json.loads(line)
+    sc_clk_tck = float(metainfo['sc_clk_tck'])
+
+    all_times = []
+    all_counters = []
+    while True:
+        lines = [line for line in h_records.readlines(READ_CHUNK_SIZE) if line.strip()]
+        if not lines:
+            break
+
+        times, counters = parse_columns(lines)
+        all_times.append(times)
+        all_counters.append(counters)
+    h_records.close()
+
+    if not all_times:
+        return sc_clk_tck, numpy.empty(0), numpy.empty((0, len(COUNTER_COLUMNS)), dtype=numpy.int64)
+    return sc_clk_tck, numpy.concatenate(all_times), numpy.concatenate(all_counters)
+
+
+def load_binary_resource_file(filename):
+    """
+    Like load_resource_file() for the fixed width records of a resource_usage.rec file.
+    """
+    h_records = open(filename, 'rb')
+    line = h_records.readline()
+    h_records.close()
+
+    metainfo = json.loads(line)
+    sc_clk_tck = float(metainfo['sc_clk_tck'])
+    dtype = numpy.dtype([(str(field), '<f8' if field == 'timestamp' else '<u8') for field in metainfo['fields']])
+
+    # Ignore the last record if process_guard got killed while writing it
+    nr_records = (os.path.getsize(filename) - len(line)) // dtype.itemsize
+    if not nr_records:
+        return sc_clk_tck, numpy.empty(0), numpy.empty((0, len(COUNTER_COLUMNS)), dtype=numpy.int64)
+
+    records = numpy.memmap(filename, dtype=dtype, mode='r', offset=len(line), shape=(nr_records,))
+    times = numpy.array(records['timestamp'], dtype=numpy.float64)
+    counters = numpy.empty((nr_records, len(COUNTER_COLUMNS)), dtype=numpy.int64)
+    for index, field in enumerate(COUNTER_FIELDS):
+        counters[:, index] = records[field]
+    return sc_clk_tck, times, counters
+
+
+def load_thread_file(filename):
+    """
+    Returns the sc_clk_tck, times, (pid, tid, utime, stime) counters and thread names of all the
+    samples of a thread_usage.log file (written by process_guard.py --threads).
+    """
+    h_records = open(filename)
+
+    line = h_records.readline()
+    metainfo = json.loads(line)
+    sc_clk_tck = float(metainfo['sc_clk_tck'])
+
+    # The thread name is the last field and can contain spaces
+    samples = [line.split(None, 5) for line in h_records if line.strip()]
+    h_records.close()
+
+    times = numpy.array([float(sample[0]) for sample in samples])
+    counters = numpy.array([[int(value) for value in sample[1:5]] for sample in samples], dtype=numpy.int64).reshape(-1, 4)
+    names = [sample[5].strip() if len(sample) > 5 else '' for sample in samples]
+    return sc_clk_tck, times, counters, names
+
+
+def load_cgroup_file(filename):
+    """
+    Returns the times and (command, usage_usec, user_usec, system_usec, memory, rbytes, wbytes, rios,
+    wios, pids) counters of all the samples of a cgroup_usage.log file (written by process_guard.py --cgroups).
+    """
+    h_records = open(filename)
+    h_records.readline()  # The metainfo
+
+    samples = numpy.loadtxt(h_records, ndmin=2)
+    h_records.close()
+    return samples[:, 0], samples[:, 1:].astype(numpy.int64)
+
+
+def load_memory_file(filename):
+    """
+    Returns the metainfo, times and (pid, rss, pss, uss) values of all the samples of a
+    memory_usage.log file (written by process_guard.py --memory-interval).
+    """
+    h_records = open(filename)
+    metainfo = json.loads(h_records.readline())
+
+    samples = numpy.loadtxt(h_records, ndmin=2)
+    h_records.close()
+    return metainfo, samples[:, 0], samples[:, 1:].astype(numpy.int64)
+
+
+def get_previous_samples(pids):
+    """
+    Returns the index of the previous sample of the same pid for every sample, or the index of the
+    sample itself for the first one of a pid.
+    """
+    order = numpy.argsort(pids, kind='mergesort')
+    previous = numpy.empty_like(order)
+    previous[1:] = order[:-1]
+    previous[0] = order[0]
+
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = pids[order[1:]] != pids[order[:-1]]
+    previous[first] = order[first]
+
+    previous_samples = numpy.empty_like(order)
+    previous_samples[order] = previous
+    return previous_samples
+
+
+def calc_rates(times, values, previous_samples):
+    # Change per second since the previous sample, 0 for the first sample of a pid
+    diffs = (values - values[previous_samples]).astype(numpy.float64)
+    diffs_in_log = times - times[previous_samples]
+
+    has_diff = diffs_in_log != 0
+    return numpy.where(has_diff, diffs / numpy.where(has_diff, diffs_in_log, 1), 0.0)
+
+
+def write_records(all_nodes, times, rows, columns, values, output_directory, outputfile):
+    """
+    Writes a record file with a column for each node and a row for each of times, values[i] goes
+    into row rows[i] and column columns[i]. Empty cells get the previous value of their column.
+    """
+    if len(values) > 0:
+        # If a cell got more than one value keep the last one, this also sorts them by row
+        cells = rows * len(all_nodes) + columns
+        _, last = numpy.unique(cells[::-1], return_index=True)
+        keep = len(cells) - 1 - last
+        rows, columns, values = rows[keep], columns[keep], values[keep]
 
         fp = open(os.path.join(output_directory, outputfile), 'wb')
-        fp2 = open(os.path.join(output_directory, diffoutputfile), 'wb') if diffoutputfile else None
-
         print >> fp, 'time', ' '.join(all_nodes)
-        if fp2:
-            print >> fp2, 'time', ' '.join(all_nodes)
-
-        prev_records = {}
-        for time in sorted(sum_records.iterkeys()):
-            print >> fp, time,
-            if fp2:
-                print >> fp2, time,
 
-            nodes = sum_records[time]
-            for node in all_nodes:
-                value = nodes.get(node, prev_records.get(node, 0))
-                print >> fp, value,
+        # Columns without a value yet are written as 0
+        prev_records = numpy.empty(len(all_nodes))
+        prev_records.fill(numpy.nan)
+        column_indexes = numpy.arange(len(all_nodes))
 
-                if fp2:
-                    diff = value - prev_records.get(node, 0)
-                    print >> fp2, diff,
+        bounds = numpy.searchsorted(rows, numpy.arange(0, len(times) + WRITE_BLOCK_SIZE, WRITE_BLOCK_SIZE))
+        for block_nr, block_start in enumerate(xrange(0, len(times), WRITE_BLOCK_SIZE)):
+            block_times = times[block_start:block_start + WRITE_BLOCK_SIZE]
+            block_slice = slice(bounds[block_nr], bounds[block_nr + 1])
 
-                prev_records[node] = value
-            print >> fp, ''
-            if fp2:
-                print >> fp2, ''
-
-        fp.close()
-        if fp2:
-            fp2.close()
+            block = numpy.empty((len(block_times), len(all_nodes)))
+            block.fill(numpy.nan)
+            block[rows[block_slice] - block_start, columns[block_slice]] = values[block_slice]
 
+            # forward fill the empty cells with the last value of their column
+            last_row = numpy.where(numpy.isnan(block), -1, numpy.arange(len(block_times))[:, numpy.newaxis])
+            last_row = numpy.maximum.accumulate(last_row, axis=0)
+            block = numpy.where(last_row >= 0, block[last_row, column_indexes], prev_records)
+            prev_records = block[-1]
 
-def parse_resource_files(input_directory, output_directory, start_timestamp):
-    def calc_diff(curtime, prevtime, curvalue, prevvalue):
-        diff = curvalue - prevvalue
-        diff_in_log = curtime - prevtime
+            for time, row in zip(block_times.tolist(), block.tolist()):
+                line = ' '.join(map(str, row))
+                if 'nan' in line:
+                    line = ' '.join('0' if value != value else str(value) for value in row)
+                print >> fp, time, line, ''
 
-        if diff_in_log:
-            return float(diff) / diff_in_log
-        return 0
-
-    all_pids = set()
-    all_nodes = []
+        fp.close()
 
-    stimes = {}
-    utimes = {}
-    vsizes = {}
-    rchars = {}
-    wchars = {}
-    readbytes = {}
-    writebytes = {}
-
-    prev_stimes = {}
-    prev_utimes = {}
-    prev_wchar = {}
-    prev_rchar = {}
-    prev_writebytes = {}
-    prev_readbytes = {}
-    prev_times = {}
 
+def get_resource_usage(root, files):
+    """
+    Returns the per node part of parse_resource_files for the resource usage file in root: the times,
+    the pids, the index of the pid and the values of every sample.
+    """
     filename = 'resource_usage.log'
-    for root, dirs, files in os.walk(input_directory):
-        if filename in files:
-            print >> sys.stderr, "Parsing resource_usage file %s" % filename
-            nodename = root.split('/')[-1]
-            all_nodes.append(nodename)
-
-            fn_records = os.path.join(root, filename)
-            h_records = open(fn_records)
-
-            line = h_records.readline()
-            metainfo = json.loads(line)
-            sc_clk_tck = float(metainfo['sc_clk_tck'])
-
-            for line in h_records:
-                parts = line.split()
+    binary_filename = 'resource_usage.rec'
+    if binary_filename in files:
+        print >> sys.stderr, "Parsing resource_usage file %s" % binary_filename
+        sc_clk_tck, times, counters = load_binary_resource_file(os.path.join(root, binary_filename))
+    elif filename in files:
+        print >> sys.stderr, "Parsing resource_usage file %s" % filename
+        sc_clk_tck, times, counters = load_resource_file(os.path.join(root, filename))
+    else:
+        return None
 
-                time = float(parts[0]) - start_timestamp
-                pid = nodename + "_" + parts[1]
+    pids = counters[:, PID]
+    previous_samples = get_previous_samples(pids)
 
-                if pid not in all_pids:
-                    all_pids.add(pid)
+    values = numpy.empty((len(times), 7))
+    values[:, 0] = calc_rates(times, counters[:, UTIME], previous_samples) / sc_clk_tck
+    values[:, 1] = calc_rates(times, counters[:, STIME], previous_samples) / sc_clk_tck
+    values[:, 2] = calc_rates(times, counters[:, WCHAR], previous_samples) / 1024.0
+    values[:, 3] = calc_rates(times, counters[:, RCHAR], previous_samples) / 1024.0
+    values[:, 4] = calc_rates(times, counters[:, WRITE_BYTES], previous_samples) / 1024.0
+    values[:, 5] = calc_rates(times, counters[:, READ_BYTES], previous_samples) / 1024.0
+    values[:, 6] = counters[:, VSIZE] / 1048576.0
 
-                utime = long(parts[14])
-                stime = long(parts[15])
+    unique_pids, pid_indexes = numpy.unique(pids, return_inverse=True)
+    return {'resource_times': times, 'resource_pids': unique_pids, 'resource_indexes': pid_indexes, 'resource_values': values}
 
-                utimes.setdefault(time, {})[pid] = calc_diff(time, prev_times.get(pid, time), utime, prev_utimes.get(pid, utime)) / sc_clk_tck
-                stimes.setdefault(time, {})[pid] = calc_diff(time, prev_times.get(pid, time), stime, prev_stimes.get(pid, stime)) / sc_clk_tck
-                utimes[time].setdefault(nodename, []).append(utimes[time][pid])
-                stimes[time].setdefault(nodename, []).append(stimes[time][pid])
 
-                vsize = long(parts[23])
-                vsizes.setdefault(time, {})[pid] = vsize / 1048576.0
-                vsizes[time].setdefault(nodename, []).append(vsizes[time][pid])
+def parse_resource_files(node_parts, output_directory, start_timestamp):
+    all_nodes = []
 
-                # rss = long(parts[24])
-                # delay_io_ticks = long(parts[41])
-                write_bytes = long(parts[-2])
-                read_bytes = long(parts[-3])
+    node_times = []
+    node_pids = []
+    node_values = []
 
-                readbytes.setdefault(time, {})[pid] = calc_diff(time, prev_times.get(pid, time), read_bytes, prev_readbytes.get(pid, read_bytes)) / 1024.0
-                writebytes.setdefault(time, {})[pid] = calc_diff(time, prev_times.get(pid, time), write_bytes, prev_writebytes.get(pid, write_bytes)) / 1024.0
-                readbytes[time].setdefault(nodename, []).append(readbytes[time][pid])
-                writebytes[time].setdefault(nodename, []).append(writebytes[time][pid])
+    for nodename, parts in node_parts:
+        if 'resource_times' in parts:
+            all_nodes.append(nodename)
 
-                # syscw = long(parts[-4])
-                # syscr = long(parts[-5])
+            node_times.append(parts['resource_times'] - start_timestamp)
+            node_pids.append((["%s_%d" % (nodename, pid) for pid in parts['resource_pids'].tolist()], parts['resource_indexes']))
+            node_values.append(parts['resource_values'])
 
-                wchar = long(parts[-6])
-                rchar = long(parts[-7])
+    outputfiles = ["utimes", "stimes", "wchars", "rchars", "writebytes", "readbytes", "vsizes"]
+    if not all_nodes:
+        return
 
-                rchars.setdefault(time, {})[pid] = calc_diff(time, prev_times.get(pid, time), rchar, prev_rchar.get(pid, rchar)) / 1024.0
-                wchars.setdefault(time, {})[pid] = calc_diff(time, prev_times.get(pid, time), wchar, prev_wchar.get(pid, wchar)) / 1024.0
-                rchars[time].setdefault(nodename, []).append(rchars[time][pid])
-                wchars[time].setdefault(nodename, []).append(wchars[time][pid])
+    times = numpy.concatenate(node_times)
+    values = numpy.concatenate(node_values)
+    all_times, rows = numpy.unique(times, return_inverse=True)
 
-                prev_utimes[pid] = utime
-                prev_stimes[pid] = stime
-                prev_rchar[pid] = rchar
-                prev_wchar[pid] = wchar
-                prev_readbytes[pid] = read_bytes
-                prev_writebytes[pid] = write_bytes
-                prev_times[pid] = time
+    all_pids = sorted(set(pid for pids, _ in node_pids for pid in pids))
+    pid_columns = dict((pid, column) for column, pid in enumerate(all_pids))
+    columns = numpy.concatenate([numpy.array([pid_columns[pid] for pid in pids], dtype=numpy.int64)[pid_indexes]
+                                 for pids, pid_indexes in node_pids])
 
-    all_pids = list(all_pids)
-    write_records(all_pids, utimes, output_directory, "utimes.txt")
-    write_records(all_pids, stimes, output_directory, "stimes.txt")
-    write_records(all_pids, wchars, output_directory, "wchars.txt")
-    write_records(all_pids, rchars, output_directory, "rchars.txt")
-    write_records(all_pids, writebytes, output_directory, "writebytes.txt")
-    write_records(all_pids, readbytes, output_directory, "readbytes.txt")
-    write_records(all_pids, vsizes, output_directory, "vsizes.txt")
+    for index, outputfile in enumerate(outputfiles):
+        write_records(all_pids, all_times, rows, columns, values[:, index], output_directory, outputfile + ".txt")
 
     if len(all_nodes) > 1:
         # calculate sum for all nodes
-        for dictionary in [utimes, stimes, wchars, rchars, vsizes, writebytes, readbytes]:
-            for time, values in dictionary.iteritems():
-                for node in all_nodes:
-                    if node in values:
-                        values[node] = sum(values[node])
+        node_columns = dict((nodename, column) for column, nodename in enumerate(sorted(all_nodes)))
+        node_columns = numpy.concatenate([numpy.repeat(node_columns[nodename], len(times)) for nodename, times in zip(all_nodes, node_times)])
+        all_nodes.sort()
+
+        cells = rows * len(all_nodes) + node_columns
+        unique_cells, cell_indexes = numpy.unique(cells, return_inverse=True)
 
         # write mean for all nodes to separate files
-        write_records(all_nodes, utimes, output_directory, "utimes_node.txt")
-        write_records(all_nodes, stimes, output_directory, "stimes_node.txt")
-        write_records(all_nodes, wchars, output_directory, "wchars_node.txt")
-        write_records(all_nodes, rchars, output_directory, "rchars_node.txt")
-        write_records(all_nodes, writebytes, output_directory, "writebytes_node.txt")
-        write_records(all_nodes, readbytes, output_directory, "readbytes_node.txt")
-        write_records(all_nodes, vsizes, output_directory, "vsizes_node.txt")
+        for index, outputfile in enumerate(outputfiles):
+            sums = numpy.bincount(cell_indexes, weights=values[:, index])
+            write_records(all_nodes, all_times, unique_cells // len(all_nodes), unique_cells % len(all_nodes), sums, output_directory, outputfile + "_node.txt")
+
+
+def get_thread_usage(root, files):
+    """
+    Returns the per node part of parse_thread_files for the thread usage file in root: the times, the
+    index of the thread and the values of every sample, the column name of every thread and its
+    (cpu seconds, max cpu seconds per second) and (pid, tid) for the summary.
+    """
+    filename = 'thread_usage.log'
+    if filename not in files:
+        return None
+
+    print >> sys.stderr, "Parsing thread_usage file %s" % filename
+    sc_clk_tck, times, counters, names = load_thread_file(os.path.join(root, filename))
+    if not len(times):
+        return None
+
+    tids = counters[:, 1]
+    previous_samples = get_previous_samples(tids)
+    values = numpy.empty((len(times), 2))
+    values[:, 0] = calc_rates(times, counters[:, 2], previous_samples) / sc_clk_tck
+    values[:, 1] = calc_rates(times, counters[:, 3], previous_samples) / sc_clk_tck
+
+    # Name the columns after the last name seen for each thread
+    unique_tids, first_samples, tid_indexes = numpy.unique(tids, return_index=True, return_inverse=True)
+    last_samples = numpy.zeros(len(unique_tids), dtype=numpy.int64)
+    numpy.maximum.at(last_samples, tid_indexes, numpy.arange(len(tids)))
+
+    columns = []
+    summary = numpy.empty((len(unique_tids), 2))
+    for index, (tid, first_sample, last_sample) in enumerate(zip(unique_tids.tolist(), first_samples.tolist(), last_samples.tolist())):
+        name = ''.join(char if char.isalnum() else '_' for char in names[last_sample])
+        columns.append("%d_%s" % (tid, name))
+
+        cpu = counters[last_sample, 2:].sum() - counters[first_sample, 2:].sum()
+        max_cpu = values[tid_indexes == index].sum(axis=1).max()
+        summary[index] = cpu / sc_clk_tck, max_cpu
+
+    return {'thread_times': times, 'thread_indexes': tid_indexes, 'thread_values': values, 'thread_columns': numpy.array(columns),
+            'thread_summary': summary, 'thread_ids': counters[last_samples][:, :2], 'thread_names': numpy.array([names[sample] for sample in last_samples])}
+
+
+def parse_thread_files(node_parts, output_directory, start_timestamp):
+    """
+    Writes the utime and stime of every thread (thread_utimes.txt, thread_stimes.txt) and a summary
+    of the CPU time used by each one, busiest first (thread_cpu.txt).
+    """
+    all_threads = []
+    thread_times = []
+    thread_columns = []
+    thread_values = []
+    summary = []
+
+    for nodename, parts in node_parts:
+        if 'thread_times' in parts:
+            columns = numpy.arange(len(all_threads), len(all_threads) + len(parts['thread_columns']))
+            all_threads.extend("%s_%s" % (nodename, column) for column in parts['thread_columns'].tolist())
+
+            for (cpu, max_cpu), (pid, tid), name in zip(parts['thread_summary'], parts['thread_ids'], parts['thread_names'].tolist()):
+                summary.append((cpu, max_cpu, nodename, pid, tid, name))
+
+            thread_times.append(parts['thread_times'] - start_timestamp)
+            thread_columns.append(columns[parts['thread_indexes']])
+            thread_values.append(parts['thread_values'])
+
+    if not all_threads:
+        return
+
+    # Sort the columns by name, as for the other files
+    order = sorted(range(len(all_threads)), key=all_threads.__getitem__)
+    new_columns = numpy.empty(len(order), dtype=numpy.int64)
+    new_columns[order] = numpy.arange(len(order))
+    all_threads = [all_threads[column] for column in order]
+
+    times = numpy.concatenate(thread_times)
+    values = numpy.concatenate(thread_values)
+    columns = new_columns[numpy.concatenate(thread_columns)]
+    all_times, rows = numpy.unique(times, return_inverse=True)
+
+    write_records(all_threads, all_times, rows, columns, values[:, 0], output_directory, "thread_utimes.txt")
+    write_records(all_threads, all_times, rows, columns, values[:, 1], output_directory, "thread_stimes.txt")
+
+    fp = open(os.path.join(output_directory, "thread_cpu.txt"), 'wb')
+    print >> fp, "# cpu seconds used, max cpu seconds per second, node, pid, tid, name"
+    for cpu, max_cpu, nodename, pid, tid, name in sorted(summary, reverse=True):
+        print >> fp, "%.2f %.2f %s %d %d %s" % (cpu, max_cpu, nodename, pid, tid, name)
+    fp.close()
+
+
+def get_cgroup_usage(root, files):
+    """
+    Returns the per node part of parse_cgroup_files for the cgroup usage file in root: the times, the
+    commands, the index of the command and the values of every sample.
+    """
+    filename = 'cgroup_usage.log'
+    if filename not in files:
+        return None
+
+    print >> sys.stderr, "Parsing cgroup_usage file %s" % filename
+    times, counters = load_cgroup_file(os.path.join(root, filename))
+    if not len(times):
+        return None
+
+    commands = counters[:, 0]
+    previous_samples = get_previous_samples(commands)
+    values = numpy.empty((len(times), 5))
+    values[:, 0] = calc_rates(times, counters[:, 1], previous_samples) / 1e6
+    values[:, 1] = counters[:, 4] / 1048576.0
+    values[:, 2] = calc_rates(times, counters[:, 5], previous_samples) / 1024.0
+    values[:, 3] = calc_rates(times, counters[:, 6], previous_samples) / 1024.0
+    values[:, 4] = counters[:, 9]
+
+    unique_commands, command_indexes = numpy.unique(commands, return_inverse=True)
+    return {'cgroup_times': times, 'cgroup_commands': unique_commands, 'cgroup_indexes': command_indexes, 'cgroup_values': values}
+
+
+def parse_cgroup_files(node_parts, output_directory, start_timestamp):
+    """
+    Writes the cpu usage, memory, disk IO and number of processes of every command as accounted by
+    its cgroup (cgroup_cpu.txt, cgroup_memory.txt, cgroup_readbytes.txt, cgroup_writebytes.txt and
+    cgroup_pids.txt), with a column per node and command.
+    """
+    all_commands = []
+    command_times = []
+    command_columns = []
+    command_values = []
+
+    for nodename, parts in node_parts:
+        if 'cgroup_times' in parts:
+            columns = numpy.arange(len(all_commands), len(all_commands) + len(parts['cgroup_commands']))
+            all_commands.extend("%s_%05d" % (nodename, command) for command in parts['cgroup_commands'].tolist())
+
+            command_times.append(parts['cgroup_times'] - start_timestamp)
+            command_columns.append(columns[parts['cgroup_indexes']])
+            command_values.append(parts['cgroup_values'])
+
+    if not all_commands:
+        return
+
+    # Sort the columns by name, as for the other files
+    order = sorted(range(len(all_commands)), key=all_commands.__getitem__)
+    new_columns = numpy.empty(len(order), dtype=numpy.int64)
+    new_columns[order] = numpy.arange(len(order))
+    all_commands = [all_commands[column] for column in order]
+
+    times = numpy.concatenate(command_times)
+    values = numpy.concatenate(command_values)
+    columns = new_columns[numpy.concatenate(command_columns)]
+    all_times, rows = numpy.unique(times, return_inverse=True)
+
+    for index, outputfile in enumerate(["cgroup_cpu", "cgroup_memory", "cgroup_readbytes", "cgroup_writebytes", "cgroup_pids"]):
+        write_records(all_commands, all_times, rows, columns, values[:, index], output_directory, outputfile + ".txt")
+
+
+def calc_node_sums(times, pids, values, lifetime):
+    """
+    Returns the unique times and the sum of the last value of every process at each of them for
+    samples taken round robin, a process is no longer counted lifetime seconds after its last sample.
+    """
+    previous_samples = get_previous_samples(pids)
+    deltas = values - numpy.where(previous_samples == numpy.arange(len(pids)), 0, values[previous_samples])
+
+    # Remove every process from the sum after its last sample
+    last_samples = numpy.zeros(pids.max() + 1, dtype=numpy.int64)
+    last_samples.fill(-1)
+    numpy.maximum.at(last_samples, pids, numpy.arange(len(pids)))
+    last_samples = last_samples[last_samples >= 0]
+    times = numpy.concatenate([times, times[last_samples] + lifetime])
+    deltas = numpy.concatenate([deltas, -values[last_samples]])
+
+    order = numpy.argsort(times, kind='mergesort')
+    sums = numpy.cumsum(deltas[order])
+    unique_times, last = numpy.unique(times[order][::-1], return_index=True)
+    return unique_times, sums[len(sums) - 1 - last]
+
+
+def get_memory_usage(root, files):
+    """
+    Returns the per node part of parse_memory_files for the memory usage file in root: the times, the
+    pids, the index of the pid and the values of every sample and the rss, pss and uss sums.
+    """
+    filename = 'memory_usage.log'
+    if filename not in files:
+        return None
+
+    print >> sys.stderr, "Parsing memory_usage file %s" % filename
+    metainfo, times, samples = load_memory_file(os.path.join(root, filename))
+    if not len(times):
+        return None
+
+    pids = samples[:, 0]
+    values = samples[:, 1:] / 1048576.0
+    values[samples[:, 1:] < 0] = numpy.nan
+
+    unique_pids, pid_indexes = numpy.unique(pids, return_inverse=True)
+    part = {'memory_times': times, 'memory_pids': unique_pids, 'memory_indexes': pid_indexes, 'memory_values': values}
+
+    # Processes are sampled round robin, so sum the last sample of each of them
+    for index in xrange(3):
+        part['memory_sum_times_%d' % index], part['memory_sums_%d' % index] = calc_node_sums(times, pid_indexes, values[:, index], metainfo['memory_interval'])
+    return part
+
+
+def parse_memory_files(node_parts, output_directory, start_timestamp):
+    """
+    Writes the RSS, PSS and USS (in MB) of every process (rss.txt, pss.txt, uss.txt) and their sum
+    per node (rss_node.txt, pss_node.txt, uss_node.txt). There are no PSS values if the node had to
+    fall back to statm.
+    """
+    all_pids = []
+    pid_times = []
+    pid_columns = []
+    pid_values = []
+    all_nodes = []
+    node_sums = []
+
+    for nodename, parts in node_parts:
+        if 'memory_times' in parts:
+            columns = numpy.arange(len(all_pids), len(all_pids) + len(parts['memory_pids']))
+            all_pids.extend("%s_%d" % (nodename, pid) for pid in parts['memory_pids'].tolist())
+
+            pid_times.append(parts['memory_times'] - start_timestamp)
+            pid_columns.append(columns[parts['memory_indexes']])
+            pid_values.append(parts['memory_values'])
+
+            all_nodes.append(nodename)
+            node_sums.append([(parts['memory_sum_times_%d' % index] - start_timestamp, parts['memory_sums_%d' % index]) for index in xrange(3)])
+
+    if not all_pids:
+        return
+
+    # Sort the columns by name, as for the other files
+    order = sorted(range(len(all_pids)), key=all_pids.__getitem__)
+    new_columns = numpy.empty(len(order), dtype=numpy.int64)
+    new_columns[order] = numpy.arange(len(order))
+    all_pids = [all_pids[column] for column in order]
+
+    times = numpy.concatenate(pid_times)
+    values = numpy.concatenate(pid_values)
+    columns = new_columns[numpy.concatenate(pid_columns)]
+    all_times, rows = numpy.unique(times, return_inverse=True)
+
+    node_order = sorted(range(len(all_nodes)), key=all_nodes.__getitem__)
+    for index, outputfile in enumerate(["rss", "pss", "uss"]):
+        has_value = ~numpy.isnan(values[:, index])
+        if not has_value.any():
+            continue
+        write_records(all_pids, all_times, rows[has_value], columns[has_value], values[has_value, index], output_directory, outputfile + ".txt")
+
+        sum_times = numpy.concatenate([node_sums[node][index][0] for node in node_order])
+        sum_columns = numpy.concatenate([numpy.repeat(column, len(node_sums[node][index][0])) for column, node in enumerate(node_order)])
+        sums = numpy.concatenate([node_sums[node][index][1] for node in node_order])
+        has_value = ~numpy.isnan(sums)
+
+        all_sum_times, sum_rows = numpy.unique(sum_times[has_value], return_inverse=True)
+        write_records(sorted(all_nodes), all_sum_times, sum_rows, sum_columns[has_value], sums[has_value], output_directory, outputfile + "_node.txt")
+
+
+def get_node_parts(root, files):
+    """
+    Returns the per node parts of the parsing of the process_guard logs in root as a dict of arrays,
+    loaded from the partial file if that was already done on the node.
+    """
+    if PARTIAL_FILENAME in files:
+        print >> sys.stderr, "Loading the partial results file %s" % PARTIAL_FILENAME
+        partial = numpy.load(os.path.join(root, PARTIAL_FILENAME))
+        parts = dict((key, partial[key]) for key in partial.files)
+        partial.close()
+        return parts
+
+    parts = {}
+    for get_part in (get_resource_usage, get_thread_usage, get_cgroup_usage, get_memory_usage):
+        parts.update(get_part(root, files) or {})
+    return parts
+
+
+def save_partial(node_directory):
+    """
+    Does the per node part of the parsing on the node that ran the processes, so only the (much smaller)
+    partial results file has to be sent to the head node, where main() merges them.
+    """
+    files = [filename for filename in os.listdir(node_directory) if filename != PARTIAL_FILENAME]
+    parts = get_node_parts(node_directory, files)
+
+    filename = os.path.join(node_directory, PARTIAL_FILENAME)
+    fp = open(filename + '.tmp', 'wb')
+    numpy.savez_compressed(fp, **parts)
+    fp.close()
+    os.rename(filename + '.tmp', filename)
 
 
 def main(input_directory, output_directory, start_time=0):
-    parse_resource_files(input_directory, output_directory, start_time)
+    node_parts = []
+    for root, dirs, files in os.walk(input_directory):
+        parts = get_node_parts(root, files)
+        if parts:
+            node_parts.append((root.split('/')[-1], parts))
+
+    parse_resource_files(node_parts, output_directory, start_time)
+    parse_thread_files(node_parts, output_directory, start_time)
+    parse_cgroup_files(node_parts, output_directory, start_time)
+    parse_memory_files(node_parts, output_directory, start_time)
 
 if __name__ == "__main__":
-    if len(argv) < 3:
+    if len(argv) == 3 and argv[1] == '--partial':
+        save_partial(argv[2])
+
+    elif len(argv) < 3:
         print >> sys.stderr, "Usage: %s <input-directory> <output-directory> [<experiment start timestamp>]" % (argv[0])
+        print >> sys.stderr, "       %s --partial <node-directory>" % (argv[0])
         print >> sys.stderr, "Got:", argv
 
         exit(1)
 
-    if len(argv) == 4:
+    elif len(argv) == 4:
         main(argv[1], argv[2], int(argv[3]))
     else:
         main(argv[1], argv[2])
@@ -53,11 +53,42 @@ if [ -z "$DISPERSY_STATISTICS_EXTRACTION_CMD" ]; then
     DISPERSY_STATISTICS_EXTRACTION_CMD=extract_dispersy_statistics.py
 fi
 
+# @CONF_OPTION DISPERSY_STATISTICS_EXTRACTION_JOBS: Amount of processes used to parse and reduce the statistics files (default: number of cores).
+if [ -z "$DISPERSY_STATISTICS_EXTRACTION_JOBS" ]; then
+    DISPERSY_STATISTICS_EXTRACTION_JOBS=$(grep -c ^processor /proc/cpuinfo)
+fi
+
+# @CONF_OPTION DISPERSY_STATISTICS_RECORD_FORMAT: Format of the intermediate record files, text (default) or binary (needs numpy).
+if [ -z "$DISPERSY_STATISTICS_RECORD_FORMAT" ]; then
+    DISPERSY_STATISTICS_RECORD_FORMAT=text
+fi
+
+# @CONF_OPTION DISPERSY_STATISTICS_INCREMENTAL: Only parse the new parts of the statistics files when post processing the same output dir again, true (default) or false.
+if [ -z "$DISPERSY_STATISTICS_INCREMENTAL" ]; then
+    DISPERSY_STATISTICS_INCREMENTAL=true
+fi
+if [ "$DISPERSY_STATISTICS_INCREMENTAL" == "true" ]; then
+    DISPERSY_STATISTICS_EXTRACTION_ARGS="--incremental"
+fi
+
+# @CONF_OPTION DISPERSY_STATISTICS_REDUCE_MODES: Space separated statistics written when reducing the data for the graphs: mean, minmax, percentiles and/or lttb (default: mean minmax).
+if [ -z "$DISPERSY_STATISTICS_REDUCE_MODES" ]; then
+    DISPERSY_STATISTICS_REDUCE_MODES="mean minmax"
+fi
+for MODE in $DISPERSY_STATISTICS_REDUCE_MODES; do
+    DISPERSY_STATISTICS_REDUCE_ARGS="$DISPERSY_STATISTICS_REDUCE_ARGS --mode $MODE"
+done
+
+# @CONF_OPTION DISPERSY_STATISTICS_REDUCE_LEVELS: Amount of resolutions of the reduced data, every one with 4 times more rows than the previous one (default: 1).
+if [ -z "$DISPERSY_STATISTICS_REDUCE_LEVELS" ]; then
+    DISPERSY_STATISTICS_REDUCE_LEVELS=1
+fi
+
 cd $OUTPUT_DIR
 #Step 2: Extract the data needed for the graphs from the experiment log file.
 
 TEMPFILE=$(mktemp)
-$DISPERSY_STATISTICS_EXTRACTION_CMD . $MESSAGES_TO_PLOT > $TEMPFILE
+$DISPERSY_STATISTICS_EXTRACTION_CMD --jobs $DISPERSY_STATISTICS_EXTRACTION_JOBS --format $DISPERSY_STATISTICS_RECORD_FORMAT $DISPERSY_STATISTICS_EXTRACTION_ARGS . $MESSAGES_TO_PLOT > $TEMPFILE
 #Get the XMIN XMAX XSTART vars from the extracted data
 source $TEMPFILE
 rm $TEMPFILE
@@ -66,7 +97,12 @@ rm $TEMPFILE
 extract_process_guard_stats.py . . $XSTART
 
 #Step 4: Reduce the data
-reduce_dispersy_statistics.py . 300
+reduce_dispersy_statistics.py --jobs $DISPERSY_STATISTICS_EXTRACTION_JOBS --levels $DISPERSY_STATISTICS_REDUCE_LEVELS $DISPERSY_STATISTICS_REDUCE_ARGS . 300
+
+# The R scripts can only read text files
+if [ "$DISPERSY_STATISTICS_RECORD_FORMAT" == "binary" ]; then
+    export_records.py .
+fi
 
 #Step 5: Graph the stuff
 # TODO(emilon): Maybe move this to the general setup script
@@ -0,0 +1,79 @@
+#!/bin/bash
+# pre_process_dispersy_experiment.sh ---
+#
+# Filename: pre_process_dispersy_experiment.sh
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 21:12:37 2026 (+0200)
+
+# Commentary:
+#
+# Runs on every DAS4 node once its instances are done (see DAS4_NODE_PRE_PROCESS_CMD), from its
+# output directory. It does the per peer part of the statistics extraction and the per node part
+# of the process_guard logs parsing there, and compresses the raw logs afterwards. This way the
+# head node receives a lot less data and post_process_dispersy_experiment.sh only has to merge the
+# partial results.
+#
+# If any of the steps fails the raw logs are left untouched and the head node will parse them.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+# These use the same defaults as post_process_dispersy_experiment.sh, the results are only merged if
+# they were extracted with the same settings.
+if [ -z "$DISPERSY_STATISTICS_EXTRACTION_CMD" ]; then
+    DISPERSY_STATISTICS_EXTRACTION_CMD=extract_dispersy_statistics.py
+fi
+
+if [ -z "$DISPERSY_STATISTICS_EXTRACTION_JOBS" ]; then
+    DISPERSY_STATISTICS_EXTRACTION_JOBS=$(grep -c ^processor /proc/cpuinfo)
+fi
+
+if [ -z "$DISPERSY_STATISTICS_RECORD_FORMAT" ]; then
+    DISPERSY_STATISTICS_RECORD_FORMAT=text
+fi
+
+echo "Extracting the statistics of the peers of $(hostname)..."
+if $DISPERSY_STATISTICS_EXTRACTION_CMD --partial --jobs $DISPERSY_STATISTICS_EXTRACTION_JOBS --format $DISPERSY_STATISTICS_RECORD_FORMAT . $MESSAGES_TO_PLOT; then
+    gzip -f [0-9]*/statistics.log
+fi
+
+echo "Extracting the resource usage of $(hostname)..."
+if extract_process_guard_stats.py --partial .; then
+    for FILE in resource_usage.log resource_usage.rec thread_usage.log cgroup_usage.log memory_usage.log; do
+        if [ -e $FILE ]; then
+            gzip -f $FILE
+        fi
+    done
+fi
+
+# The stderr files are left alone, post_process_dispersy_experiment.sh looks for non-empty ones.
+for FILE in $(find -type f ! -empty -name "*.out"); do
+    gzip -f "$FILE"
+done
+
+#
+# pre_process_dispersy_experiment.sh ends here
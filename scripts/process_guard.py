@@ -4,15 +4,97 @@
 
 import subprocess
 from time import sleep, time
-from os import setpgrp, getpgrp, killpg, getpid, access, R_OK, path, kill, errno, sysconf, sysconf_names
+from os import setpgrp, getpgrp, killpg, getpid, access, R_OK, kill, errno, sysconf, sysconf_names
+from os import open as os_open, close, read, lseek, listdir, mkdir, rmdir, path, O_RDONLY, SEEK_SET
 from signal import SIGKILL, SIGTERM, signal
 from glob import iglob
 from math import ceil
+from bisect import bisect_right
+from struct import Struct
 import json
 
+try:
+    from os import pread
+except ImportError:
+    # Python 2 has no pread, seeking back to the start of the file is the next best thing.
+    def pread(fd, buffersize, offset):
+        lseek(fd, offset, SEEK_SET)
+        return read(fd, buffersize)
+
+PROC_READ_SIZE = 4096
+
+def parse_raw_stats(line):
+    """
+    Parses a line generated by ResourceMonitor.get_raw_stats() into a
+    (pid, utime, stime, vsize, rss, rchar, wchar, read_bytes, write_bytes) tuple.
+    """
+    pid, status = line.split(' ', 1)
+    # The process name can contain spaces, so skip it before splitting.
+    parts = status[status.rfind(')') + 2:].split()
+    # parts[0] is the 3rd field (state) of /proc/<pid>/stat and the last 7 ones are the /proc/<pid>/io values.
+    return (int(pid), int(parts[11]), int(parts[12]), int(parts[20]), int(parts[21]),
+            int(parts[-7]), int(parts[-6]), int(parts[-3]), int(parts[-2]))
+
+
+def find_cgroup2_dir():
+    """
+    Returns the cgroup v2 directory we are running in, or None if there is no cgroup v2 hierarchy.
+    """
+    mount_point = None
+    for line in open('/proc/self/mounts'):
+        parts = line.split()
+        if parts[2] == 'cgroup2':
+            mount_point = parts[1]
+            break
+    if not mount_point:
+        return None
+
+    for line in open('/proc/self/cgroup'):
+        hierarchy, _, cgroup = line.rstrip('\n').split(':', 2)
+        if hierarchy == '0':
+            return mount_point + cgroup.rstrip('/')
+    return None
+
+
+class BinaryResourceLog(object):
+    """
+    Writes the samples as fixed width records instead of the verbatim /proc lines, keeping only the
+    fields used by extract_process_guard_stats.py. The first line of the file is a JSON document with
+    the meta info, which also describes the records.
+    """
+    FIELDS = ('timestamp', 'pid', 'utime', 'stime', 'vsize', 'rss', 'rchar', 'wchar', 'read_bytes', 'write_bytes')
+    RECORD = Struct('<d9Q')
+
+    def __init__(self, filename, metainfo, buffered_records=131072):
+        self._file = open(filename, 'wb')
+
+        metainfo = dict(metainfo, fields=self.FIELDS, struct=self.RECORD.format)
+        self._file.write(json.dumps(metainfo) + "\n")
+
+        self._buffer = bytearray(self.RECORD.size * buffered_records)
+        self._offset = 0
+
+    def write_sample(self, timestamp, stats):
+        self.RECORD.pack_into(self._buffer, self._offset, timestamp, *stats)
+        self._offset += self.RECORD.size
+        if self._offset == len(self._buffer):
+            self.flush()
+
+    def flush(self):
+        self._file.write(buffer(self._buffer, 0, self._offset))
+        self._offset = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
 class ResourceMonitor(object):
     # adapted after http://stackoverflow.com/questions/276052/how-to-get-current-cpu-and-ram-usage-in-python
 
+    # Whether update_pid_tree() is cheap enough to be called on every tick
+    continuous_pid_discovery = False
+
     def __init__(self, output_dir, commands):
         """Create new ResourceMonitor instance."""
 
@@ -37,6 +119,21 @@ class ResourceMonitor(object):
 
         self.last_died = False
 
+        # pid -> (stat fd, io fd), the /proc files of the monitored processes are kept open between samples.
+        self.proc_fds = {}
+        # (pid, tid) -> stat fd of the threads of the monitored processes
+        self.thread_fds = {}
+        # pid -> smaps_rollup (or statm) fd of the processes we sample the memory usage of
+        self.memory_fds = {}
+        # smaps_rollup needs Linux >= 4.14, otherwise we can only get the RSS and an USS estimate from statm.
+        self.smaps_rollup_supported = access('/proc/%d/smaps_rollup' % getpid(), R_OK)
+        try:
+            self.page_size = sysconf(sysconf_names['SC_PAGE_SIZE'])
+        except AttributeError:
+            self.page_size = 4096
+        # Finding new processes by following /proc/<pid>/task/<tid>/children needs Linux >= 3.5 built with CONFIG_PROC_CHILDREN.
+        self.children_supported = bool(list(iglob('/proc/%d/task/*/children' % getpid())))
+
     def prune_pid_list(self):
         """
         Remove all finished processes from pid_dict and pid_list.
@@ -66,32 +163,39 @@ class ResourceMonitor(object):
                 del self.pid_dict[pid]
             if pid in self.pid_list:
                 self.pid_list.remove(pid)
+            self.close_proc_files(pid)
 
         if not self.pid_list and pids_to_remove:  # If the pid list is empty and we have removed any PID, it means we can exit as no more processes will appear.
             self.last_died = True
 
+    def get_proc_files(self, pid):
+        if pid not in self.proc_fds:
+            stat_fd = os_open('/proc/%s/stat' % pid, O_RDONLY)
+            try:
+                io_fd = os_open('/proc/%s/io' % pid, O_RDONLY)
+            except OSError:
+                close(stat_fd)
+                raise
+            self.proc_fds[pid] = (stat_fd, io_fd)
+        return self.proc_fds[pid]
+
+    def close_proc_files(self, pid):
+        for fd in self.proc_fds.pop(pid, ()):
+            close(fd)
+        if pid in self.memory_fds:
+            close(self.memory_fds.pop(pid))
+
     def get_raw_stats(self):
-        for pid in self.pid_list:
+        for pid in list(self.pid_list):
             try:
-                if False:
-                    status = "9932 (bash) S 1 9932 9932 0 -1 8192 1330 25068 0 12 1 0 21 7 20 0 1 0 873934607 112930816 2 18446744073709551615 1 1 0 0 0 0 65536 4 65538 18446744073709551615 0 0 17 0 0 0 0 0 0"
-                    lines = [
-                        "rchar: 2012\n",
-                        "wchar: 0\n",
-                        "syscr: 7\n",
-                        "syscw: 0\n",
-                        "read_bytes: 0\n",
-                        "write_bytes: 0\n",
-                        "cancelled_write_bytes: 0\n",
-                    ]
-                else:
-                    status = open('/proc/%s/stat' % pid, 'r').read()[:-1]  # Skip the newline
-                    lines = open('/proc/%s/io' % pid, 'r').readlines()
+                stat_fd, io_fd = self.get_proc_files(pid)
+                status = pread(stat_fd, PROC_READ_SIZE, 0)[:-1]  # Skip the newline
+                lines = pread(io_fd, PROC_READ_SIZE, 0).splitlines()
 
                 stats = [status]
                 for line in lines:
                     try:
-                        stats.append(line.split(': ')[1][:-1])  # Skip the newline
+                        stats.append(line.split(': ')[1])
 
                     except Exception as e:
                         print "Got exception while reading/splitting line:"
@@ -99,30 +203,118 @@ class ResourceMonitor(object):
                         print "Line contents are:", line
                 yield ' '.join(stats)
 
-            except IOError:
+            except (IOError, OSError):
+                # Reading the files of a process that has died fails with ESRCH.
+                self.close_proc_files(pid)
                 self.pid_list.remove(pid)
                 if not self.pid_list:
                     self.last_died = True
 
+    def get_thread_stats(self):
+        """
+        Yields a (pid, tid, name, utime, stime) tuple for every thread of the monitored processes.
+        """
+        seen = set()
+        for pid in list(self.pid_list):
+            try:
+                tids = listdir('/proc/%s/task' % pid)
+            except OSError:
+                continue
+
+            for tid in tids:
+                key = (pid, tid)
+                try:
+                    if key not in self.thread_fds:
+                        self.thread_fds[key] = os_open('/proc/%s/task/%s/stat' % key, O_RDONLY)
+                    status = pread(self.thread_fds[key], PROC_READ_SIZE, 0)
+                except (IOError, OSError):
+                    continue
+                seen.add(key)
+
+                # The thread name is the 2nd field, same as /proc/<pid>/task/<tid>/comm
+                name_end = status.rfind(')')
+                name = status[status.find('(') + 1:name_end]
+                parts = status[name_end + 2:].split()
+                yield pid, int(tid), name, int(parts[11]), int(parts[12])
+
+        for key in set(self.thread_fds) - seen:
+            close(self.thread_fds.pop(key))
+
+    def get_memory_stats(self, pids):
+        """
+        Yields a (pid, rss, pss, uss) tuple in bytes for every one of pids still alive, pss is -1
+        if smaps_rollup is not supported.
+        """
+        for pid in pids:
+            try:
+                if pid not in self.memory_fds:
+                    self.memory_fds[pid] = os_open('/proc/%d/%s' % (pid, 'smaps_rollup' if self.smaps_rollup_supported else 'statm'), O_RDONLY)
+                contents = pread(self.memory_fds[pid], PROC_READ_SIZE, 0)
+            except (IOError, OSError):
+                continue
+
+            if self.smaps_rollup_supported:
+                # "Name:   <value> kB" lines after the [rollup] header line
+                sizes = dict((line.split(':', 1)[0], int(line.split()[1]) * 1024) for line in contents.splitlines()[1:] if line.endswith('kB'))
+                if not sizes:
+                    # Kernel threads and zombies have no memory map
+                    continue
+                yield pid, sizes['Rss'], sizes['Pss'], sizes['Private_Clean'] + sizes['Private_Dirty']
+            else:
+                # "size resident shared text lib data dt" in pages, shared only counts file backed pages.
+                resident, shared = [int(value) for value in contents.split()[1:3]]
+                yield pid, resident * self.page_size, -1, (resident - shared) * self.page_size
+
+    def get_stats(self):
+        for line in self.get_raw_stats():
+            yield parse_raw_stats(line)
+
     def is_everyone_dead(self):
         return self.last_died or not self.pid_list
 
     def update_pid_tree(self):
         """Update the list of PIDs contained in the process group"""
-        for pid_dir in iglob('/proc/[1-9]*'):
-            pid = int(pid_dir.split('/')[-1])
+        if self.children_supported:
+            pids = self.get_descendants(getpid())
+        else:
+            pids = (int(pid_dir.split('/')[-1]) for pid_dir in iglob('/proc/[1-9]*'))
+
+        for pid in pids:
             if pid in self.pid_list or pid in self.ignore_pid_list:
                 continue
 
-            stat_file = path.join(pid_dir, 'stat')
-            io_file = path.join(pid_dir, 'io')
+            stat_file = '/proc/%d/stat' % pid
+            io_file = '/proc/%d/io' % pid
             if access(stat_file, R_OK) and access(io_file, R_OK):
-                pgrp = int(open(stat_file, 'r').read().split()[4])  # 4 is PGRP
+                try:
+                    pgrp = int(open(stat_file, 'r').read().rsplit(')', 1)[1].split()[2])  # PGRP is the 5th field
+                except IOError:
+                    continue
                 if pgrp == self.process_group_id:
                     self.pid_list.append(pid)
                 else:
                     self.ignore_pid_list.append(pid)
 
+    def get_descendants(self, pid):
+        """
+        Returns the PIDs of all the processes started by pid or any of its descendants.
+
+        Processes reparented to init (IE: grandchildren of an instance that has died) are missed,
+        while a full /proc scan would find them if they stay in our process group.
+        """
+        descendants = []
+        parents = [pid]
+        while parents:
+            parent = parents.pop()
+            for children_file in iglob('/proc/%d/task/*/children' % parent):
+                try:
+                    children = [int(child) for child in open(children_file, 'r').read().split()]
+                except IOError:
+                    continue
+                descendants.extend(children)
+                parents.extend(children)
+        return descendants
+
     def run(self, cmd):
         if self.output_dir:
             output_filename = self.output_dir + "/%05d.out" % self.cmd_counter
@@ -137,7 +329,7 @@ class ResourceMonitor(object):
             stdout = stderr = None
 
         print >> stdout, "Starting #%05d: %s" % (self.cmd_counter, cmd)
-        p = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=stderr, close_fds=True, env=None)
+        p = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=stderr, close_fds=True, env=None, preexec_fn=self.prepare_command(self.cmd_counter))
         self.pid_dict[p.pid] = p
         self.cmd_counter = self.cmd_counter + 1
 
@@ -162,26 +354,202 @@ class ResourceMonitor(object):
                     print "Nuking the whole thing, have a nice day..."
                     killpg(0, SIGKILL)  # kill the entire process group
 
+    def prepare_command(self, cmd_nr):
+        """
+        Returns a function to be called in the child process before running command cmd_nr.
+        """
+        return None
+
     def get_pid_list(self):
         return self.pid_dict.keys()
 
 
+class CgroupResourceMonitor(ResourceMonitor):
+    """
+    Runs every command in its own cgroup (v2), so all of its processes are found no matter when
+    they are started or whether they leave our process group, and the resource usage of each
+    command can be read from its cgroup (cpu.stat, memory.current, io.stat and pids.current).
+
+    The cgroups are created in a process_guard_<pid> cgroup below the one we are running in. The
+    memory, io and pids files are only there if those controllers can be enabled for it, which
+    isn't the case if the cgroup we are running in isn't delegated to us.
+    """
+    CONTROLLERS = ('cpu', 'memory', 'io', 'pids')
+    continuous_pid_discovery = True
+
+    def __init__(self, output_dir, commands, cgroup_dir, limits=()):
+        self.cgroup_dir = path.join(cgroup_dir, 'process_guard_%d' % getpid())
+        self.enable_controllers(cgroup_dir)
+        mkdir(self.cgroup_dir)
+        self.enable_controllers(self.cgroup_dir)
+
+        # Create all the cgroups before starting anything, so we can still fall back to the /proc
+        # scanning if we are not allowed to create or configure them.
+        self.cgroups = []
+        try:
+            for cmd_nr in xrange(len(commands)):
+                cgroup = path.join(self.cgroup_dir, 'cmd_%05d' % cmd_nr)
+                mkdir(cgroup)
+                self.cgroups.append(cgroup)
+                for key, value in limits:
+                    with open(path.join(cgroup, key), 'w') as f:
+                        f.write(value)
+        except:
+            self.remove_cgroups()
+            raise
+
+        # (cgroup, filename) -> fd, or None if the file doesn't exist
+        self.cgroup_fds = {}
+        ResourceMonitor.__init__(self, output_dir, commands)
+
+    def enable_controllers(self, cgroup_dir):
+        available = open(path.join(cgroup_dir, 'cgroup.controllers')).read().split()
+        for controller in self.CONTROLLERS:
+            if controller in available:
+                try:
+                    with open(path.join(cgroup_dir, 'cgroup.subtree_control'), 'w') as f:
+                        f.write('+' + controller)
+                except IOError:
+                    # IE: There are other processes in the cgroup.
+                    pass
+
+    def prepare_command(self, cmd_nr):
+        procs_file = path.join(self.cgroups[cmd_nr], 'cgroup.procs')
+
+        def join_cgroup():
+            with open(procs_file, 'w') as f:
+                f.write(str(getpid()))
+        return join_cgroup
+
+    def read_cgroup_file(self, cgroup, filename):
+        key = (cgroup, filename)
+        if key not in self.cgroup_fds:
+            try:
+                self.cgroup_fds[key] = os_open(path.join(cgroup, filename), O_RDONLY)
+            except OSError:
+                self.cgroup_fds[key] = None
+
+        fd = self.cgroup_fds[key]
+        return pread(fd, PROC_READ_SIZE, 0) if fd is not None else None
+
+    def update_pid_tree(self):
+        """Update the list of PIDs with all the processes in our cgroups"""
+        for cgroup in self.cgroups:
+            for pid in (self.read_cgroup_file(cgroup, 'cgroup.procs') or '').split():
+                pid = int(pid)
+                if pid not in self.pid_list:
+                    self.pid_list.append(pid)
+
+    def get_cgroup_stats(self):
+        """
+        Yields a (command number, usage_usec, user_usec, system_usec, memory.current, rbytes, wbytes,
+        rios, wios, pids.current) tuple for every command, missing values are 0.
+        """
+        for cmd_nr, cgroup in enumerate(self.cgroups):
+            cpu = dict(line.split() for line in (self.read_cgroup_file(cgroup, 'cpu.stat') or '').splitlines())
+
+            # One "MAJ:MIN rbytes=X wbytes=X rios=X wios=X ..." line per device
+            io = dict.fromkeys(('rbytes', 'wbytes', 'rios', 'wios'), 0)
+            for line in (self.read_cgroup_file(cgroup, 'io.stat') or '').splitlines():
+                for value in line.split()[1:]:
+                    key, value = value.split('=')
+                    if key in io:
+                        io[key] += int(value)
+
+            memory = self.read_cgroup_file(cgroup, 'memory.current')
+            pids = self.read_cgroup_file(cgroup, 'pids.current')
+            yield (cmd_nr, int(cpu.get('usage_usec', 0)), int(cpu.get('user_usec', 0)), int(cpu.get('system_usec', 0)),
+                   int(memory or 0), io['rbytes'], io['wbytes'], io['rios'], io['wios'], int(pids or 0))
+
+    def terminate(self):
+        ResourceMonitor.terminate(self)
+
+        # The processes that left our process group survived killpg
+        for cgroup in self.cgroups:
+            for pid in open(path.join(cgroup, 'cgroup.procs')).read().split():
+                try:
+                    kill(int(pid), SIGKILL)
+                except OSError:
+                    pass
+
+        for fd in self.cgroup_fds.itervalues():
+            if fd is not None:
+                close(fd)
+        self.cgroup_fds = {}
+
+        self.remove_cgroups()
+
+    def remove_cgroups(self):
+        for cgroup in self.cgroups + [self.cgroup_dir]:
+            for _ in xrange(10):
+                try:
+                    rmdir(cgroup)
+                    break
+                except OSError:
+                    # The killed processes might take a bit to be gone
+                    sleep(0.1)
+
+
 class ProcessMonitor(object):
-    def __init__(self, commands, timeout, interval, output_dir=None, monitor_dir=None):
+    def __init__(self, commands, timeout, interval, output_dir=None, monitor_dir=None, monitor_format='text', monitor_threads=False, max_interval=0,
+                 cgroups=False, cgroup_limits=(), memory_interval=0):
         self.start_time = time()
         self.end_time = self.start_time + timeout if timeout else 0 # Do not time out if time_limit is 0.
         self._interval = interval
+        # If set, the interval is doubled up to this value while we can't keep up with it.
+        self._max_interval = max_interval
+        self.ticks = 0
+        self.missed_ticks = 0
+        self.monitor_format = monitor_format
+        self.thread_file = None
+        self.cgroup_file = None
+        self.memory_file = None
+        # Every process gets its memory usage sampled once per memory interval, spread over the ticks.
+        self._memory_interval = memory_interval
+        self._last_memory_pid = 0
+
+        self._rm = None
+        if cgroups:
+            cgroup_dir = find_cgroup2_dir()
+            if not cgroup_dir:
+                print "cgroup v2 is not available, falling back to scanning /proc."
+            else:
+                try:
+                    self._rm = CgroupResourceMonitor(output_dir, commands, cgroup_dir, cgroup_limits)
+                except (IOError, OSError) as e:
+                    print "Could not set up the cgroups (%s), falling back to scanning /proc." % e
+        if not self._rm:
+            self._rm = ResourceMonitor(output_dir, commands)
 
-        self._rm = ResourceMonitor(output_dir, commands)
         if monitor_dir:
-            self.monitor_file = open(monitor_dir + "/resource_usage.log", "w", (1024 ** 2) * 10)  # Set the file's buffering to 10MB
             # We read the jiffie -> second conversion rate from the os, by dividing the utime
             # and stime values by this conversion rate we will get the actual cpu seconds spend during this second.
             try:
                 sc_clk_tck = float(sysconf(sysconf_names['SC_CLK_TCK']))
             except AttributeError:
                 sc_clk_tck = 100.0
-            self.monitor_file.write(json.dumps({"sc_clk_tck": sc_clk_tck})+"\n")
+
+            if monitor_format == 'binary':
+                self.monitor_file = BinaryResourceLog(monitor_dir + "/resource_usage.rec", {"sc_clk_tck": sc_clk_tck, "page_size": self._rm.page_size})
+            else:
+                self.monitor_file = open(monitor_dir + "/resource_usage.log", "w", (1024 ** 2) * 10)  # Set the file's buffering to 10MB
+                self.monitor_file.write(json.dumps({"sc_clk_tck": sc_clk_tck})+"\n")
+
+            if isinstance(self._rm, CgroupResourceMonitor):
+                # One "timestamp command usage_usec user_usec system_usec memory rbytes wbytes rios wios pids" line per command and sample
+                self.cgroup_file = open(monitor_dir + "/cgroup_usage.log", "w", (1024 ** 2) * 10)
+                self.cgroup_file.write(json.dumps({"commands": commands})+"\n")
+
+            if memory_interval:
+                # One "timestamp pid rss pss uss" line per process and sample, in bytes
+                self.memory_file = open(monitor_dir + "/memory_usage.log", "w", (1024 ** 2) * 10)
+                self.memory_file.write(json.dumps({"source": "smaps_rollup" if self._rm.smaps_rollup_supported else "statm",
+                                                   "memory_interval": memory_interval})+"\n")
+
+            if monitor_threads:
+                # One "timestamp pid tid utime stime name" line per thread and sample
+                self.thread_file = open(monitor_dir + "/thread_usage.log", "w", (1024 ** 2) * 10)
+                self.thread_file.write(json.dumps({"sc_clk_tck": sc_clk_tck})+"\n")
         else:
             self.monitor_file = None
         # Capture SIGTERM to kill all the child processes before dying
@@ -190,10 +558,34 @@ class ProcessMonitor(object):
 
     def stop(self):
         self.stopping = True
+        if self.missed_ticks:
+            print "Skipped %d of %d sampling ticks as we couldn't keep up with the interval." % (self.missed_ticks, self.ticks + self.missed_ticks)
         if self.monitor_file:
             self.monitor_file.close()
+        if self.thread_file:
+            self.thread_file.close()
+        if self.cgroup_file:
+            self.cgroup_file.close()
+        if self.memory_file:
+            self.memory_file.close()
         self._rm.terminate()
 
+    def get_memory_sample_pids(self, interval):
+        """
+        Returns the processes to sample the memory usage of in this tick. Reading smaps_rollup
+        walks the page tables of the process, so instead of reading all of them every memory
+        interval, the processes are sampled round robin so every tick reads at most
+        len(pid_list) * interval / memory_interval of them.
+        """
+        pids = sorted(self._rm.pid_list)
+        count = int(ceil(len(pids) * min(interval / float(self._memory_interval), 1)))
+
+        start = bisect_right(pids, self._last_memory_pid)
+        sample_pids = (pids[start:] + pids[:start])[:count]
+        if sample_pids:
+            self._last_memory_pid = sample_pids[-1]
+        return sample_pids
+
     def _termTrap(self, *argv):
         print "Captured TERM signal"
         if not self.stopping:
@@ -201,17 +593,26 @@ class ProcessMonitor(object):
 
     def monitoring_loop(self):
         check_for_new_processes = 60
+        # Amount of consecutive ticks with plenty of spare time needed to shrink a backed off interval again
+        relax_after_ticks = 10
 
         time_start = time()
-        sleep_time = self._interval
+        interval = self._interval
+        # The ticks are scheduled at absolute deadlines aligned to the interval (to try to overlap multiple nodes),
+        # so the time spent sampling and the sleep jitter don't accumulate into drift.
+        deadline = ceil(time_start / interval) * interval
         last_subprocess_update = time_start
+        last_overrun_report = 0
+        relaxed_ticks = 0
         while not self.stopping:
             timestamp = time()
-            r_timestamp = ceil(timestamp / self._interval) * self._interval  # rounding timestamp to nearest interval to try to overlap multiple nodes
+            r_timestamp = deadline
+            self.ticks += 1
 
             self._rm.prune_pid_list()
-            # Look for new subprocesses only once a second and only during the first "check_for_new_processes" seconds
-            if (timestamp < time_start + check_for_new_processes) and (timestamp - last_subprocess_update >= 1):
+            # Look for new subprocesses only once a second and only during the first "check_for_new_processes" seconds,
+            # unless it is cheap to do it every time.
+            if self._rm.continuous_pid_discovery or ((timestamp < time_start + check_for_new_processes) and (timestamp - last_subprocess_update >= 1)):
                 self._rm.update_pid_tree()
                 last_subprocess_update = timestamp
 
@@ -220,20 +621,59 @@ class ProcessMonitor(object):
                 return self.stop()
 
             elif self.monitor_file:
-                next_wake = timestamp + self._interval
+                if self.monitor_format == 'binary':
+                    for stats in self._rm.get_stats():
+                        self.monitor_file.write_sample(r_timestamp, stats)
+                else:
+                    for line in self._rm.get_raw_stats():
+                        self.monitor_file.write("%f %s\n" % (r_timestamp, line))
+
+                if self.cgroup_file:
+                    for stats in self._rm.get_cgroup_stats():
+                        self.cgroup_file.write("%f %d %d %d %d %d %d %d %d %d %d\n" % ((r_timestamp,) + stats))
 
-                for line in self._rm.get_raw_stats():
-                    self.monitor_file.write("%f %s\n" % (r_timestamp, line))
+                if self.thread_file:
+                    for pid, tid, name, utime, stime in self._rm.get_thread_stats():
+                        self.thread_file.write("%f %s %d %d %d %s\n" % (r_timestamp, pid, tid, utime, stime, name))
 
-                sleep_time = next_wake - timestamp
-                if sleep_time < 0:
-                    print "Can't keep up with this interval, try a higher value!", sleep_time
-                    self.stop()
+                if self.memory_file:
+                    for stats in self._rm.get_memory_stats(self.get_memory_sample_pids(interval)):
+                        self.memory_file.write("%f %d %d %d %d\n" % ((r_timestamp,) + stats))
 
             if self.end_time and timestamp > self.end_time: # if self.end_time == 0 the time out is disabled.
                 print "Time out, killing monitored processes."
                 return self.stop()
-            sleep(sleep_time)
+
+            now = time()
+            deadline += interval
+            if now >= deadline:
+                # We can't keep up, skip the ticks we missed instead of trying to catch up with them.
+                missed = int((now - deadline) // interval) + 1
+                self.missed_ticks += missed
+                relaxed_ticks = 0
+
+                if self._max_interval and interval < self._max_interval:
+                    interval = min(interval * 2, self._max_interval)
+                    print "Can't keep up with the sampling interval, backing off to %f seconds." % interval
+                elif now - last_overrun_report > 60:
+                    print "Can't keep up with the %f seconds sampling interval, %d ticks skipped so far." % (interval, self.missed_ticks)
+                    last_overrun_report = now
+                deadline = ceil(now / interval) * interval
+
+            elif interval > self._interval:
+                # Go back to the requested interval once sampling takes less than a quarter of the halved one.
+                if now - timestamp < interval / 8:
+                    relaxed_ticks += 1
+                else:
+                    relaxed_ticks = 0
+
+                if relaxed_ticks >= relax_after_ticks:
+                    interval = max(interval / 2, self._interval)
+                    relaxed_ticks = 0
+                    print "Sampling is keeping up again, reducing the interval to %f seconds." % interval
+                    deadline = ceil(now / interval) * interval
+
+            sleep(max(deadline - time(), 0))
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -269,6 +709,43 @@ if __name__ == "__main__":
                       action ="store",
                       help   ="Sample monitoring stats and check processes/threads every FLOAT seconds"
                       )
+    parser.add_option("--max-interval",
+                      metavar='FLOAT',
+                      default=0,
+                      type   =float,
+                      help   ="If sampling can't keep up with --interval, back off by doubling it up to FLOAT seconds instead of skipping ticks (disabled by default)."
+                      )
+    parser.add_option("--cgroups",
+                      action ="store_true",
+                      default=False,
+                      help   ="Run every command in its own cgroup (v2) to find all of its processes and account for its resource usage (written to cgroup_usage.log in the monitor dir)."
+                      )
+    parser.add_option("--cgroup-limit",
+                      metavar='FILE=VALUE',
+                      action ="append",
+                      dest   ="cgroup_limits",
+                      default=[],
+                      help   ="Write VALUE to FILE in the cgroup of every command, IE: memory.max=2G or 'io.max=8:0 wbps=10485760' (can be specified multiple times, needs --cgroups)."
+                      )
+    parser.add_option("--memory-interval",
+                      metavar='SECONDS',
+                      action ="store",
+                      type   ="float",
+                      dest   ="memory_interval",
+                      default=0,
+                      help   ="Sample the RSS, PSS and USS of every process once every SECONDS (written to memory_usage.log in the monitor dir, 0 disables it), spreading the processes over the ticks in between."
+                      )
+    parser.add_option("--threads",
+                      action ="store_true",
+                      default=False,
+                      help   ="Also sample the CPU usage of every thread of the monitored processes (written to thread_usage.log in the monitor dir)."
+                      )
+    parser.add_option("--monitor-format",
+                      metavar='FORMAT',
+                      default='text',
+                      choices=['text', 'binary'],
+                      help   ="Write the monitoring stats as the raw /proc lines (text, default) or as compact fixed width records (binary)."
+                      )
     (options, args) = parser.parse_args()
     if not (options.commands_file or options.commands):
         parser.error("Please specify at least one of --command or --commands-file (run with -h to see command usage).")
@@ -286,7 +763,8 @@ if __name__ == "__main__":
     if not commands:
         parser.error("Could not collect a list of commands to run.\nMake sure that the commands file is not empty or has all the lines commented out.")
 
-    pm = ProcessMonitor(commands,  options.timeout, options.interval, options.output_dir, options.monitor_dir)
+    pm = ProcessMonitor(commands,  options.timeout, options.interval, options.output_dir, options.monitor_dir, options.monitor_format, options.threads, options.max_interval,
+                        options.cgroups, [limit.split('=', 1) for limit in options.cgroup_limits], options.memory_interval)
     try:
         pm.monitoring_loop()
 
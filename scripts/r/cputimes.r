@@ -263,3 +263,42 @@ if(file.exists("vsizes_reduced.txt")){
 
 	ggsave(file="vsizes.png", width=12, height=6, dpi=100)
 }
+
+for(memory in c("rss", "pss", "uss")){
+	if(file.exists(paste(memory, "_reduced.txt", sep=""))){
+		df <- read.table(paste(memory, "_reduced.txt", sep=""), header = TRUE, check.names = FALSE)
+		df <- melt(df, id="time")
+		df$type <- 'Process'
+
+		if(file.exists(paste(memory, "_node_reduced.txt", sep=""))){
+			df2 <- read.table(paste(memory, "_node_reduced.txt", sep=""), header = TRUE, check.names = FALSE)
+			df2 <- melt(df2, id="time")
+			df2$type <- 'Node'
+
+			df <- rbind(df, df2)
+		}
+
+		p <- ggplot(df) + theme_bw()
+
+		if(file.exists("annotations.txt")){
+			df2 <- read.table("annotations.txt", header = TRUE, check.names = FALSE)
+			p <- p + geom_vline(alpha = 0.3, data=df2, aes(xintercept = time))
+			p <- p + geom_text(alpha = 0.3, data=df2, angle = 90, aes(x=time, y=max(df$value), label=remark, hjust=1, vjust=start, size=3))
+		}
+
+		p <- p + geom_step(aes(time, value, group=variable, colour=variable))
+
+		if(file.exists(paste(memory, "_node_reduced.txt", sep=""))){
+			p <- p + facet_grid(type ~ ., scales = "free_y")
+		}
+
+		p <- p + opts(legend.position="none")
+		p <- p + labs(x = "\nTime into experiment (Seconds)", y = paste(toupper(memory), "(MBytes)\n"))
+		if(length(args) > 0){
+			p <- p + xlim(minX, maxX)
+		}
+		print(p)
+
+		ggsave(file=paste(memory, ".png", sep=""), width=12, height=6, dpi=100)
+	}
+}
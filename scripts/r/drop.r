@@ -5,7 +5,12 @@ minX <- as.integer(commandArgs(TRUE)[1])
 maxX <- as.integer(commandArgs(TRUE)[2])
 
 if(file.exists("dropped_diff_reduced.txt")){
-	df <- read.table("dropped_diff_reduced.txt", header = TRUE)
+	# The maximum of every reduced row shows the bursts the mean flattens
+	if(file.exists("dropped_diff_reduced_max.txt")){
+		df <- read.table("dropped_diff_reduced_max.txt", header = TRUE)
+	} else {
+		df <- read.table("dropped_diff_reduced.txt", header = TRUE)
+	}
 	df <- melt(df, id="time")
 	df <- subset(df, df$value > 0)
 	
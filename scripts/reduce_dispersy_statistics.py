@@ -1,78 +1,353 @@
 #!/usr/bin/env python
 import sys
 import os
-from math import ceil
-from collections import defaultdict
+import json
+from math import ceil, floor
+from multiprocessing import Pool
+from optparse import OptionParser
 
-def reduce(base_directory, nrlines, inputfile, outputfile):
+import numpy
+
+from gumby.records import BINARY_EXTENSION, TextRecordReader, open_record_reader, record_file_exists
+
+# Maximum amount of values read at once, the memory used doesn't depend on the size of the files
+BLOCK_VALUES = 2 ** 18
+
+# mean writes <name>_reduced.txt, the others <name>_reduced_<statistic>.txt files next to it
+MODES = ('mean', 'minmax', 'percentiles', 'lttb')
+DEFAULT_PERCENTILES = (5, 50, 95)
+
+# Every extra level has this many times more rows than the previous one
+LEVEL_FACTOR = 4
+INDEX_FILENAME = 'reduced_index.json'
+
+
+class GroupReducer(object):
+    """
+    Writes a row with the statistics of every nrlines_to_merge consecutive rows fed to it (and the
+    maximum time seen so far) to the file of each statistic ('mean', 'min', 'max' or 'p<percentile>').
+    The mean, minimum and maximum are carried over between blocks, the percentiles need to keep the
+    rows of the current group.
+    """
+
+    def __init__(self, nrlines_to_merge, ofps, percentiles=DEFAULT_PERCENTILES):
+        self.nrlines_to_merge = nrlines_to_merge
+        self.ofps = ofps
+        self.percentiles = [percentile for percentile in percentiles if get_percentile_statistic(percentile) in ofps]
+
+        self.max_time = None
+        self.nr_merged = 0
+        self.sums = self.mins = self.maxs = None
+        self.rows = []
+
+    def feed(self, block):
+        start = 0
+        while start < len(block):
+            end = min(start + self.nrlines_to_merge - self.nr_merged, len(block))
+            self.add(block[start:end])
+            start = end
+
+            if self.nr_merged == self.nrlines_to_merge:
+                self.write()
+
+    def add(self, rows):
+        self.max_time = max(self.max_time, rows[:, 0].max())
+        values = rows[:, 1:]
+
+        if 'mean' in self.ofps:
+            if self.sums is None:
+                self.sums = numpy.zeros(values.shape[1])
+            # Summing the carried over sums and the rows in one go adds them in the same order as sum()
+            self.sums = numpy.add.reduce(numpy.vstack((self.sums, values)), axis=0)
+
+        if 'min' in self.ofps:
+            mins = values.min(axis=0)
+            self.mins = mins if self.mins is None else numpy.minimum(self.mins, mins)
+            maxs = values.max(axis=0)
+            self.maxs = maxs if self.maxs is None else numpy.maximum(self.maxs, maxs)
+
+        if self.percentiles:
+            self.rows.append(values)
+
+        self.nr_merged += len(rows)
+
+    def write(self):
+        if 'mean' in self.ofps:
+            self.write_row('mean', self.sums / float(self.nr_merged))
+            self.sums[:] = 0
+
+        if 'min' in self.ofps:
+            self.write_row('min', self.mins)
+            self.write_row('max', self.maxs)
+            self.mins = self.maxs = None
+
+        if self.percentiles:
+            for percentile, values in zip(self.percentiles, numpy.percentile(numpy.vstack(self.rows), self.percentiles, axis=0)):
+                self.write_row(get_percentile_statistic(percentile), values)
+            self.rows = []
+
+        self.nr_merged = 0
+
+    def write_row(self, statistic, values):
+        print >> self.ofps[statistic], ' '.join([str(float(self.max_time))] + map(str, values.tolist())), ''
+
+    def close(self):
+        if self.nr_merged:
+            self.write()
+
+
+def lttb(times, values, threshold):
+    """
+    Returns the indexes of the threshold points of the (times, values) series selected by the
+    largest-triangle-three-buckets algorithm, which keeps the peaks and dips of the series.
+    """
+    nr_points = len(times)
+    if threshold >= nr_points:
+        return numpy.arange(nr_points)
+    if threshold < 3:
+        return numpy.array([0, nr_points - 1][:threshold])
+
+    indexes = numpy.zeros(threshold, dtype=int)
+    indexes[-1] = nr_points - 1
+
+    # The first and last points are always selected, the rest are split in threshold - 2 buckets
+    every = (nr_points - 2) / float(threshold - 2)
+    selected = 0
+    for bucket in xrange(threshold - 2):
+        start = int(floor(bucket * every)) + 1
+        end = int(floor((bucket + 1) * every)) + 1
+        next_end = min(int(floor((bucket + 2) * every)) + 1, nr_points)
+
+        # Select the point making the largest triangle with the previous selected point and the
+        # average of the next bucket
+        next_time = times[end:next_end].mean()
+        next_value = values[end:next_end].mean()
+        areas = numpy.abs((times[selected] - next_time) * (values[start:end] - values[selected]) -
+                          (times[selected] - times[start:end]) * (next_value - values[selected]))
+        selected = start + int(areas.argmax())
+        indexes[bucket + 1] = selected
+
+    return indexes
+
+
+def get_percentile_statistic(percentile):
+    return 'p%g' % percentile
+
+
+def get_statistics(modes, percentiles):
+    statistics = []
+    for mode in MODES:
+        if mode in modes:
+            if mode == 'minmax':
+                statistics.extend(('min', 'max'))
+            elif mode == 'percentiles':
+                statistics.extend(get_percentile_statistic(percentile) for percentile in percentiles)
+            else:
+                statistics.append(mode)
+    return statistics
+
+
+def get_reduced_filename(outputfile, statistic, nrlines, base_nrlines):
+    name, extension = os.path.splitext(outputfile)
+    if statistic != 'mean':
+        name += '_' + statistic
+    if nrlines != base_nrlines:
+        name += '_%d' % nrlines
+    return name + extension
+
+
+def open_reader(inputfile):
+    """
+    Returns a reader of inputfile and the header line of its reduced files. The first line of a text
+    file is kept as it is, it has the names of the columns except in the debugstatistics files, which
+    start with a comment instead.
+    """
+    reader = open_record_reader(inputfile)
+    if not isinstance(reader, TextRecordReader):
+        return reader, ' '.join(reader.names) if reader.names else '# ' + ' '.join(reader.comments)
+
+    fp = open(inputfile, 'r')
+    header = fp.readline().rstrip('\n')
+    fp.close()
+    return TextRecordReader(inputfile, has_names=not header.startswith('#')), header
+
+
+def reduce(base_directory, nrlines, inputfile, outputfile, modes=('mean',), levels=1, percentiles=DEFAULT_PERCENTILES):
+    """
+    Writes outputfile with at most nrlines rows, each of them the mean of consecutive rows of inputfile
+    (and the maximum time seen so far). The rows are read in blocks and the sums of the rows of the
+    current output row are carried over between blocks, so the files are streamed in a single pass
+    after counting their rows.
+
+    The other modes write the minimum and maximum (minmax) or the percentiles of the same rows, or
+    the rows selected by lttb() using the sum of the columns of every row, to their own files. With
+    more than one level, every level also writes files with LEVEL_FACTOR times more rows than the
+    previous one, as long as that is less than the rows of inputfile.
+
+    Returns a {statistic: {nrlines: filename}} dict of the files written.
+    """
     inputfile = os.path.join(base_directory, inputfile)
     outputfile = os.path.join(base_directory, outputfile)
 
-    if os.path.exists(inputfile):
+    written = {}
+    if record_file_exists(inputfile):
         print >> sys.stderr, base_directory, inputfile, outputfile
 
-        ifp = open(inputfile, 'r')
-        ofp = open(outputfile, 'w')
+        reader, header = open_reader(inputfile)
+        block_size = max(BLOCK_VALUES // max(len(header.split()), 1), 1)
+        statistics = get_statistics(modes, percentiles)
 
-        lines = ifp.readlines()
-        print >> ofp, lines[0][:-1]
+        if 'lttb' in statistics:
+            # Counts the rows too
+            times = []
+            sums = []
+            for block in reader.iter_blocks(block_size):
+                times.append(block[:, 0])
+                sums.append(block[:, 1:].sum(axis=1))
+            times = numpy.concatenate(times) if times else numpy.zeros(0)
+            sums = numpy.concatenate(sums) if sums else numpy.zeros(0)
+            nr_records = len(times)
+        else:
+            nr_records = reader.count_rows()
 
-        lines = lines[1:]
-        if len(lines) > nrlines:
-            nrlines_to_merge = int(ceil(len(lines) / float(nrlines)))
-            print >> sys.stderr, "%s has %d lines, reducing to %d lines" % (inputfile, len(lines), nrlines)
+        levels_nrlines = [nrlines * LEVEL_FACTOR ** level for level in xrange(levels)]
+        levels_nrlines = levels_nrlines[:1] + [level_nrlines for level_nrlines in levels_nrlines[1:] if level_nrlines < nr_records]
 
-            max_time = None
-            to_be_merged_parts = defaultdict(list)
-            for i, line in enumerate(lines):
-                parts = line.split()
-                max_time = max(float(parts[0]), max_time)
+        ofps = []
+        copies = []
+        reducers = []
+        selections = []
+        for level_nrlines in levels_nrlines:
+            level_ofps = {}
+            for statistic in statistics:
+                filename = get_reduced_filename(outputfile, statistic, level_nrlines, nrlines)
+                level_ofps[statistic] = ofp = open(filename, 'w')
+                print >> ofp, header
+                ofps.append(ofp)
+                written.setdefault(statistic, {})[level_nrlines] = os.path.basename(filename)
 
-                parts = map(float, parts[1:])
-                for j, part in enumerate(parts):
-                    to_be_merged_parts[j].append(part)
+            if nr_records <= level_nrlines:
+                copies.extend(level_ofps.values())
+                continue
 
-                if (i + 1) % nrlines_to_merge == 0 or (i + 1 == len(lines)):
-                    print >> ofp, max_time,
+            print >> sys.stderr, "%s has %d lines, reducing to %d lines" % (inputfile, nr_records, level_nrlines)
+            if 'lttb' in level_ofps:
+                selections.append((lttb(times, sums, level_nrlines), level_ofps.pop('lttb')))
+            if level_ofps:
+                reducers.append(GroupReducer(int(ceil(nr_records / float(level_nrlines))), level_ofps, percentiles))
 
-                    for j, parts in to_be_merged_parts.iteritems():
-                        mean = sum(parts) / float(len(parts))
-                        print >> ofp, mean,
+        if copies:
+            # Only the first level can be a copy, the others have more rows than inputfile then. The rows
+            # of text files are copied as they are.
+            if isinstance(reader, TextRecordReader):
+                lines = (line.rstrip('\n') for line in reader.iter_lines())
+            else:
+                lines = (' '.join(map(str, parts)) for parts in reader.iter_rows())
+            for line in lines:
+                for ofp in copies:
+                    print >> ofp, line
 
-                        to_be_merged_parts[j] = []
+        else:
+            offset = 0
+            for block in reader.iter_blocks(block_size):
+                for reducer in reducers:
+                    reducer.feed(block)
 
-                    print >> ofp, ''
+                for indexes, ofp in selections:
+                    indexes = indexes[indexes.searchsorted(offset):indexes.searchsorted(offset + len(block))] - offset
+                    for parts in block[indexes].tolist():
+                        print >> ofp, ' '.join(map(str, parts))
 
-        else:
-            for line in lines:
-                print >> ofp, line[:-1]
+                offset += len(block)
 
-        ifp.close()
-        ofp.close()
+        for reducer in reducers:
+            reducer.close()
+        for ofp in ofps:
+            ofp.close()
 
-def main(input_directory, nrlines):
-    for filename in ['send', 'send_diff', 'received', 'received_diff', 'dropped', 'dropped_diff', 'bl_skip', 'bl_skip_diff', 'bl_reuse', 'bl_reuse_skip', 'utimes', 'stimes', 'wchars', 'rchars', 'writebytes', 'readbytes', 'vsizes', 'utimes_node', 'stimes_node', 'wchars_node', 'rchars_node', 'writebytes_node', 'readbytes_node', 'vsizes_node']:
-        reduce(input_directory, nrlines, '%s.txt' % filename, '%s_reduced.txt' % filename)
+    return written
 
-    total_communities = 1
-    while os.path.exists(os.path.join(input_directory, 'total_connections_%d.txt' % total_communities)):
-        reduce(input_directory, nrlines, 'total_connections_%d.txt' % total_communities, 'total_connections_%d_reduced.txt' % total_communities)
 
-        reduce(input_directory, nrlines, 'bl_reuse_%d.txt' % total_communities, 'bl_reuse_%d_reduced.txt' % total_communities)
-        reduce(input_directory, nrlines, 'bl_skip_%d.txt' % total_communities, 'bl_skip_%d_reduced.txt' % total_communities)
-        reduce(input_directory, nrlines, 'bl_time_%d.txt' % total_communities, 'bl_time_%d_reduced.txt' % total_communities)
+def _reduce(job):
+    # Runs in a worker process of main
+    return reduce(*job)
+
+
+def main(input_directory, nrlines, jobs=1, modes=('mean',), levels=1, percentiles=DEFAULT_PERCENTILES):
+    filenames = ['send', 'send_diff', 'received', 'received_diff', 'dropped', 'dropped_diff', 'bl_skip', 'bl_skip_diff', 'bl_reuse', 'bl_reuse_skip', 'utimes', 'stimes', 'wchars', 'rchars', 'writebytes', 'readbytes', 'vsizes', 'utimes_node', 'stimes_node', 'wchars_node', 'rchars_node', 'writebytes_node', 'readbytes_node', 'vsizes_node', 'rss', 'pss', 'uss', 'rss_node', 'pss_node', 'uss_node']
+
+    total_communities = 1
+    while record_file_exists(os.path.join(input_directory, 'total_connections_%d.txt' % total_communities)):
+        filenames.append('total_connections_%d' % total_communities)
+        filenames.append('bl_reuse_%d' % total_communities)
+        filenames.append('bl_skip_%d' % total_communities)
+        filenames.append('bl_time_%d' % total_communities)
 
         total_communities += 1
 
     for filename in os.listdir(input_directory):
-        if filename.endswith('-debugstatistics.txt'):
-            reduce(input_directory, nrlines, filename, filename[:-4] + '_reduced.txt')
+        name, extension = os.path.splitext(filename)
+        if name.endswith('-debugstatistics') and extension in ('.txt', BINARY_EXTENSION):
+            filenames.append(name)
+
+    reduce_jobs = [(input_directory, nrlines, '%s.txt' % filename, '%s_reduced.txt' % filename, modes, levels, percentiles) for filename in filenames]
+    if jobs > 1:
+        pool = Pool(jobs)
+        try:
+            written = pool.map(_reduce, reduce_jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        written = [reduce(*job) for job in reduce_jobs]
+
+    if levels > 1:
+        # Lets a viewer load the coarsest files first and the finer ones when zooming in
+        index = {'levels': [nrlines * LEVEL_FACTOR ** level for level in xrange(levels)],
+                 'statistics': get_statistics(modes, percentiles),
+                 'files': {}}
+        for filename, files in zip(filenames, written):
+            if files:
+                index['files'][filename] = dict((statistic, dict((str(level_nrlines), reduced_filename) for level_nrlines, reduced_filename in levels_files.iteritems()))
+                                                for statistic, levels_files in files.iteritems())
+
+        fp = open(os.path.join(input_directory, INDEX_FILENAME), 'w')
+        json.dump(index, fp, indent=2, separators=(',', ': '), sort_keys=True)
+        fp.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print "Usage: %s <peers-directory> <nr-of-lines-to-output>" % (sys.argv[0])
+    parser = OptionParser(usage="%prog [options] <peers-directory> <nr-of-lines-to-output>")
+    parser.add_option("-j", "--jobs",
+                      metavar='N',
+                      default=1,
+                      type=int,
+                      help="Reduce the files using N processes (default: 1)"
+                      )
+    parser.add_option("-m", "--mode",
+                      action='append',
+                      choices=MODES,
+                      dest='modes',
+                      metavar='MODE',
+                      help="Statistics to write, can be given more than once: mean (<name>_reduced.txt), minmax "
+                      "(<name>_reduced_min.txt and <name>_reduced_max.txt), percentiles (<name>_reduced_p<percentile>.txt) "
+                      "or lttb (<name>_reduced_lttb.txt, the rows selected by largest-triangle-three-buckets) (default: mean)"
+                      )
+    parser.add_option("-p", "--percentiles",
+                      default=','.join(map(str, DEFAULT_PERCENTILES)),
+                      help="Comma separated percentiles written by the percentiles mode (default: %default)"
+                      )
+    parser.add_option("-l", "--levels",
+                      default=1,
+                      type=int,
+                      help="Also write <name>_reduced*_<rows>.txt files with %d, %d... times more rows, up to LEVELS "
+                      "levels, and an index of them in %s (default: %%default)" % (LEVEL_FACTOR, LEVEL_FACTOR ** 2, INDEX_FILENAME)
+                      )
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_usage()
         print >> sys.stderr, sys.argv
 
         exit(1)
 
-    main(sys.argv[1], int(sys.argv[2]))
+    main(args[0], int(args[1]), options.jobs, options.modes or ['mean'], options.levels,
+         [float(percentile) for percentile in options.percentiles.split(',')])
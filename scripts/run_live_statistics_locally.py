@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# run_live_statistics_locally.py ---
+#
+# Filename: run_live_statistics_locally.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 17:03:44 2026 (+0200)
+
+# Commentary:
+#
+# Runs the live statistics aggregation service together with a number of fake peers pushing
+# random (but increasing) statistics to it every second, all of them in this process.
+#
+# Useful to test the service and the clients without having to run a real experiment:
+#
+#     run_live_statistics_locally.py 100 30 /tmp/live_statistics.txt
+#
+# Will run 100 fake peers for 30 seconds and leave the aggregates in /tmp/live_statistics.txt.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from random import randint
+from sys import argv, exit, stdout
+from time import time
+
+from gumby.stats import StatisticsClientFactory, StatisticsServiceFactory
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python.log import startLogging
+
+
+class FakePeer(object):
+
+    def __init__(self, peer_id, port):
+        self.factory = StatisticsClientFactory(peer_id)
+        self.statistics = {'total_send': 0, 'total_down': 0, 'drop_count': 0, 'connections': 0}
+        reactor.connectTCP('127.0.0.1', port, self.factory)
+
+        self._lc = LoopingCall(self.tick)
+        self._lc.start(1.0)
+
+    def tick(self):
+        changed = {'total_send': self.statistics['total_send'] + randint(0, 10240),
+                   'total_down': self.statistics['total_down'] + randint(0, 10240)}
+        if randint(0, 9) == 0:
+            changed['drop_count'] = self.statistics['drop_count'] + 1
+        if randint(0, 4) == 0:
+            changed['connections'] = randint(0, 20)
+
+        self.statistics.update(changed)
+        self.factory.pushStatistics(time(), changed)
+
+    def stop(self):
+        self._lc.stop()
+        self.factory.close()
+
+
+def main():
+    if len(argv) < 3:
+        print >> stdout, "Usage: %s <peers> <duration> [output file]" % argv[0]
+        exit(1)
+
+    peers = int(argv[1])
+    duration = float(argv[2])
+    output_filename = argv[3] if len(argv) > 3 else 'live_statistics.txt'
+
+    startLogging(stdout)
+    port = reactor.listenTCP(0, StatisticsServiceFactory(peers, output_filename), interface='127.0.0.1').getHost().port
+
+    fake_peers = [FakePeer(peer_id, port) for peer_id in xrange(1, peers + 1)]
+    for fake_peer in fake_peers:
+        reactor.callLater(duration, fake_peer.stop)
+
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
+
+#
+# run_live_statistics_locally.py ends here
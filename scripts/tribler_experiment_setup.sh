@@ -45,5 +45,17 @@ fi
 
 das4_setup.sh
 
+# @CONF_OPTION SCENARIO_INDEX: Compile the scenario files of the experiment so every instance only loads its own events instead of parsing them, true (default) or false.
+if [ -z "$SCENARIO_INDEX" ]; then
+    SCENARIO_INDEX=true
+fi
+if [ "$SCENARIO_INDEX" == "true" ]; then
+    for SCENARIO_FILE in $EXPERIMENT_DIR/*.scenario; do
+        if [ -e "$SCENARIO_FILE" ]; then
+            compile_scenario.py "$SCENARIO_FILE"
+        fi
+    done
+fi
+
 #
 # tribler_experiment_setup.sh ends here